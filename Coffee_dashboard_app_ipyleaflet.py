@@ -1,74 +1,48 @@
 from shiny import App, render, ui, reactive
 from shinywidgets import output_widget, render_widget
 from ipyleaflet import Map, Marker, CircleMarker, MarkerCluster, GeoJSON, GeoData
-from ipyleaflet import LayersControl, ScaleControl, Popup
+from ipyleaflet import LayersControl, ScaleControl, Popup, WidgetControl, LayerGroup, LegendControl
 from ipywidgets import HTML
 import geopandas as gpd
-import pandas as pd
 import shinyswatch
-from shapely import wkt
 from shapely.geometry import Point
-from geopy.distance import geodesic
 import plotly.graph_objects as go
 from pathlib import Path
-
-# Load and prepare csv data
-def load_data(path):
-    # Load CSV data
-    data_cws = pd.read_csv(f"{path}/Coffee_Washing_Stations.csv")
-    data_farmers = pd.read_csv(f"{path}/Coffee_farmers.csv")
-    data_farms = pd.read_csv(f"{path}/Coffee_farms.csv")
-
-    # Convert column names to lower case
-    data_cws.columns = data_cws.columns.str.lower()
-    data_farmers.columns = data_farmers.columns.str.lower()
-    data_farms.columns = data_farms.columns.str.lower()
-
-    # convert farmer_cws to lower case
-    data_farmers = data_farmers[data_farmers['farmer_cws'].notna()]
-    data_farmers['farmer_cws'] = data_farmers['farmer_cws'].str.lower().str.replace(' ', '_')
-    
-    data_cws = gpd.GeoDataFrame(
-        data_cws, 
-        geometry=gpd.GeoSeries.from_wkt(data_cws['geom']), 
-        crs="EPSG:4326"
-    ).drop('geom', axis=1)
-    
-   # define a function to filter out farms with invalid WKT strings
-    def safe_load_wkt(wkt_string):
-        try:
-            return wkt.loads(wkt_string)
-        except Exception:
-            return None
-
-    # Apply the WKT validation function to filter out invalid geometries
-    data_farms['geometry'] = data_farms['geom'].apply(safe_load_wkt)
-    data_farms = data_farms[data_farms['geometry'].notnull()].copy()
-
-    # Convert to GeoDataFrame and project to UTM to allow area calculation
-    data_farms = gpd.GeoDataFrame(data_farms, geometry='geometry', crs='EPSG:4326').to_crs(epsg=32736) 
-
-    # Calculate farm areas
-    data_farms['area'] = data_farms.area / 100
-    
-    # Calculate centroids for farms
-    data_farms['geometry'] = data_farms.geometry.centroid 
-    data_farms.to_crs(epsg=4326, inplace=True)
-    data_farms = data_farms.drop('geom', axis=1)
-    
-    # Convert columns to numeric
-    data_cws['actual_capacity'] = pd.to_numeric(data_cws['actual_capacity'])
-    
-    return data_cws, data_farmers, data_farms
-
-# load geometry data
-def load_geo_data(path):
-    country = gpd.read_file(f"{path}/RW_country.gpkg", layer="country")
-    lakes = gpd.read_file(f"{path}/RW_lakes.gpkg", layer="lakes")
-    parks = gpd.read_file(f"{path}/RW_national_parks.gpkg", layer="np")
-    districts = gpd.read_file(f"{path}/RW_districts.gpkg", layer="districts")
-    districts['district'] = districts['district'].str.lower() # Convert district names to lowercase   
-    return country, lakes, parks, districts
+from coffee_core.instrumentation import instrument, diagnostics_panel, register_diagnostics, with_metrics_routes
+from coffee_core.timeseries import month_of, month_label, percent, describe_change
+from coffee_core.demographics import YOUTH_AGE
+from coffee_core.catchment import supply_base_lines
+from coffee_core.capacity import UTILIZATION_CLASSES
+from coffee_core.export import EXPORT_FORMATS, export_chunks, export_filename, export_media_type, file_stem, stream
+from coffee_core.reports import REPORT_FORMATS, ReportJobs, report_snapshot
+from coffee_core import reports
+from coffee_core.engine import ALL, GEO_LAYERS, TREE_AGE_RANGES, build_store
+from coffee_core import engine
+from coffee_core.offload import offload, offloaded_calc
+from coffee_core.api import with_api_routes
+from coffee_core.debounce import CLICK_DEBOUNCE_SECS, debounce
+from coffee_core import packed, viewport
+
+# Process-wide data tables, reloaded in the background when their files change
+#-------------------------------------------------------------------------------
+current_dir = Path(__file__).parent # Get the directory of the current script
+coffee_data_path = current_dir / "data" 
+geo_data_path = current_dir / "data_wgs84"  
+
+# farms are tied to their nearest CWS (see coffee_core.catchment) and the
+# farmers to the CWS of their farms
+store = build_store(coffee_data_path, geo_data_path, catchment_cws=True)
+
+# printable reports are rendered on a process pool shared by all sessions
+report_jobs = ReportJobs()
+
+# the farm points carry their position in the farms table as a CSS class, so
+# that the page can restyle a selection of them (see highlight_selected_farms)
+def tag_farms(farms_json):
+    for feature in farms_json['features']:
+        if 'id' in feature:  # farms, not density hexagons
+            feature['properties']['style'] = {'className': f"farm-{feature['id']}"}
+    return farms_json
 
 # define app UI
 app_ui = ui.page_fluid(   
@@ -95,6 +69,17 @@ ui.tags.style(
                 margin: 0 !important;
                 padding: 0 !important;
         }
+        /* download buttons of the export card */
+        .export-buttons {
+            display: flex;
+            gap: 10px;
+        }
+        /* drill-down selects above the farms map */
+        .drilldown {
+            display: flex;
+            gap: 10px;
+            padding: 6px 10px 0 10px;
+        }
         
         /* bg of the map tabs headers */
         .nav-tabs.card-header-tabs {
@@ -234,6 +219,11 @@ ui.tags.style(
             margin-bottom: 15px !important;
             }
 
+        .card:has(div.shiny-html-output#capacity_chart) {
+            height: 350px !important;
+            margin-bottom: 15px !important;
+            }
+
         /* Style for card bodies containing charts */
         .card:has(div.shiny-html-output[id$="chart"]) .card-body {
             padding: 10px !important;
@@ -307,7 +297,8 @@ ui.tags.style(
         ui.column(12,
             ui.div(
                 ui.h2("Coffee Extension Activities Dashboard"),
-                ui.h4("A dashboard to track key extension-related KPIs for Rwanda's coffee program")
+                ui.h4("A dashboard to track key extension-related KPIs for Rwanda's coffee program"),
+                ui.output_ui("date_range_filter")
             )
         )
     ),
@@ -320,6 +311,7 @@ ui.tags.style(
                     ui.div(
                         ui.output_text("nbr_farmers"),
                         ui.span("registered coffee farmers", class_="metric-label"),
+                        ui.output_ui("nbr_farmers_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -329,7 +321,7 @@ ui.tags.style(
                     ui.div(
                         ui.output_text("nbr_farmers_women"),
                         ui.span("of total farmers are women", class_="metric-label"),
-                        #ui.div("↑ 2.3% from last season", class_="metric-trend positive"),
+                        ui.output_ui("nbr_farmers_women_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -338,8 +330,9 @@ ui.tags.style(
                     ui.card_header("Youth Engagement", class_="youth-header"),
                     ui.div(
                         ui.output_text("nbr_farmers_young"),
-                        ui.span("of all the farmers are young", class_="metric-label"),
-                        #ui.div("↑ 1.8% from last season", class_="metric-trend positive"),
+                        ui.span(f"of all the farmers are young (under {YOUTH_AGE})", class_="metric-label"),
+                        ui.output_ui("nbr_farmers_young_trend"),
+                        ui.output_ui("farmer_age_bands"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -365,6 +358,7 @@ ui.tags.style(
                         )
                     ),
                     ui.nav_panel("Coffee Farms View",
+                        ui.output_ui("admin_drilldown"),
                         ui.div(
                             output_widget("map_farms"),
                             class_="map-container"
@@ -379,7 +373,7 @@ ui.tags.style(
                     ui.div(
                         ui.output_text("farm_area"),
                         ui.span("Hectares", class_="metric-label"),
-                        #ui.div("↑ 3.2% from last season", class_="metric-trend positive"),
+                        ui.output_ui("farm_area_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -391,10 +385,65 @@ ui.tags.style(
                 ui.card(
                     ui.card_header("# Farmers per training touchpoints", class_="hh-header"),
                     output_widget("touch_points_chart", height="260px")
+                ),
+                ui.card(
+                    ui.card_header("CWS capacity and expected cherry per district", class_="area-header"),
+                    output_widget("capacity_chart", height="260px")
+                ),
+                ui.card(
+                    ui.card_header("Export the current selection", class_="farmers-header"),
+                    ui.input_select("export_format", None,
+                                    {fmt: label for fmt, (label, _, _) in EXPORT_FORMATS.items()}),
+                    ui.div(
+                        ui.download_button("export_farms", "Farms"),
+                        ui.download_button("export_farmers", "Farmers"),
+                        class_="export-buttons"
+                    )
+                ),
+                ui.card(
+                    ui.card_header("Printable report", class_="youth-header"),
+                    ui.div(
+                        ui.input_select("report_format", None,
+                                        {fmt: label for fmt, (label, _) in REPORT_FORMATS.items()}),
+                        ui.input_action_button("generate_report", "Generate"),
+                        class_="export-buttons"
+                    ),
+                    ui.output_ui("report_status")
                 )
             )
         )
     ),
+    # hidden diagnostics panel (only present when instrumentation is enabled)
+    diagnostics_panel(),
+    # Style the selected farms on the farms map, from the bitmask of their
+    # positions sent as 'selected_farms'
+    ui.tags.script(packed.UNPACK_JS + """
+        var selectedFarms = null;
+        Shiny.addCustomMessageHandler('selected_farms', function(message) {
+            selectedFarms = message.mask;
+            var sheet = document.getElementById('selected-farms-style');
+            if (!sheet) {
+                sheet = document.head.appendChild(document.createElement('style'));
+                sheet.id = 'selected-farms-style';
+            }
+            if (!message.mask) {
+                sheet.textContent = '';
+                return;
+            }
+            unpackMask(message.mask).then(function(selected) {
+                if (selectedFarms !== message.mask) {
+                    return;  // a newer selection arrived meanwhile
+                }
+                var farms = [];
+                for (var i = 0; i < message.farms; i++) {
+                    if (selected(i)) {
+                        farms.push('path.farm-' + i);
+                    }
+                }
+                sheet.textContent = farms.join(',') + ' {fill: #b8b242; fill-opacity: 0.6; stroke: yellow;}';
+            });
+        });
+    """),
     # Remove spinners when the content is fully loaded
     ui.tags.script("""
         $(document).on('shiny:outputinvalidated', function(event) {
@@ -412,108 +461,268 @@ ui.tags.style(
 )
 
 def server(input, output, session):
-    # Load data
-    current_dir = Path(__file__).parent # Get the directory of the current script
-    coffee_data_path = current_dir / "data" 
-    geo_data_path = current_dir / "data_wgs84"  
-    country, lakes, parks, districts = load_geo_data(geo_data_path)
-    data_cws, data_farmers, data_farms = load_data(coffee_data_path)
+    # Data tables, shared by all sessions and refreshed when their files change
+    store.start()
+    data_cws, data_farms = store.reactive_table('cws'), store.reactive_table('farms')
+    country, lakes, parks, districts = (store.reactive_table(name) for name in GEO_LAYERS)
+    register_diagnostics(input, output, session)
     
     #------------------------------------------------------------------
-    # for demo purposes, let's assign CWS IDs from the cws dataset to the farmers
-    import random
-    cws_ids = data_cws['cws_id'].unique()
-    data_farmers['farmer_cws'] = random.choices(cws_ids, k=len(data_farmers))
-    data_farms['cws_id'] = random.choices(cws_ids, k=len(data_farms))
+    # farmers at the CWS of their farms (see coffee_core.engine.build_store)
+    data_farmers = store.reactive_table('farmers_by_catchment')
+    catchments = store.reactive_table('catchments')
+    cws_service_areas = store.reactive_table('cws_service_areas')
+    cws_capacity = store.reactive_table('cws_capacity')
+    district_locator = store.reactive_table('district_locator')
+    cws_locator = store.reactive_table('cws_locator')
+    admin = store.reactive_table('admin')
+    report_layers = store.reactive_table('report_map_layers')
     #-----------------------------------------------------------------------------------
 
-    # Display country statistics
+    # Monthly KPI totals and the registration period filter
+    kpis = store.reactive_table('kpis')
+
+    @output
+    @render.ui
+    @instrument()
+    def date_range_filter():
+        first, last = kpis().date_span()
+        if first is None:
+            return None
+        return ui.input_date_range("date_range", "Farms registered between", start=first, end=last,
+                                   min=first, max=last, format="M yyyy", startview="year")
+
+    # (start, end) months of the filter, open ended until it is set
+    @reactive.Calc
+    @instrument()
+    def selected_months():
+        if not input.date_range.is_set():
+            return None, None
+        start, end = input.date_range()
+        return (month_of(start) if start else None, month_of(end) if end else None)
+
+    # demographics of the farmers of the selected district/sector/cell or CWS
+    # (all farmers otherwise)
+    @reactive.Calc
+    @instrument()
+    def farmer_totals():
+        return engine.farmer_totals(current_selection(), selected_months(), kpis(),
+                                    data_farmers(), data_farms(), admin())
+
+    # change of `value(totals)` over the last month of the period, as a trend line
+    def trend_ui(value, totals, previous, month, points=False):
+        if previous is None:
+            return None
+        trend = describe_change(value(totals), value(previous), month, points)
+        if trend is None:
+            return None
+        text, direction = trend
+        return ui.div(text, class_=f"metric-trend {direction}")
+
+    def women_share(totals):
+        return percent(totals['women'], totals['farmers'])
+
+    def young_share(totals):
+        return percent(totals['young'], totals['farmers'])
+
     @output
     @render.text
+    @instrument()
     def nbr_farmers():
-        return f"{len(data_farmers):,}"
+        totals, _, _ = farmer_totals()
+        return f"{int(totals['farmers']):,}"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_trend():
+        return trend_ui(lambda totals: totals['farmers'], *farmer_totals())
     
     @output
     @render.text
+    @instrument()
     def nbr_farmers_women():
-        women = len(data_farmers[data_farmers['gender'] == 'female'])
-        return f"{(women / len(data_farmers)) * 100:.1f}%"
+        totals, _, _ = farmer_totals()
+        return f"{women_share(totals):.1f}%"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_women_trend():
+        return trend_ui(women_share, *farmer_totals(), points=True)
     
     @output
     @render.text
+    @instrument()
     def nbr_farmers_young():
-        young = len(data_farmers[data_farmers['age'].astype(int) < 35])
-        return f"{(young / len(data_farmers)) * 100:.1f}%"
+        totals, _, _ = farmer_totals()
+        return f"{young_share(totals):.1f}%"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_young_trend():
+        return trend_ui(young_share, *farmer_totals(), points=True)
+
+    @output
+    @render.ui
+    @instrument()
+    def farmer_age_bands():
+        totals, _, _ = farmer_totals()
+        shares = kpis().demographics.band_shares(totals)
+        return ui.div(" · ".join(f"{band}: {share:.0f}%" for band, share in shares), class_="metric-label")
     
     @output
     @render.text
+    @instrument()
     def youth_in_hh():
-        return f"{data_farmers['young_in_hh'].dropna().astype(int).sum():,}" 
+        totals, _, _ = farmer_totals()
+        return f"{int(totals['youth_in_hh']):,}" 
 
     # Initialize reactive values
-    clicked_spot = reactive.Value(None)
+    pending_click = reactive.Value(None)  # clicks land here, see map_state
     cws_map_widget = reactive.Value(None)
     farms_map_widget = reactive.Value(None)
     selected_district_layer = reactive.Value(None)
-    selected_farms_layer = reactive.Value(None)
+    selected_unit_layer = reactive.Value(None)
     selected_cws_layer = reactive.Value(None)
+    farms_view_layers = reactive.Value(None)
+    map_view = reactive.Value(None)
+
+    # the tab in focus and the clicked spot, updated together once clicks and
+    # tab switches have settled for CLICK_DEBOUNCE_SECS: a burst of clicks
+    # recomputes the selection once, for the last click only
+    @debounce(CLICK_DEBOUNCE_SECS)
+    @instrument()
+    def map_state():
+        return input.map_tabs(), pending_click.get()
+
+    @reactive.Calc
+    @instrument()
+    def active_tab():
+        return map_state()[0]
+
+    @reactive.Calc
+    @instrument()
+    def clicked_spot():
+        return map_state()[1]
 
     # Calculate reactive variables used for interactivity
     #------------------------------------------------
     #1. get the clicked district
     @reactive.Calc
+    @instrument()
     def selected_district():
-        pt = clicked_spot.get()
+        pt = clicked_spot()
         if pt is not None:
-            current_district = gpd.sjoin(districts, pt, how="inner", predicate="intersects")
-            return current_district
+            return engine.locate_district(district_locator(), pt.geometry.iloc[0].y, pt.geometry.iloc[0].x)
         return None
 
-    #2. get the farms in the selected district
+    # (level, unit positions) from the clicked district down to the sector
+    # and cell picked within it in the drill-down
     @reactive.Calc
-    def selected_farms():
+    @instrument()
+    def drill_path():
         cur_district = selected_district()
-        if cur_district is not None:
-            distr_farms = gpd.sjoin(data_farms, cur_district.loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-            return distr_farms
+        if cur_district is None:
+            return None
+        hierarchy = admin()
+        path = [('district', hierarchy.positions('district', cur_district['district']))]
+        child = hierarchy.child_level('district')
+        while child is not None and input[f"drill_{child}"].is_set():
+            picked = input[f"drill_{child}"]()
+            # a pick left over from another district does not apply
+            if not picked or int(picked) not in hierarchy.children(*path[-1]):
+                break
+            path.append((child, [int(picked)]))
+            child = hierarchy.child_level(child)
+        return path
+
+    # the unit drilled into, (level, unit positions)
+    @reactive.Calc
+    @instrument()
+    def selected_unit():
+        path = drill_path()
+        return path[-1] if path is not None else None
+
+    # drill-down selects for the sectors and cells of the clicked district
+    # (only when their boundaries are available), labelled with their rollups
+    @output
+    @render.ui
+    @instrument()
+    def admin_drilldown():
+        hierarchy = admin()
+        path = drill_path()
+        if len(hierarchy.levels) < 2 or path is None or not len(path[0][1]):
+            return None
+        selects = []
+        for i, (level, units) in enumerate(path):
+            child = hierarchy.child_level(level)
+            if child is None:
+                break
+            rollup = hierarchy.rollup(child, hierarchy.children(level, units))
+            choices = {"": f"All {child}s"}
+            for pos, row in rollup.iterrows():
+                choices[str(pos)] = f"{row[child].title()} ({row['farms']:,.0f} farms, {row['area']:,.1f} ha)"
+            picked = str(path[i + 1][1][0]) if i + 1 < len(path) else ""
+            selects.append(ui.input_select(f"drill_{child}", child.title(), choices, selected=picked))
+        return ui.div(*selects, class_="drilldown")
+
+    #2. get the farms in the selected district (or sector/cell), on the executor
+    @offloaded_calc
+    @instrument()
+    def selected_farms():
+        cur_unit = selected_unit()
+        if cur_unit is not None:
+            level, units = cur_unit
+            hierarchy = admin()
+            return lambda: engine.unit_farms(hierarchy, level, units)
         return None
     
-    #3. Get the nearest CWS to the clicked spot on the CWS map
+    #3. Get the nearest CWS to the clicked spot on the CWS map (an index lookup)
     @reactive.Calc
+    @instrument()
     def selected_cws():
-        pt = clicked_spot.get()
+        pt = clicked_spot()
         if pt is None:
             return None
-            
-        # Convert the point to its coordinates
-        # Assuming pt is a GeoDataFrame with a single point
-        point_coords = (pt.geometry.iloc[0].y, pt.geometry.iloc[0].x)
-        
-        # Calculate distances from clicked point to all CWS locations
-        distances = data_cws.geometry.apply(
-            lambda x: geodesic(
-                point_coords,
-                (x.y, x.x)
-            ).meters
-        )
-        
-        # Get the index of the minimum distance
-        nearest_idx = distances.idxmin()
-        
-        # Return the nearest CWS
-        return data_cws.iloc[[nearest_idx]]
+        return engine.nearest_cws(cws_locator(), pt.geometry.iloc[0].y, pt.geometry.iloc[0].x)
     
+    # farmers of the selected CWS and their farms
+    @reactive.Calc
+    @instrument()
+    def selected_cws_members():
+        cur_cws = selected_cws()
+        if cur_cws is None:
+            return None
+        return engine.cws_members(data_farmers(), data_farms(), str(cur_cws['cws_id'].values[0]))
+
+    # what the cards and charts are about: the unit drilled into on the farms
+    # map, the station picked on the CWS map, or ALL (see coffee_core.engine)
+    @reactive.Calc
+    @instrument()
+    def current_selection():
+        current_tab = active_tab() # check which map is currently in focus
+        if current_tab == "Coffee Farms View" and selected_unit() is not None:
+            level, units = selected_unit()
+            return (level, tuple(units))
+        elif current_tab == "CWS View" and selected_cws() is not None:
+            return ('cws', str(selected_cws()['cws_id'].values[0]))
+        return ALL
+
     # Add a reactive effect to reset selected_cws and selected-district to Null 
     # This will trigger whenever the map tab changes
     @reactive.Effect
+    @instrument()
     def _reset_on_tab_change():
         input.map_tabs()
-        clicked_spot.set(None)
+        pending_click.set(None)
 
     # Display the CWS map
     @output
     @render_widget
-    def map_farms():
+    @instrument()
+    async def map_farms():
         # Define the map
         m = Map(center=(-1.9403, 29.8739), zoom=8, scroll_wheel_zoom=True)
 
@@ -525,7 +734,7 @@ def server(input, output, session):
             'fillOpacity': 0.2
         }
         country_layer = GeoData(
-            geo_dataframe=country, 
+            geo_dataframe=country(), 
             style=country_style,
             name='Country boundary'
         )
@@ -537,7 +746,7 @@ def server(input, output, session):
             'fillOpacity': 0.6
         }
         parks_layer = GeoData(
-            geo_dataframe=parks, 
+            geo_dataframe=parks(), 
             style=parks_style,
             name='National parks'
         )
@@ -549,7 +758,7 @@ def server(input, output, session):
             'fillOpacity': 0.6
         }
         lakes_layer = GeoData(
-            geo_dataframe=lakes,
+            geo_dataframe=lakes(),
             style=lakes_style,
             name='Lakes'
         )
@@ -561,43 +770,62 @@ def server(input, output, session):
             }
         
         districts_layer = GeoData(
-            geo_dataframe=districts,
+            geo_dataframe=districts(),
             style=districts_style,
             hover_style={'fillColor': '#bcb32e' , 'fillOpacity': 0.9},
             name='District boundaries'
         )
 
-        # Convert farms geodataframe to GeoJSON format
-        farms_json = data_farms.__geo_interface__
-
         farms_style = {
             'fillColor': '#171c1a',
             'fillOpacity': 0.6,
             'radius': 6,  # Fixed radius instead of depending on zoom level
             'color': '#6d7471',
         }
-        farms_layer = GeoJSON(
-            data=farms_json, 
-            point_style=farms_style,
-            hover_style={'fillOpacity': 0.9},
-            marker_type='circle', 
-            name='Coffee farms'
-        )
 
-        # Add clusters of farms
-        markers = []
-        for feature in farms_json['features']:
-            coords = feature['geometry']['coordinates']  # of each farm centroid
-            lat_lon = (coords[1], coords[0]) # Convert the coords to (lat, lon)
-            marker = Marker(location=lat_lon) # Create a Marker for each farm
-            markers.append(marker)
+        if viewport.ENABLED:
+            # Start empty: the farms in view are sent once the map reports its bounds
+            farms_layer = GeoJSON(
+                data=viewport.EMPTY, 
+                point_style=farms_style,
+                hover_style={'fillOpacity': 0.9},
+                marker_type='circle', 
+                name='Coffee farms'
+            )
+            farms_hint = HTML()
+            m.add_control(WidgetControl(widget=farms_hint, position='bottomright'))
+            farms_view_layers.set((farms_layer, farms_hint))
+
+            def on_view_change(change):
+                map_view.set((m.bounds, m.zoom))
+            m.observe(on_view_change, names=['bounds', 'zoom'])
+        else:
+            # Convert farms geodataframe to GeoJSON format
+            farms = data_farms()
+            farms_json = await offload(lambda: tag_farms(farms.reset_index(drop=True).__geo_interface__))
 
-        # Create a MarkerCluster and add the markers
-        marker_cluster = MarkerCluster(markers=markers)
-        marker_cluster.name = "Farm clusters"
+            farms_layer = GeoJSON(
+                data=farms_json, 
+                point_style=farms_style,
+                hover_style={'fillOpacity': 0.9},
+                marker_type='circle', 
+                name='Coffee farms'
+            )
+
+            # Add clusters of farms
+            markers = []
+            for feature in farms_json['features']:
+                coords = feature['geometry']['coordinates']  # of each farm centroid
+                lat_lon = (coords[1], coords[0]) # Convert the coords to (lat, lon)
+                marker = Marker(location=lat_lon) # Create a Marker for each farm
+                markers.append(marker)
 
-        # Add the MarkerCluster to the map
-        m.add_layer(marker_cluster)
+            # Create a MarkerCluster and add the markers
+            marker_cluster = MarkerCluster(markers=markers)
+            marker_cluster.name = "Farm clusters"
+
+            # Add the MarkerCluster to the map
+            m.add_layer(marker_cluster)
                 
         # Add the districts layer to the map
         m.add_layer(country_layer)
@@ -625,7 +853,7 @@ def server(input, output, session):
                 )
                 
                 # Update the clicked spot
-                clicked_spot.set(point)
+                pending_click.set(point)
 
         # Attach the click handler to the map
         m.on_interaction(handle_click)
@@ -635,9 +863,35 @@ def server(input, output, session):
 
         return m
 
+    # Lazy farms mode: send only the farms inside the current viewport, or their
+    # density hexagons when zoomed out
+    if viewport.ENABLED:
+        farms_viewport_index = store.reactive_table('farms_view_index')
+        farm_hexbins = store.reactive_table('farm_hexbins')
+
+        @debounce(viewport.DEBOUNCE_SECS)
+        @instrument()
+        def farms_viewport():
+            return map_view.get()
+
+        @reactive.Effect
+        @reactive.event(farms_viewport, farms_viewport_index, farm_hexbins)
+        @instrument("update_farms_in_view")
+        def _():
+            layers = farms_view_layers.get()
+            view = farms_viewport()
+            if layers is None or view is None:
+                return
+            farms_layer, farms_hint = layers
+            bounds, zoom = view
+            farms, farms_hint.value = viewport.farms_in_view(
+                farms_viewport_index(), bounds, zoom, farm_hexbins())
+            farms_layer.data = tag_farms(farms)
+
     # add the selected district to the map
     @reactive.Effect
     @reactive.event(selected_district)
+    @instrument("highlight_selected_district")
     def _():
         m = farms_map_widget.get()
         cur_district = selected_district()
@@ -676,54 +930,56 @@ def server(input, output, session):
             # Store the new layer reference
             selected_district_layer.set(new_layer)
 
-    # highlight farms in the selected district
+    # add the sector/cell drilled into to the map
     @reactive.Effect
-    @reactive.event(selected_farms)
+    @reactive.event(selected_unit)
+    @instrument("highlight_selected_unit")
     def _():
         m = farms_map_widget.get()
-        cur_farms = selected_farms()
-        
+        cur_unit = selected_unit()
+
         if m is None:
             return
-            
-        # Remove previous selected farms layer if it exists
-        old_layer = selected_farms_layer.get()
+
+        old_layer = selected_unit_layer.get()
         if old_layer is not None:
             try:
                 m.remove_layer(old_layer)
             except Exception:
-                pass 
-        
-        # Clear the old layer reference
-        selected_farms_layer.set(None)
-        
-        if cur_farms is not None and not cur_farms.empty:
-            # Create a new GeoJSON layer for the selected farms
-            selected_farms_style = {
-                'fillColor': '#b8b242',
-                'fillOpacity': 0.6,
-                'radius': 3,  
-                'color': 'yellow'
-            }
-
-            # Convert the selected district to GeoJSON
-            selected_farms_json = cur_farms.__geo_interface__
+                pass
+        selected_unit_layer.set(None)
 
-            # Create and add the new layer
-            new_layer = GeoJSON(
-                data=selected_farms_json, 
-                point_style=selected_farms_style,
-                hover_style={'fillOpacity': 0.9},
-                name='Selected farms'  
+        if cur_unit is not None and cur_unit[0] != 'district':
+            level, units = cur_unit
+            new_layer = GeoData(
+                geo_dataframe=admin().units(level, units),
+                style={'color': 'red', 'fillColor': 'orange', 'opacity': 0.8, 'weight': 2},
+                name=f'Selected {level.title()}'
             )
             m.add_layer(new_layer)
-            
-            # Store the new layer reference
-            selected_farms_layer.set(new_layer)
+            selected_unit_layer.set(new_layer)
+
+    # highlight the farms in the selected district (or sector/cell): the farms
+    # already on the map are restyled by the page, from a bitmask of their
+    # positions
+    @reactive.Effect
+    @reactive.event(selected_unit, ignore_none=False)
+    @instrument("highlight_selected_farms")
+    async def _():
+        cur_unit = selected_unit()
+        hierarchy = admin()
+        mask = None
+        if cur_unit is not None:
+            level, units = cur_unit
+            selected = hierarchy.farm_positions(level, units)
+            if len(selected):
+                mask = packed.pack_mask(selected, len(hierarchy.farms))
+        await session.send_custom_message("selected_farms", {"mask": mask, "farms": len(hierarchy.farms)})
 
     # Display the farms on the map
     @output
     @render_widget
+    @instrument()
     def map_cws():        
         # Define the map with bounds instead of center/zoom
         m = Map(center=(-1.9403, 29.8739), zoom=8, scroll_wheel_zoom=True, close_popup_on_click=True)
@@ -736,7 +992,7 @@ def server(input, output, session):
             'fillOpacity': 0.2
         }
         country_layer = GeoData(
-            geo_dataframe =country,
+            geo_dataframe =country(),
             style=country_style,
             name='Country boundary'
         )
@@ -748,7 +1004,7 @@ def server(input, output, session):
             'fillOpacity': 0.6
         }
         parks_layer = GeoData(
-            geo_dataframe=parks,
+            geo_dataframe=parks(),
             style=parks_style,
             name='National parks'
         )
@@ -760,7 +1016,7 @@ def server(input, output, session):
             'fillOpacity': 0.6
         }
         lakes_layer = GeoData(
-            geo_dataframe=lakes,
+            geo_dataframe=lakes(),
             style=lakes_style,
             name='Lakes'
         )
@@ -772,14 +1028,29 @@ def server(input, output, session):
                 'fillOpacity': 0.2
             } 
         districts_layer = GeoData(
-            geo_dataframe=districts,
+            geo_dataframe=districts(),
             style=districts_style,
             hover_style={'fillColor': '#bcb32e' , 'fillOpacity': 0.2},
             name='District boundaries'
         )
 
+        # the land closest to each station, to spot coverage gaps
+        service_areas_style = {
+                'fillColor': '#bcb32e',
+                'color': '#7a7420',
+                'weight': 1,
+                'dashArray': '4',
+                'fillOpacity': 0.1
+            }
+        service_areas_layer = GeoData(
+            geo_dataframe=cws_service_areas(),
+            style=service_areas_style,
+            hover_style={'fillOpacity': 0.3},
+            name='CWS service areas'
+        )
+
         # Convert CWS data to GeoJSON for display
-        cws_json = data_cws.__geo_interface__
+        cws_json = data_cws().__geo_interface__
         
         # define a function to add CWS markers with tooltips
         def add_cws_markers(map_obj, data_json):
@@ -929,12 +1200,24 @@ def server(input, output, session):
         # # The the labels to the map as a layer
         # add_distr_labels(m, districts)
 
+
+        # rings colored by how much of its processing capacity each station used
+        utilization_layer = GeoJSON(
+            data=cws_capacity().layer,
+            point_style={'radius': 11, 'fill': False, 'weight': 3},
+            style_callback=lambda feature: {'color': feature['properties']['color']},
+            name='CWS capacity utilization'
+        )
+        utilization_legend = LegendControl({label: color for _, label, color in UTILIZATION_CLASSES},
+                                           title="Capacity used", position="bottomright")
        
         # Add layers to the map
         m.add_layer(country_layer)
         m.add_layer(lakes_layer)
         m.add_layer(parks_layer)
         m.add_layer(districts_layer)
+        m.add_layer(service_areas_layer)
+        m.add_layer(utilization_layer)
               
         # Add CWS markers and districts labels
         add_cws_markers(m, cws_json)
@@ -945,6 +1228,7 @@ def server(input, output, session):
         
         scale = ScaleControl(position='bottomleft')
         m.add_control(scale)
+        m.add_control(utilization_legend)
         
         def handle_click(**kwargs):
             if kwargs.get("type") == "click":
@@ -953,7 +1237,7 @@ def server(input, output, session):
                     [{"geometry": Point(lng, lat)}],
                     crs="EPSG:4326"
                 )
-                clicked_spot.set(point)
+                pending_click.set(point)
 
         m.on_interaction(handle_click)
         cws_map_widget.set(m)
@@ -963,6 +1247,7 @@ def server(input, output, session):
     # highlight the nearest CWS to the clicked spot
     @reactive.Effect
     @reactive.event(selected_cws)
+    @instrument("highlight_selected_cws")
     def _():
         m = cws_map_widget.get()
         cur_cws = selected_cws()
@@ -994,12 +1279,29 @@ def server(input, output, session):
             selected_cws_json = cur_cws.__geo_interface__
 
             # Create and add the selected CWS layer
-            new_layer = GeoJSON(
+            cws_layer = GeoJSON(
                 data=selected_cws_json, 
                 point_style=selected_cws_style,
                 hover_style={'fillOpacity': 0.9},
                 name='Selected CWS'  
             )
+            new_layer = LayerGroup(layers=(cws_layer,), name='Selected CWS')
+
+            # open a popup with the station's supply base
+            cur_station = cur_cws.iloc[0]
+            base = catchments().supply_base(cur_station['cws_id'])
+            if base is not None:
+                popup_html = f"<div><b>Name:</b> {cur_station['cws_name']}</div>"
+                popup_html += "".join(f"<div><b>{label}:</b> {text}</div>" for label, text in supply_base_lines(base))
+                popup_html += "".join(f"<div><b>{label}:</b> {text}</div>"
+                                      for label, text in cws_capacity().station_lines(cur_station['cws_id']))
+                new_layer.add_layer(Popup(
+                    location=(cur_station.geometry.y, cur_station.geometry.x),
+                    child=HTML(value=f"<div style='font-family: Arial, sans-serif; padding: 3px; margin: 0; line-height: 1.2;'>{popup_html}</div>"),
+                    close_button=True,
+                    auto_close=True,
+                    close_on_escape_key=True
+                ))
             m.add_layer(new_layer)
             
             # Store the new layer reference
@@ -1008,56 +1310,41 @@ def server(input, output, session):
     # Calculate and reactive variables and update related charts
     #==========================================================
     #1. Farm area info card
+    # area totals of the farms in the selected district or CWS (all farms otherwise)
+    @reactive.Calc
+    @instrument()
+    def farm_totals():
+        return engine.farm_totals(current_selection(), selected_months(), kpis(), admin())
+
     @output
     @render.text
+    @instrument()
     def farm_area():
-        current_tab = input.map_tabs()
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Perform spatial join if a district is selected
-                filtered_farms = gpd.sjoin(data_farms, selected_district().loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-                total_area = filtered_farms['area'].sum()
-            else:
-                total_area = data_farms['area'].sum()
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_cws = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-                unique_national_ids = data_farmers_cws['national_id'].unique().tolist()
-                filtered_farms = data_farms[data_farms['national_id'].isin(unique_national_ids)]
-                total_area = filtered_farms['area'].sum()
-            else:
-                total_area = data_farms['area'].sum()
-        else:
-            total_area = data_farms['area'].sum()
+        totals, _, _ = farm_totals()
+        return f"{totals['area']:,.1f}" 
 
-        return f"{total_area:,.1f}" 
+    @output
+    @render.ui
+    @instrument()
+    def farm_area_trend():
+        return trend_ui(lambda totals: totals['area'], *farm_totals())
 
     # #2. Coffee trees chart
     @output
     @render_widget
-    def coffee_trees_chart():
-        # filter farms data based on the active tab and/or selected district-selected CWS
-        current_tab = input.map_tabs()
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Perform spatial join if a district is selected
-                data_farms_filtered = gpd.sjoin(data_farms, selected_district().loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-            else:
-                data_farms_filtered = data_farms
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_cws = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-                unique_national_ids = data_farmers_cws['national_id'].unique().tolist()
-                data_farms_filtered = data_farms[data_farms['national_id'].isin(unique_national_ids)]
-            else:
-                data_farms_filtered = data_farms
+    @instrument()
+    async def coffee_trees_chart():
+        # the farms of the selected district/sector/cell or CWS (all farms otherwise)
+        selection = current_selection()
+        if selection == ALL:
+            data_farms_filtered = data_farms()
+        elif selection[0] == 'cws':
+            _, data_farms_filtered = selected_cws_members()
         else:
-            data_farms_filtered = data_farms
+            data_farms_filtered = selected_farms()
 
-        # Prepare the data for ploting
-        data = data_farms_filtered.groupby('age_range_coffee_trees')['nbr_coffee_trees'].sum().reset_index()
+        # Prepare the data for ploting (once per selection)
+        data = await offload(engine.coffee_trees_data, selection, data_farms_filtered)
         
         # Create the plot using plotly
         fig = go.Figure()
@@ -1076,7 +1363,7 @@ def server(input, output, session):
         fig.update_layout(
             xaxis = dict(
                 categoryorder='array',
-                categoryarray=["less_3", "3_to_7", "8_to_15", "16_to_30", "more_30"]
+                categoryarray=TREE_AGE_RANGES
             ),
             height=250,
             margin=dict(l=10, r=10, t=30, b=10),
@@ -1090,36 +1377,15 @@ def server(input, output, session):
     # 3. training chart  
     @output
     @render_widget 
-    def touch_points_chart():
-        # filter farmers data based on the active tab and/or selected district-selected CWS
-        current_tab = input.map_tabs()
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Select the farmers in the selected district
-                cur_district = str(selected_district()['district'].values[0])
-                data_farmers_filtered = data_farmers[data_farmers['district'] == cur_district]
-            else:
-                data_farmers_filtered = data_farmers
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_filtered = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-            else:
-                data_farmers_filtered = data_farmers
-        else:
-            data_farmers_filtered = data_farmers
-
-        # Prepare the training data
-        training_data = (
-            data_farmers_filtered['training_topics']
-            .str.split(' ')
-            .explode()
-            .value_counts()
-            .reset_index()
-        )
-        # Rename columns for clarity
-        training_data.columns = ['topic', 'count'] 
-        data = training_data.sort_values('count', ascending=False)
+    @instrument()
+    async def touch_points_chart():
+        # the farmers of the selection on the active tab (see current_selection)
+        selection = current_selection()
+        farmers, farms, hierarchy = data_farmers(), data_farms(), admin()
+        select_farmers = lambda: engine.selection_farmers(selection, farmers, farms, hierarchy)
+
+        # Prepare the training data (once per selection)
+        data = await offload(lambda: engine.training_topics_data(selection, select_farmers()))
        
         # Create the plotly plot
         fig = go.Figure()
@@ -1147,5 +1413,129 @@ def server(input, output, session):
 
         return fig
 
+    # 4. capacity of the stations against the cherry expected from the farms,
+    # per district; it only changes with the data, not with the selection
+    @output
+    @render_widget
+    @instrument()
+    def capacity_chart():
+        data = cws_capacity().districts.sort_values('processing_capacity', ascending=False)
+        fig = go.Figure()
+        for column, name, color in [('processing_capacity', 'Processing capacity', 'rgba(44, 62, 80, 0.6)'),
+                                    ('actual_capacity', 'Processed', 'rgba(50, 171, 96, 0.6)'),
+                                    ('expected_cherry_t', 'Expected cherry', 'rgba(188, 179, 46, 0.6)')]:
+            fig.add_trace(go.Bar(x=data.index, y=data[column], name=name, marker=dict(color=color)))
+
+        fig.update_layout(
+            barmode='group',
+            yaxis=dict(tickformat=',', title='Tonnes'),
+            xaxis=dict(tickangle=45),
+            legend=dict(orientation='h', y=1.1),
+            height=250,
+            margin=dict(l=10, r=10, t=30, b=10),
+            autosize=True,
+            paper_bgcolor='rgba(0,0,0,0)',
+            plot_bgcolor='rgba(0,0,0,0)'
+        )
+
+        return fig
+
+    # 5. Export of the current selection
+    # farms and farmers of the selected district/sector/cell or CWS (all of
+    # them otherwise), with the name of the selection for the file names
+    @reactive.Calc
+    @instrument()
+    def selection_tables():
+        current_tab = active_tab()
+        if current_tab == "Coffee Farms View" and selected_unit() is not None and len(selected_unit()[1]):
+            level, units = selected_unit()
+            farmers = engine.selection_farmers(current_selection(), data_farmers(), data_farms(), admin())
+            return "_".join(admin().units(level, units)[level]), selected_farms(), farmers
+        elif current_tab == "CWS View" and selected_cws() is not None:
+            cur_cws = str(selected_cws()['cws_id'].values[0])
+            farmers, farms = selected_cws_members()
+            return cur_cws, farms, farmers
+        return "all", data_farms(), data_farmers()
+
+    # the files are encoded chunk by chunk on a worker thread while they download
+    @render.download(filename=lambda: export_filename("farms", selection_tables()[0], input.export_format()),
+                     media_type=lambda: export_media_type(input.export_format()))
+    @instrument()
+    async def export_farms():
+        _, farms, _ = selection_tables()
+        async for chunk in stream(export_chunks(farms, input.export_format())):
+            yield chunk
+
+    @render.download(filename=lambda: export_filename("farmers", selection_tables()[0], input.export_format()),
+                     media_type=lambda: export_media_type(input.export_format()))
+    @instrument()
+    async def export_farmers():
+        _, _, farmers = selection_tables()
+        async for chunk in stream(export_chunks(farmers, input.export_format())):
+            yield chunk
+
+    # 6. Printable report of the selection, rendered on the worker pool
+    report_job = reactive.Value(None)
+
+    # the cards as they are shown, as (label, value)
+    def report_cards():
+        totals, _, _ = farmer_totals()
+        area, _, _ = farm_totals()
+        return [
+            ("Total farmers", f"{totals['farmers']:,.0f}"),
+            ("Women participation", f"{women_share(totals):.1f}%"),
+            ("Youth engagement", f"{young_share(totals):.1f}%"),
+            ("Youth in households", f"{int(totals['youth_in_hh']):,}"),
+            ("Cultivated area (ha)", f"{area['area']:,.1f}"),
+        ]
+
+    @reactive.Effect
+    @reactive.event(input.generate_report)
+    @instrument("generate_report")
+    def _():
+        name, farms, farmers = selection_tables()
+        selection = stations = None
+        if active_tab() == "Coffee Farms View" and name != "all":
+            level, units = selected_unit()
+            selection = admin().units(level, units).geometry.values
+        elif active_tab() == "CWS View" and name != "all":
+            areas = cws_service_areas()
+            selection = areas.loc[areas['cws_id'] == name].geometry.values
+            stations = selected_cws().geometry.values
+        start, end = selected_months()
+        if start is not None and end is not None:
+            period = f"Farms registered {month_label(start)} to {month_label(end)}"
+        else:
+            period = "All registration months"
+        title = "Coffee farms" + ("" if name == "all" else f": {name.replace('_', ' ').title()}")
+        snapshot = report_snapshot(title, period, report_cards(), farms, farmers, report_layers(),
+                                   selection=selection, stations=stations)
+        fmt = input.report_format()
+        report_job.set(report_jobs.submit(snapshot, fmt, f"{file_stem('report', name)}.{fmt}"))
+
+    @output
+    @render.ui
+    @instrument()
+    def report_status():
+        job_id = report_job.get()
+        if job_id is None:
+            return None
+        job = report_jobs.status(job_id)
+        if job["state"] in ("queued", "running"):
+            reactive.invalidate_later(reports.POLL_SECS)
+            return ui.div(
+                ui.div(ui.div(class_="progress-bar", style=f"width: {job['progress']:.0%}"), class_="progress"),
+                ui.span(job["message"], class_="metric-label")
+            )
+        if job["state"] == "failed":
+            return ui.div(f"The report could not be made: {job['message']}", class_="metric-trend negative")
+        return ui.download_button("download_report", f"Download {REPORT_FORMATS[job['format']][0]}")
+
+    @render.download(filename=lambda: report_jobs.status(report_job.get())["filename"],
+                     media_type=lambda: REPORT_FORMATS[report_jobs.status(report_job.get())["format"]][1])
+    @instrument()
+    def download_report():
+        return report_jobs.status(report_job.get())["path"]
+
 
-app = App(app_ui, server)
\ No newline at end of file
+app = with_metrics_routes(with_api_routes(App(app_ui, server), store, farmers='farmers_by_catchment'))
@@ -0,0 +1,448 @@
+"""Benchmark the dashboards' load, click-to-update and render stages.
+
+Generates synthetic Rwanda-bounded datasets (see `benchmarks.synthetic`) at
+each requested size, times every stage and writes the results as JSON:
+
+    python -m benchmarks.bench_dashboard --sizes 1000 10000 --output bench.json
+    python -m benchmarks.bench_dashboard --baseline bench.json --tolerance 0.25
+
+With `--baseline`, any stage whose median time grew by more than the
+tolerance is reported and the command exits with status 1.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+
+from benchmarks.synthetic import SIZES, write_dataset
+from coffee_core import engine, ingest, viewport
+from coffee_core.engine import ALL, CwsLocator, build_store, load_data, load_geo_data
+from coffee_core.timeseries import FarmKpis
+from coffee_core.capacity import CwsCapacity
+from coffee_core.catchment import Catchments, service_areas
+from coffee_core.locate import PointLocator
+from coffee_core.admin import AdminHierarchy, drilldown_levels, load_admin_layer
+from coffee_core.hexbin import FarmHexbins
+from coffee_core.rtree import FarmIndex
+
+# map builders create one widget/marker per farm, so they are capped by default
+MAX_MAP_ROWS = 100_000
+
+# later stages consume these results, so they cannot be skipped
+REQUIRED_STAGES = {"load_data", "load_geo_data", "selected_district", "selected_farms", "selected_cws",
+                   "viewport.index", "admin.build", "hexbins.build", "load_data[cached]", "farm_index.open",
+                   "engine.build_store", "engine.selected_district", "engine.selected_farms",
+                   "engine.selected_cws"}
+
+
+def timed(fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+# Baseline reference: the apps' reactive bodies from before the shared engine
+# (coffee_core.engine), which the apps now call instead (the engine.* stages)
+#-----------------------------------------------------------------------------
+def click_point(lat, lng):
+    return gpd.GeoDataFrame([{"geometry": Point(lng, lat)}], crs="EPSG:4326")
+
+
+def stage_selected_district(districts, pt):
+    return gpd.sjoin(districts, pt, how="inner", predicate="intersects")
+
+
+def stage_selected_farms(data_farms, cur_district):
+    return gpd.sjoin(data_farms, cur_district.loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
+
+
+def stage_selected_cws(data_cws, pt):
+    from geopy.distance import geodesic
+
+    point_coords = (pt.geometry.iloc[0].y, pt.geometry.iloc[0].x)
+    distances = data_cws.geometry.apply(lambda x: geodesic(point_coords, (x.y, x.x)).meters)
+    return data_cws.iloc[[distances.idxmin()]]
+
+
+def stage_farm_area_district(data_farms, cur_district):
+    filtered_farms = gpd.sjoin(data_farms, cur_district.loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
+    return filtered_farms['area'].sum()
+
+
+def stage_farm_area_cws(data_farms, data_farmers, cur_cws):
+    cur_cws = str(cur_cws['cws_id'].values[0])
+    data_farmers_cws = data_farmers[data_farmers['farmer_cws'] == cur_cws]
+    unique_national_ids = data_farmers_cws['national_id'].unique().tolist()
+    filtered_farms = data_farms[data_farms['national_id'].isin(unique_national_ids)]
+    return filtered_farms['area'].sum()
+
+
+def stage_coffee_trees_chart(data_farms_filtered):
+    import plotly.graph_objects as go
+
+    data = data_farms_filtered.groupby('age_range_coffee_trees')['nbr_coffee_trees'].sum().reset_index()
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=data['age_range_coffee_trees'], y=data['nbr_coffee_trees']))
+    fig.update_layout(
+        xaxis=dict(categoryorder='array',
+                   categoryarray=["less_3", "3_to_7", "8_to_15", "16_to_30", "more_30"]),
+        height=250,
+    )
+    return fig.to_json()
+
+
+def stage_touch_points_chart(data_farmers_filtered):
+    import plotly.graph_objects as go
+
+    training_data = (
+        data_farmers_filtered['training_topics']
+        .str.split(' ')
+        .explode()
+        .value_counts()
+        .reset_index()
+    )
+    training_data.columns = ['topic', 'count']
+    data = training_data.sort_values('count', ascending=False)
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=data['topic'], y=data['count']))
+    fig.update_layout(yaxis=dict(tickformat=','), xaxis=dict(tickangle=45), height=250)
+    return fig.to_json()
+
+
+def stage_ipyleaflet_map_farms(country, lakes, parks, districts, data_farms):
+    from ipyleaflet import Map, Marker, MarkerCluster, GeoJSON, GeoData
+
+    m = Map(center=(-1.9403, 29.8739), zoom=8, scroll_wheel_zoom=True)
+    for layer in (country, lakes, parks, districts):
+        m.add_layer(GeoData(geo_dataframe=layer))
+    farms_json = data_farms.__geo_interface__
+    m.add_layer(GeoJSON(data=farms_json, marker_type='circle'))
+    markers = []
+    for feature in farms_json['features']:
+        coords = feature['geometry']['coordinates']
+        markers.append(Marker(location=(coords[1], coords[0])))
+    m.add_layer(MarkerCluster(markers=markers))
+    return len(json.dumps(farms_json, default=str))
+
+
+def stage_ipyleaflet_map_cws(country, lakes, parks, districts, data_cws):
+    from ipyleaflet import Map, CircleMarker, MarkerCluster, GeoData
+
+    m = Map(center=(-1.9403, 29.8739), zoom=8, scroll_wheel_zoom=True)
+    for layer in (country, lakes, parks, districts):
+        m.add_layer(GeoData(geo_dataframe=layer))
+    cws_json = data_cws.__geo_interface__
+    markers = []
+    for feature in cws_json['features']:
+        coords = feature['geometry']['coordinates']
+        capacity = int(feature['properties'].get('actual_capacity', 0))
+        markers.append(CircleMarker(location=(coords[1], coords[0]),
+                                    radius=int(min(3 + capacity * 0.001, 8))))
+    m.add_layer(MarkerCluster(markers=markers, max_cluster_radius=20))
+    return len(json.dumps(cws_json, default=str))
+
+
+def stage_folium_map_farms(country, lakes, parks, districts, data_farms):
+    import folium
+    from folium.plugins import MarkerCluster
+
+    m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8)
+    for layer in (country, districts, parks, lakes):
+        folium.GeoJson(layer).add_to(m)
+    marker_cluster_farms = MarkerCluster().add_to(m)
+    for idx, row in data_farms.iterrows():
+        folium.CircleMarker(location=[row.geometry.y, row.geometry.x], radius=2).add_to(marker_cluster_farms)
+    return len(m._repr_html_())
+
+
+# the same map with its layers packed (DASHBOARD_PACKED_LAYERS=1)
+def stage_folium_map_farms_packed(country, lakes, parks, districts, data_farms):
+    import folium
+    from folium.plugins import MarkerCluster
+    from coffee_core import packed
+
+    m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8)
+    for layer in (country, districts, parks, lakes):
+        packed.PackedGeoJson(layer).add_to(m)
+    marker_cluster_farms = MarkerCluster().add_to(m)
+    packed.PackedGeoJson(data_farms[['geometry']], marker=folium.CircleMarker(radius=2),
+                         control=False).add_to(marker_cluster_farms)
+    return len(m._repr_html_())
+
+
+def stage_folium_map_cws(country, lakes, parks, districts, data_cws):
+    import folium
+
+    m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8)
+    for layer in (country, districts, parks, lakes):
+        folium.GeoJson(layer).add_to(m)
+    for idx, row in data_cws.iterrows():
+        folium.CircleMarker(location=[row.geometry.y, row.geometry.x], radius=4).add_to(m)
+    return len(m._repr_html_())
+
+
+# the store with the objects the apps' selection queries read built
+def warm_store(store):
+    for name in ('district_locator', 'cws_locator', 'admin', 'kpis'):
+        store.get(name)
+    return store
+
+
+def run_size(n_rows, data_dir, repeat, max_map_rows, skip):
+    dataset_dir = Path(data_dir) / f"rows_{n_rows}"
+    if not (dataset_dir / "data" / "Coffee_farms.csv").exists():
+        write_dataset(dataset_dir, n_rows)
+    data_path, geo_path = dataset_dir / "data", dataset_dir / "data_wgs84"
+
+    results = []
+
+    def record(stage, fn, n_repeat=repeat, payload=None):
+        if stage in skip and stage not in REQUIRED_STAGES:
+            results.append({"rows": n_rows, "stage": stage, "skipped": "excluded by --skip"})
+            return None
+        times, result = timed(fn, n_repeat)
+        entry = {
+            "rows": n_rows,
+            "stage": stage,
+            "repeat": n_repeat,
+            "min_s": min(times),
+            "median_s": statistics.median(times),
+            "mean_s": statistics.fmean(times),
+        }
+        if payload is not None:
+            entry["payload_bytes"] = payload(result)
+        results.append(entry)
+        print(f"{n_rows:>9,} {stage:<32} {entry['median_s']:.4f}s", file=sys.stderr)
+        return result
+
+    # loading is expensive at large sizes, so it is timed once; the columnar
+    # cache is removed first so load_data really parses the CSV
+    farms_cache = ingest.cache_path(data_path / "Coffee_farms.csv")
+    farms_cache.unlink(missing_ok=True)
+    data_cws, data_farmers, data_farms = record("load_data", lambda: load_data(data_path), 1)
+    record("ingest_farms", lambda: ingest.ingest_farms(data_path / "Coffee_farms.csv", progress=None), 1)
+    cached_farms = record("load_data[cached]", lambda: load_data(data_path), 1)[2]
+    # the spatial index the ingest wrote with the cache, memory-mapped
+    farm_index = record("farm_index.open",
+                        lambda: FarmIndex(cached_farms, ingest.read_farms_index(data_path / "Coffee_farms.csv")), 1)
+    farms_cache.unlink(missing_ok=True)
+    ingest.index_path(farms_cache).unlink(missing_ok=True)
+    country, lakes, parks, districts = record("load_geo_data", lambda: load_geo_data(geo_path), 1)
+
+    # click on a point inside the district holding most farms, and on a random spot for CWS
+    busiest = data_farmers['district'].value_counts().index[0]
+    anchor = districts.loc[districts['district'] == busiest].geometry.iloc[0].representative_point()
+    pt = click_point(anchor.y, anchor.x)
+    rng = np.random.default_rng(1)
+    cws_pt = click_point(rng.uniform(-2.5, -1.5), rng.uniform(29.3, 30.6))
+
+    cur_district = record("selected_district", lambda: stage_selected_district(districts, pt))
+    locator = record("locator.build", lambda: PointLocator(districts), 1)
+    record("locator.selected_district", lambda: locator.locate(anchor.y, anchor.x))
+    cur_farms = record("selected_farms", lambda: stage_selected_farms(data_farms, cur_district),
+                       payload=len)
+    cur_cws = record("selected_cws", lambda: stage_selected_cws(data_cws, cws_pt))
+    cws_locator = record("cws_locator.build", lambda: CwsLocator(data_cws), 1)
+    record("cws_locator.selected_cws", lambda: cws_locator.position(cws_pt.geometry.iloc[0].y, cws_pt.geometry.iloc[0].x))
+    record("farm_area[district]", lambda: stage_farm_area_district(data_farms, cur_district))
+    record("farm_area[cws]", lambda: stage_farm_area_cws(data_farms, data_farmers, cur_cws))
+    # the cards now read monthly totals built once per data refresh
+    kpis = record("kpis.build", lambda: FarmKpis(data_farms, data_farmers), 1)
+    record("kpis.farm_area[cws]",
+           lambda: kpis.farms_by_cws.total_with_change([str(cur_cws['cws_id'].values[0])]))
+    last_month = kpis.farms.last if kpis.farms.last is not None else 0
+    record("kpis.farmers[range]", lambda: kpis.farmers.total_with_change(None, last_month - 5, last_month))
+    record("kpis.demographics[district]",
+           lambda: kpis.demographics.total_with_change('district', [busiest], last_month - 5, last_month))
+
+    # district -> sector -> cell drill-down: farms located in every level once, then lookups
+    layers = {'district': districts}
+    for level in drilldown_levels(geo_path)[1:]:
+        layers[level] = load_admin_layer(geo_path, level)
+    admin = record("admin.build", lambda: AdminHierarchy(data_farms, layers), 1)
+    district_units = admin.positions('district', cur_district['district'])
+    record("admin.farm_area[district]", lambda: admin.totals['district'].total_with_change(district_units))
+    record("admin.selected_farms[district]", lambda: admin.farms_in('district', district_units), payload=len)
+    unit = ('district', district_units)
+    while admin.child_level(unit[0]) is not None:
+        child = admin.child_level(unit[0])
+        children = record(f"admin.drill[{child}]", lambda: admin.rollup(child, admin.children(*unit)))
+        if children is None or children.empty:
+            break
+        unit = (child, [children['farms'].idxmax()])
+        record(f"admin.selected_farms[{child}]", lambda: admin.farms_in(*unit), payload=len)
+
+    # the same selections through the shared engine, as the apps run them:
+    # on the tables and derived objects of a `build_store` store, with the
+    # selection cache cleared before each call, then once from the cache
+    store = record("engine.build_store", lambda: warm_store(build_store(data_path, geo_path)), 1)
+    store_district_locator, store_cws_locator, store_admin, store_kpis = (
+        store.get(name) for name in ('district_locator', 'cws_locator', 'admin', 'kpis'))
+
+    def cold(fn):
+        def run():
+            engine.selection_cache.clear()
+            return fn()
+        return run
+
+    engine_district = record("engine.selected_district",
+                             cold(lambda: engine.locate_district(store_district_locator, anchor.y, anchor.x)))
+    engine_units = store_admin.positions('district', engine_district['district'])
+    engine_farms = record("engine.selected_farms",
+                          cold(lambda: engine.unit_farms(store_admin, 'district', engine_units)), payload=len)
+    record("engine.selected_farms[cached]", lambda: engine.unit_farms(store_admin, 'district', engine_units),
+           payload=len)
+    cws_lat, cws_lng = cws_pt.geometry.iloc[0].y, cws_pt.geometry.iloc[0].x
+    engine_cws = record("engine.selected_cws", cold(lambda: engine.nearest_cws(store_cws_locator, cws_lat, cws_lng)))
+    engine_cws_id = str(engine_cws['cws_id'].values[0])
+    record("engine.cws_members",
+           cold(lambda: engine.cws_members(store.get('farmers'), store.get('farms'), engine_cws_id)),
+           payload=lambda r: len(r[1]))
+    district_selection = ('district', tuple(engine_units))
+    for label, selection in [("district", district_selection), ("cws", ('cws', engine_cws_id)), ("all", ALL)]:
+        record(f"engine.farm_totals[{label}]",
+               cold(lambda selection=selection: engine.farm_totals(selection, (None, None), store_kpis, store_admin)))
+    record("engine.coffee_trees_data[district]",
+           cold(lambda: engine.coffee_trees_data(district_selection, engine_farms)))
+    engine_district_name = str(engine_district['district'].values[0])
+    record("engine.training_topics_data[district]",
+           cold(lambda: engine.training_topics_data(
+               district_selection, engine.district_farmers(store.get('farmers'), engine_district_name))))
+    engine.selection_cache.clear()
+
+    # nearest-CWS catchments: one assignment pass per data refresh, then a lookup per click
+    catchments = record("catchments.build", lambda: Catchments(data_farms, data_cws), 1)
+    record("catchments.supply_base", lambda: catchments.supply_base(cur_cws['cws_id'].values[0]))
+    # a refresh appending 10% more farms assigns only those
+    earlier = Catchments(data_farms.iloc[:len(data_farms) * 10 // 11], data_cws)
+    record("catchments.append[10%]", lambda: earlier.appended(data_farms, data_cws))
+    # station and district capacity analytics, from the catchment and district aggregates
+    record("capacity.build", lambda: CwsCapacity(data_cws, catchments, admin), 1,
+           payload=lambda r: len(json.dumps(r.layer)))
+    record("catchments.service_areas", lambda: service_areas(data_cws, country), 1)
+    record("coffee_trees_chart[all]", lambda: stage_coffee_trees_chart(data_farms), payload=len)
+    record("coffee_trees_chart[district]", lambda: stage_coffee_trees_chart(cur_farms), payload=len)
+    record("touch_points_chart[all]", lambda: stage_touch_points_chart(data_farmers), payload=len)
+    cur_district_name = str(cur_district['district'].values[0])
+    record("touch_points_chart[district]",
+           lambda: stage_touch_points_chart(data_farmers[data_farmers['district'] == cur_district_name]),
+           payload=len)
+
+    # lazy farms mode: index build and a zoomed-in viewport around the district click
+    view_index = record("viewport.index", lambda: viewport.FarmViewportIndex(data_farms), 1)
+    view_bounds = ((anchor.y - 0.05, anchor.x - 0.05), (anchor.y + 0.05, anchor.x + 0.05))
+    record("viewport.farms_in_view",
+           lambda: viewport.farms_in_view(view_index, view_bounds, viewport.MIN_ZOOM + 2),
+           payload=lambda r: len(json.dumps(r[0])))
+    view_box = (view_bounds[0][0], view_bounds[0][1], view_bounds[1][0], view_bounds[1][1])
+    record("farm_index.query[strtree]", lambda: view_index.query(*view_box), payload=len)
+    record("farm_index.query[mmap]", lambda: farm_index.query(*view_box), payload=len)
+    # zoomed out, the density hexagons of the whole country go instead
+    hexbins = record("hexbins.build", lambda: FarmHexbins(data_farms), 1)
+    country_bounds = tuple(zip(country.total_bounds[[1, 0]], country.total_bounds[[3, 2]]))
+    record("viewport.farms_in_view[hexbins]",
+           lambda: viewport.farms_in_view(view_index, country_bounds, viewport.MIN_ZOOM - 2, hexbins),
+           payload=lambda r: len(json.dumps(r[0])))
+    from coffee_core import packed
+    record("viewport.farms_in_view[packed]",
+           lambda: packed.pack(viewport.farms_in_view(view_index, view_bounds, viewport.MIN_ZOOM + 2)[0]),
+           payload=lambda r: len(json.dumps(r)))
+
+    geo = (country, lakes, parks, districts)
+    # the Folium maps draw the boundaries from one shared-arc topology
+    from coffee_core.topology import BoundaryTopology
+    record("topology.build",
+           lambda: BoundaryTopology(dict(zip(["country", "lakes", "parks", "districts"], geo))), 1,
+           payload=lambda r: len(r.json))
+    record("ipyleaflet.map_cws", lambda: stage_ipyleaflet_map_cws(*geo, data_cws), payload=int)
+    record("folium.map_cws", lambda: stage_folium_map_cws(*geo, data_cws), payload=int)
+    for stage, fn in [("ipyleaflet.map_farms", stage_ipyleaflet_map_farms),
+                      ("folium.map_farms", stage_folium_map_farms)]:
+        if n_rows > max_map_rows:
+            results.append({"rows": n_rows, "stage": stage,
+                            "skipped": f"rows > --max-map-rows ({max_map_rows})"})
+            continue
+        record(stage, lambda fn=fn: fn(*geo, data_farms), 1, payload=int)
+    # packed, the farms are not one marker each and go at any size
+    record("folium.map_farms[packed]", lambda: stage_folium_map_farms_packed(*geo, data_farms), 1, payload=int)
+
+    return results
+
+
+# compare median times against a previous run; returns the regressed entries
+def compare(results, baseline, tolerance):
+    previous = {(r["rows"], r["stage"]): r for r in baseline["results"] if "median_s" in r}
+    regressions = []
+    for r in results:
+        old = previous.get((r["rows"], r["stage"]))
+        if old is None or "median_s" not in r:
+            continue
+        if r["median_s"] > old["median_s"] * (1 + tolerance):
+            regressions.append({
+                "rows": r["rows"],
+                "stage": r["stage"],
+                "baseline_s": old["median_s"],
+                "current_s": r["median_s"],
+                "ratio": r["median_s"] / old["median_s"],
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", help="where synthetic datasets are generated and reused")
+    parser.add_argument("--max-map-rows", type=int, default=MAX_MAP_ROWS)
+    parser.add_argument("--skip", nargs="*", default=[], help="stage names to leave out")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or Path(tempfile.gettempdir()) / "coffee_dashboard_bench"
+    results = []
+    for n_rows in args.sizes:
+        results.extend(run_size(n_rows, data_dir, args.repeat, args.max_map_rows, set(args.skip)))
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandas": pd.__version__,
+        "geopandas": gpd.__version__,
+        "results": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+        for r in report["regressions"]:
+            print(f"REGRESSION {r['rows']:,} {r['stage']}: "
+                  f"{r['baseline_s']:.4f}s -> {r['current_s']:.4f}s", file=sys.stderr)
+        status = 1 if report["regressions"] else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,473 @@
+"""Load test the dashboards with many concurrent sessions.
+
+Starts one of the apps locally with `shiny run` on a synthetic dataset (see
+`benchmarks.synthetic`), or on the repo's own data with `--real-data`, then
+opens `--sessions` websocket sessions the way browsers do. Each session
+replays a random mix of clicks on random points inside Rwanda, clicks inside
+a random district, sector/cell picks in the drill-down and switches between
+the CWS View and Coffee Farms View tabs, with a think time between actions:
+
+    python -m benchmarks.load_test --app folium --sessions 20 --actions 15
+    python -m benchmarks.load_test --app ipyleaflet --rows 100000 --output load.json
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --pid 4242
+
+An action is timed from sending it until the last output update it caused,
+once no output is still recalculating and the session has been quiet for
+`--settle` seconds (longer than the click debounce). The report gives, per
+action, latency percentiles and the bytes received over the websocket, and
+the server's resident memory idle, with all the sessions connected and at
+its peak (Linux only), with the growth per session.
+
+All the outputs of the page are reported visible, as if every session kept
+both tabs on screen, which is the worst case for the server.
+"""
+import argparse
+import asyncio
+import html
+import json
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import websockets
+
+from benchmarks.synthetic import REPO_DIR, SIZES, random_points_in, write_dataset
+from coffee_core.debounce import CLICK_DEBOUNCE_SECS
+
+APPS = {
+    'folium': "coffee_dashb_Folium.py",
+    'ipyleaflet': "Coffee_dashboard_app_ipyleaflet.py",
+}
+TABS = ["Coffee Farms View", "CWS View"]
+# relative weights of the actions a session picks from
+ACTION_MIX = {"click": 3, "district": 3, "drill": 1, "tab": 2}
+# quiet time after the last update of an action for it to count as settled
+SETTLE_SECS = CLICK_DEBOUNCE_SECS + 1
+ACTION_TIMEOUT_SECS = 60
+PERCENTILES = [50, 90, 95, 99]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid):
+    """Resident memory of process `pid`, or None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# a directory laid out like the repo (the app, coffee_core and its data),
+# for running an app on a synthetic dataset without touching the repo
+def stage_app_dir(app_file, dataset_dir, work_dir):
+    app_dir = Path(work_dir)
+    app_dir.mkdir(parents=True, exist_ok=True)
+    links = {app_file: REPO_DIR / app_file, "coffee_core": REPO_DIR / "coffee_core",
+             "data": dataset_dir / "data", "data_wgs84": dataset_dir / "data_wgs84"}
+    for name, target in links.items():
+        link = app_dir / name
+        if link.is_symlink() or link.exists():
+            link.unlink()
+        link.symlink_to(target.resolve())
+    return app_dir
+
+
+# the server inherits the environment, so DASHBOARD_* settings apply to it
+def start_server(app_dir, app_file, port, log_path):
+    log = open(log_path, "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "shiny", "run", app_file, "--host", "127.0.0.1", "--port", str(port)],
+        cwd=app_dir, stdout=log, stderr=subprocess.STDOUT,
+    )
+    proc.log_path = log_path
+    return proc
+
+
+def wait_ready(url, proc=None, timeout=300):
+    """The page at `url` once the server answers, failing if it exits first."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            tail = Path(proc.log_path).read_text()[-2000:]
+            raise RuntimeError(f"the server exited with status {proc.returncode}:\n{tail}")
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return response.read().decode()
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"the server at {url} did not answer within {timeout}s")
+
+
+def page_outputs(page):
+    """Ids of the outputs on the page."""
+    outputs = []
+    for tag in re.findall(r"<div[^>]*>", page):
+        id_ = re.search(r'\bid="([^"]+)"', tag)
+        class_ = re.search(r'\bclass="([^"]*)"', tag)
+        if id_ and class_ and re.search(r"\bshiny-[\w-]*output\b", class_.group(1)):
+            outputs.append(id_.group(1))
+    return outputs
+
+
+def drill_choices(drilldown):
+    """{select id: values of the options not selected} of the drill-down
+    selects in `drilldown` html."""
+    choices = {}
+    for select_id, options in re.findall(r'<select[^>]*\bid="(drill_\w+)"[^>]*>(.*?)</select>', drilldown, re.S):
+        choices[select_id] = [html.unescape(value) for value in re.findall(
+            r'<option(?![^>]*\bselected)[^>]*\bvalue="([^"]*)"', options) if value]
+    return choices
+
+
+class Targets:
+    """Random click targets: anywhere in the country, or inside a district."""
+
+    def __init__(self, geo_path, rng):
+        self.rng = rng
+        self.country = gpd.read_file(geo_path / "RW_country.gpkg", layer="country").geometry.union_all()
+        districts = geo_path / "RW_districts.gpkg"
+        self.districts = (list(gpd.read_file(districts, layer="districts").geometry)
+                          if districts.exists() else [self.country])
+
+    def anywhere(self):
+        x, y = random_points_in(self.country, 1, self.rng)
+        return float(y[0]), float(x[0])
+
+    def in_district(self):
+        district = self.districts[self.rng.integers(len(self.districts))]
+        x, y = random_points_in(district, 1, self.rng)
+        return float(y[0]), float(x[0])
+
+
+class Session:
+    """One simulated browser session."""
+
+    def __init__(self, app, ws_url, outputs, targets, rng, settle, timeout):
+        self.app = app
+        self.ws_url = ws_url
+        self.outputs = outputs
+        self.targets = targets
+        self.rng = rng
+        self.settle = settle
+        self.timeout = timeout
+        self.tab = TABS[0]
+        self.models = {}  # ipyleaflet: output name -> widget model id
+        self.drill = {}
+        self.records = []
+        self._inbox = asyncio.Queue()
+        self._sent = None
+
+    async def _read(self, ws):
+        async for message in ws:
+            self._inbox.put_nowait((time.perf_counter(), len(message), json.loads(message)))
+
+    def _observe(self, message):
+        for name, value in (message.get("values") or {}).items():
+            if isinstance(value, dict) and "model_id" in value:
+                self.models[name] = value["model_id"]
+            if name == "admin_drilldown":
+                self.drill = drill_choices(value["html"]) if isinstance(value, dict) else {}
+
+    @staticmethod
+    def _is_update(message):
+        return bool(message.get("values") or message.get("errors") or message.get("inputMessages")
+                    or "custom" in message)
+
+    def _drain_late(self):
+        """Add what arrived after the last action settled to its record."""
+        while not self._inbox.empty():
+            received, size, message = self._inbox.get_nowait()
+            self._observe(message)
+            record = self.records[-1]
+            record["bytes"] += size
+            record["messages"] += 1
+            record["late_messages"] += 1
+            record["errors"] += len(message.get("errors") or {})
+            if self._is_update(message):
+                record["latency_s"] = received - self._sent
+
+    async def _settled(self, action, sent):
+        """Record of `action` sent at `sent`, once its updates have settled.
+
+        Every action invalidates some output, so it settles only after a first
+        update, however long a loaded server takes to get to it. Busy/idle
+        notices and empty flushes do not count as activity: the data store
+        polls for refreshes, so the server sends them all the time.
+        """
+        n_bytes, n_messages, errors = 0, 0, 0
+        last_update, recalculating = None, set()
+        deadline, active = sent + self.timeout, sent
+        while True:
+            now = time.perf_counter()
+            settling = last_update is not None and not recalculating
+            if now >= deadline or (settling and now >= active + self.settle):
+                break
+            wait = (min(deadline, active + self.settle) if settling else deadline) - now
+            try:
+                received, size, message = await asyncio.wait_for(self._inbox.get(), timeout=wait)
+            except asyncio.TimeoutError:
+                continue
+            n_bytes += size
+            n_messages += 1
+            self._observe(message)
+            status = message.get("recalculating")
+            if status:
+                (recalculating.add if status["status"] == "recalculating" else recalculating.discard)(status["name"])
+            errors += len(message.get("errors") or {})
+            if self._is_update(message):
+                last_update = received
+            if status or "progress" in message or self._is_update(message):
+                active = received
+        record = {
+            "action": action,
+            "latency_s": None if last_update is None else last_update - sent,
+            "bytes": n_bytes,
+            "messages": n_messages,
+            "errors": errors,
+            "late_messages": 0,
+            "timed_out": time.perf_counter() >= deadline,
+        }
+        self.records.append(record)
+        return record
+
+    async def _send(self, ws, action, data):
+        self._drain_late()
+        self._sent = time.perf_counter()
+        await ws.send(json.dumps(data))
+        return await self._settled(action, self._sent)
+
+    def _click(self, lat, lng):
+        if self.app == 'folium':
+            return {"method": "update", "data": {"clicked_coords": [lat, lng]}}
+        # ipyleaflet: a leaflet interaction on the map of the tab in focus
+        model_id = self.models.get("map_farms" if self.tab == TABS[0] else "map_cws")
+        if model_id is None:
+            return None
+        content = {"event": "interaction", "type": "click", "coordinates": [lat, lng]}
+        comm = json.dumps({"content": {"comm_id": model_id, "data": {"method": "custom", "content": content}},
+                           "buffers": []})
+        return {"method": "update", "data": {"shinywidgets_comm_send": comm}}
+
+    async def _act(self, ws, action):
+        if action == "drill":
+            picks = [(select_id, values) for select_id, values in self.drill.items() if values]
+            if not picks:
+                action = "district"
+            else:
+                select_id, values = picks[self.rng.integers(len(picks))]
+                value = values[self.rng.integers(len(values))]
+                return await self._send(ws, action, {"method": "update", "data": {select_id: value}})
+        if action == "tab":
+            self.tab = TABS[1 - TABS.index(self.tab)]
+            return await self._send(ws, action, {"method": "update", "data": {"map_tabs": self.tab}})
+        point = self.targets.in_district() if action == "district" else self.targets.anywhere()
+        message = self._click(*point)
+        if message is None:
+            return None
+        return await self._send(ws, action, message)
+
+    async def run(self, n_actions, think, connected, finished, close):
+        """Connect, replay `n_actions` actions, then stay connected until `close` is set."""
+        async with websockets.connect(self.ws_url, max_size=None) as ws:
+            reader = asyncio.create_task(self._read(ws))
+            init = {"map_tabs": self.tab, ".clientdata_url_search": "",
+                    **{f".clientdata_output_{name}_hidden": False for name in self.outputs}}
+            await self._send(ws, "startup", {"method": "init", "data": init})
+            connected()
+            actions, weights = zip(*ACTION_MIX.items())
+            p = np.array(weights) / sum(weights)
+            for _ in range(n_actions):
+                await asyncio.sleep(think * self.rng.uniform(0.5, 1.5))
+                await self._act(ws, self.rng.choice(actions, p=p))
+            await asyncio.sleep(self.settle)
+            self._drain_late()
+            finished()
+            await close.wait()
+            reader.cancel()
+        return self.records
+
+
+def countdown(n):
+    """A callback to call `n` times, and the event set by the last call."""
+    event, left = asyncio.Event(), [n]
+
+    def tick():
+        left[0] -= 1
+        if left[0] == 0:
+            event.set()
+    return tick, event
+
+
+# wait for `event`, failing early if a session failed
+async def _until(event, sessions):
+    waiter = asyncio.ensure_future(event.wait())
+    await asyncio.wait([waiter, sessions], return_when=asyncio.FIRST_COMPLETED)
+    if not waiter.done():
+        waiter.cancel()
+        sessions.result()
+
+
+async def run_sessions(app, url, outputs, targets, args, pid=None):
+    """Records of the actions of all the sessions, and the server's memory."""
+    ws_url = url.replace("http", "ws", 1).rstrip("/") + "/websocket/"
+    memory = {"idle_bytes": rss_bytes(pid) if pid else None, "peak_bytes": None}
+    connected, all_connected = countdown(args.sessions)
+    finished, all_finished = countdown(args.sessions)
+    close = asyncio.Event()
+
+    async def sample_peak():
+        while True:
+            rss = rss_bytes(pid)
+            if rss is not None:
+                memory["peak_bytes"] = max(memory["peak_bytes"] or 0, rss)
+            await asyncio.sleep(0.5)
+
+    async def start(i):
+        # sessions arrive spread over --ramp seconds
+        await asyncio.sleep(args.ramp * i / args.sessions)
+        session = Session(app, ws_url, outputs, targets, np.random.default_rng(args.seed + i),
+                          args.settle, args.timeout)
+        return await session.run(args.actions, args.think, connected, finished, close)
+
+    sampler = asyncio.create_task(sample_peak()) if pid else None
+    sessions = asyncio.ensure_future(asyncio.gather(*(start(i) for i in range(args.sessions))))
+    try:
+        await _until(all_connected, sessions)
+        memory["connected_bytes"] = rss_bytes(pid) if pid else None
+        await _until(all_finished, sessions)
+        memory["end_bytes"] = rss_bytes(pid) if pid else None
+        close.set()
+        records = [record for session in await sessions for record in session]
+    finally:
+        sessions.cancel()
+        if sampler is not None:
+            sampler.cancel()
+    if memory["idle_bytes"] is not None and memory["connected_bytes"] is not None:
+        memory["per_session_bytes"] = (memory["connected_bytes"] - memory["idle_bytes"]) / args.sessions
+    return records, memory
+
+
+def summarize(records):
+    """Latency and payload percentiles per action."""
+    summary = {}
+    for action in ["startup", *ACTION_MIX]:
+        rows = [r for r in records if r["action"] == action]
+        if not rows:
+            continue
+        latencies = np.array([r["latency_s"] for r in rows if r["latency_s"] is not None])
+        sizes = np.array([r["bytes"] for r in rows])
+        summary[action] = {
+            "count": len(rows),
+            "no_update": sum(r["latency_s"] is None for r in rows),
+            "timeouts": sum(r["timed_out"] for r in rows),
+            "errors": sum(r["errors"] for r in rows),
+            "late_messages": sum(r["late_messages"] for r in rows),
+            "latency_s": {f"p{q}": float(np.percentile(latencies, q)) for q in PERCENTILES} | {
+                "max": float(latencies.max())} if len(latencies) else None,
+            "bytes": {f"p{q}": float(np.percentile(sizes, q)) for q in PERCENTILES} | {
+                "max": int(sizes.max()), "total": int(sizes.sum())},
+        }
+    return summary
+
+
+def print_summary(summary, memory):
+    mib = lambda b: f"{b / 2**20:,.1f} MiB" if b is not None else "n/a"
+    print(f"{'action':<10} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'kB p50':>9} {'kB max':>9}",
+          file=sys.stderr)
+    for action, s in summary.items():
+        lat = s["latency_s"] or {}
+        cells = [f"{lat[k]:.3f}s" if k in lat else "-" for k in ("p50", "p95", "p99", "max")]
+        print(f"{action:<10} {s['count']:>6} {cells[0]:>8} {cells[1]:>8} {cells[2]:>8} {cells[3]:>8} "
+              f"{s['bytes']['p50'] / 1000:>9,.1f} {s['bytes']['max'] / 1000:>9,.1f}", file=sys.stderr)
+    print(f"server memory: idle {mib(memory.get('idle_bytes'))}, connected {mib(memory.get('connected_bytes'))}, "
+          f"peak {mib(memory.get('peak_bytes'))}, per session {mib(memory.get('per_session_bytes'))}",
+          file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=sorted(APPS), default="folium")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--actions", type=int, default=10, help="actions replayed by every session")
+    parser.add_argument("--think", type=float, default=2.0, help="mean seconds between two actions of a session")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which the sessions connect")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECS)
+    parser.add_argument("--timeout", type=float, default=ACTION_TIMEOUT_SECS, help="seconds allowed per action")
+    parser.add_argument("--rows", type=int, default=SIZES[0], help="farms in the synthetic dataset")
+    parser.add_argument("--data-dir", help="where synthetic datasets are generated and reused")
+    parser.add_argument("--real-data", action="store_true", help="run the app on the repo's own data")
+    parser.add_argument("--url", help="load an already running server instead of starting one")
+    parser.add_argument("--pid", type=int, help="process id of the --url server, for its memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    app_file = APPS[args.app]
+    if args.real_data:
+        app_dir = REPO_DIR
+    else:
+        data_dir = Path(args.data_dir or Path(tempfile.gettempdir()) / "coffee_dashboard_bench")
+        dataset_dir = data_dir / f"rows_{args.rows}"
+        if not (dataset_dir / "data" / "Coffee_farms.csv").exists():
+            write_dataset(dataset_dir, args.rows)
+        app_dir = stage_app_dir(app_file, dataset_dir, data_dir / f"app_{args.app}_{args.rows}")
+    targets = Targets(app_dir / "data_wgs84", np.random.default_rng(args.seed))
+
+    server, pid = None, args.pid
+    if args.url:
+        url = args.url
+    else:
+        url = f"http://127.0.0.1:{free_port()}"
+        server = start_server(app_dir, app_file, url.rsplit(":", 1)[1],
+                              Path(tempfile.gettempdir()) / f"coffee_dashboard_load_{args.app}.log")
+        pid = server.pid
+    try:
+        outputs = page_outputs(wait_ready(url, server))
+        print(f"{args.sessions} sessions x {args.actions} actions against {args.app} at {url}", file=sys.stderr)
+        records, memory = asyncio.run(run_sessions(args.app, url, outputs, targets, args, pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(records)
+    print_summary(summary, memory)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "app": args.app,
+        "rows": None if args.real_data or args.url else args.rows,
+        "sessions": args.sessions,
+        "actions": args.actions,
+        "think_s": args.think,
+        "memory": memory,
+        "summary": summary,
+        "records": records,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    return 0 if not any(s["timeouts"] or s["errors"] for s in summary.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
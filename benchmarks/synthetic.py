@@ -0,0 +1,233 @@
+"""Synthetic Rwanda-bounded datasets for benchmarking the dashboards.
+
+The generated files use the same layout and schemas as the real inputs, so
+`load_data` and `load_geo_data` can be pointed at them unchanged:
+
+    <out>/data/Coffee_farms.csv
+    <out>/data/Coffee_farmers.csv
+    <out>/data/Coffee_Washing_Stations.csv
+    <out>/data_wgs84/RW_{country,lakes,national_parks,districts,sectors,cells}.gpkg
+"""
+import shutil
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+GEO_DATA_PATH = REPO_DIR / "data_wgs84"
+
+# Columns of data/Coffee_farms.csv, in file order
+FARM_COLUMNS = [
+    "national_id", "farm_name", "farm_id", "farm_delineated", "farm_registered",
+    "delineate_farm", "area_ares", "nbr_coffee_trees", "age_range_coffee_trees",
+    "coffee_harvested", "nbr_young_coffee_trees", "shade_tree_availability",
+    "shade_tree_species", "nbr_shade_trees", "shade_tree_need", "farm_photo",
+    "shade_tree_species_other", "upi_code", "upi_missing_comment", "farm_centroid",
+    "farm_delineation_check", "x_submitted_by",
+    "farmer_enrollment_farmer_identification_gender", "day", "month", "year", "geom",
+]
+
+# Columns of data/Coffee_Washing_Stations.csv, in file order
+CWS_COLUMNS = [
+    "type", "cws_name", "cws_ownership", "cws_owner_other_entity", "cws_owner_origin",
+    "cws_factory_ownership", "cooperatives_served", "processing_capacity",
+    "actual_capacity", "nbr_farmers_received", "key_contact", "key_contact_position",
+    "key_contact_phone", "photo", "cws_owner_coop", "other_cooperative_served",
+    "comments", "cws_owner_coop_other", "cws_id", "geom",
+]
+
+TREE_AGE_RANGES = ["less_3", "3_to_7", "8_to_15", "16_to_30", "more_30"]
+TRAINING_TOPICS = ["pruning", "mulching", "fertilization", "pest_control",
+                   "harvesting", "shade_trees", "soil_conservation", "rejuvenation"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def load_country():
+    return gpd.read_file(GEO_DATA_PATH / "RW_country.gpkg", layer="country")
+
+
+# sample n points uniformly inside the country polygon (rejection sampling)
+def random_points_in(polygon, n, rng):
+    minx, miny, maxx, maxy = polygon.bounds
+    shapely.prepare(polygon)
+    xs, ys = [], []
+    remaining = n
+    while remaining > 0:
+        x = rng.uniform(minx, maxx, int(remaining * 1.6) + 16)
+        y = rng.uniform(miny, maxy, int(remaining * 1.6) + 16)
+        inside = shapely.contains_xy(polygon, x, y)
+        xs.append(x[inside][:remaining])
+        ys.append(y[inside][:remaining])
+        remaining -= len(xs[-1])
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+# grid of pseudo-districts clipped to the country boundary
+def make_districts(country, n_cols=6, n_rows=5):
+    outline = country.geometry.union_all()
+    minx, miny, maxx, maxy = outline.bounds
+    dx, dy = (maxx - minx) / n_cols, (maxy - miny) / n_rows
+    cells = []
+    for i in range(n_cols):
+        for j in range(n_rows):
+            cell = box(minx + i * dx, miny + j * dy, minx + (i + 1) * dx, miny + (j + 1) * dy)
+            cell = cell.intersection(outline)
+            if not cell.is_empty:
+                cells.append(cell)
+    return gpd.GeoDataFrame(
+        {"district": [f"District_{k:02d}" for k in range(len(cells))]},
+        geometry=cells,
+        crs="EPSG:4326",
+    )
+
+
+# split every unit of `parents` into an n x n grid clipped to it, e.g. the
+# sectors of the pseudo-districts and the cells of those sectors
+def subdivide(parents, parent_column, column, n=3):
+    names, cells = [], []
+    for parent_name, parent in zip(parents[parent_column], parents.geometry):
+        minx, miny, maxx, maxy = parent.bounds
+        dx, dy = (maxx - minx) / n, (maxy - miny) / n
+        k = 0
+        for i in range(n):
+            for j in range(n):
+                cell = box(minx + i * dx, miny + j * dy, minx + (i + 1) * dx, miny + (j + 1) * dy)
+                cell = cell.intersection(parent)
+                if not cell.is_empty and cell.area > 0:
+                    names.append(f"{parent_name}_{column}_{k:02d}")
+                    cells.append(cell)
+                    k += 1
+    return gpd.GeoDataFrame({column: names}, geometry=cells, crs=parents.crs)
+
+
+def make_cws(n, country, rng):
+    x, y = random_points_in(country.geometry.union_all(), n, rng)
+    ids = [f"cws_{k:05d}" for k in range(n)]
+    capacity = rng.integers(100, 5000, n)
+    data = {c: [None] * n for c in CWS_COLUMNS}
+    data.update({
+        "type": "cws",
+        "cws_name": ids,
+        "cws_ownership": rng.choice(["cooperative", "other_entity"], n),
+        "cws_owner_origin": "domestic",
+        "cws_factory_ownership": "yes",
+        "processing_capacity": capacity + rng.integers(0, 1000, n),
+        "actual_capacity": capacity,
+        "nbr_farmers_received": rng.integers(100, 3000, n),
+        "key_contact_phone": rng.integers(780000000, 789999999, n),
+        "cws_id": ids,
+        "geom": shapely.to_wkt(shapely.points(x, y), rounding_precision=7),
+    })
+    return pd.DataFrame(data, columns=CWS_COLUMNS)
+
+
+# farm polygons are small quadrilaterals (~10-60 m across) around random centres
+def make_farms(n, country, rng):
+    x, y = random_points_in(country.geometry.union_all(), n, rng)
+    half = rng.uniform(0.00005, 0.0003, n)
+    ring = np.stack([
+        np.column_stack([x - half, y - half]),
+        np.column_stack([x + half, y - half * 0.8]),
+        np.column_stack([x + half * 0.9, y + half]),
+        np.column_stack([x - half, y + half * 0.7]),
+        np.column_stack([x - half, y - half]),
+    ], axis=1)
+    polygons = shapely.polygons(ring)
+    national_ids = rng.integers(1_190_000_000_000_000, 1_199_999_999_999_999, n)
+    farm_names = [f"farm_{k}" for k in range(n)]
+    data = {c: [None] * n for c in FARM_COLUMNS}
+    data.update({
+        "national_id": national_ids,
+        "farm_name": farm_names,
+        "farm_id": [f"{nid}_{name}" for nid, name in zip(national_ids, farm_names)],
+        "farm_delineated": "no",
+        "farm_registered": "no",
+        "delineate_farm": True,
+        "area_ares": np.round(shapely.area(polygons) * 1.2e8, 2),
+        "nbr_coffee_trees": rng.integers(10, 2000, n),
+        "age_range_coffee_trees": rng.choice(TREE_AGE_RANGES, n),
+        "coffee_harvested": True,
+        "nbr_young_coffee_trees": rng.integers(0, 100, n),
+        "shade_tree_availability": rng.choice([True, False], n),
+        "nbr_shade_trees": rng.integers(0, 20, n),
+        "shade_tree_need": rng.choice([True, False], n),
+        "x_submitted_by": "synthetic",
+        "day": rng.integers(1, 29, n),
+        "month": rng.choice(MONTHS, n),
+        "year": rng.choice([2023, 2024], n),
+        "geom": shapely.to_wkt(polygons, rounding_precision=7),
+    })
+    return pd.DataFrame(data, columns=FARM_COLUMNS)
+
+
+# one farmer per farm; the district comes from where the farm actually is
+def make_farmers(farms, cws, districts, rng):
+    n = len(farms)
+    centroids = gpd.GeoDataFrame(
+        geometry=gpd.GeoSeries.from_wkt(farms["geom"]).centroid, crs="EPSG:4326"
+    )
+    joined = gpd.sjoin(centroids, districts, how="left", predicate="intersects")
+    joined = joined[~joined.index.duplicated()]
+    # draw from a fixed pool of topic combinations to keep 1M-row generation fast
+    pool = np.array([
+        " ".join(rng.choice(TRAINING_TOPICS, rng.integers(1, 4), replace=False))
+        for _ in range(64)
+    ])
+    topics = pool[rng.integers(0, len(pool), n)]
+    young = rng.integers(0, 5, n)
+    return pd.DataFrame({
+        "national_id": farms["national_id"].values,
+        "gender": rng.choice(["female", "male"], n),
+        "age": rng.integers(18, 80, n),
+        "young_in_hh": young,
+        "youth_in_hh": young,
+        "district": joined["district"].str.lower().values,
+        "farmer_cws": rng.choice(cws["cws_id"].values, n),
+        "training_topics": topics,
+    })
+
+
+def write_dataset(out_dir, n_farms, n_cws=None, seed=0):
+    """Write a synthetic dataset of `n_farms` farms/farmers to `out_dir`."""
+    out_dir = Path(out_dir)
+    rng = np.random.default_rng(seed)
+    country = load_country()
+    districts = make_districts(country)
+    if n_cws is None:
+        n_cws = int(np.clip(n_farms // 500, 20, 2000))
+
+    cws = make_cws(n_cws, country, rng)
+    farms = make_farms(n_farms, country, rng)
+    farmers = make_farmers(farms, cws, districts, rng)
+
+    data_path = out_dir / "data"
+    geo_path = out_dir / "data_wgs84"
+    data_path.mkdir(parents=True, exist_ok=True)
+    geo_path.mkdir(parents=True, exist_ok=True)
+    cws.to_csv(data_path / "Coffee_Washing_Stations.csv", index=False)
+    farms.to_csv(data_path / "Coffee_farms.csv", index=False)
+    farmers.to_csv(data_path / "Coffee_farmers.csv", index=False)
+    for name in ["RW_country", "RW_lakes", "RW_national_parks"]:
+        shutil.copy(GEO_DATA_PATH / f"{name}.gpkg", geo_path / f"{name}.gpkg")
+    districts.to_file(geo_path / "RW_districts.gpkg", layer="districts", driver="GPKG")
+    sectors = subdivide(districts, "district", "sector")
+    sectors.to_file(geo_path / "RW_sectors.gpkg", layer="sectors", driver="GPKG")
+    subdivide(sectors, "sector", "cell").to_file(geo_path / "RW_cells.gpkg", layer="cells", driver="GPKG")
+    return data_path, geo_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--rows", type=int, default=SIZES[0])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_dataset(args.out_dir, args.rows, seed=args.seed)
@@ -0,0 +1 @@
+"""Shared helpers used by both the Folium and ipyleaflet dashboards."""
@@ -0,0 +1,143 @@
+"""Administrative levels (district → sector → cell) for drilling into the farms.
+
+District boundaries are always there; sector and cell boundaries are read from
+``data_wgs84`` when their GeoPackages are present, and the drill-down stops at
+the finest level available. `AdminHierarchy` locates every farm in every level
+once, when the farms are (re)loaded, and groups the farm positions by unit.
+Rollups per unit (farms, area, trees) are summed bottom-up: a unit gets the
+totals of its children plus the farms that fall in none of them. Moving from
+a district to its sectors and on to their cells is then a lookup of
+precomputed children, farms and totals instead of a spatial join.
+"""
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from coffee_core.locate import PointLocator
+from coffee_core.timeseries import MonthlyTotals, registration_months
+
+# level: (GeoPackage in data_wgs84, layer), coarsest first. The layer is also
+# the name of the level's table, and its units are named in the `<level>` column.
+ADMIN_LEVELS = {
+    'district': ("RW_districts.gpkg", "districts"),
+    'sector': ("RW_sectors.gpkg", "sectors"),
+    'cell': ("RW_cells.gpkg", "cells"),
+}
+ROLLUP_COLUMNS = ["farms", "area", "trees"]
+
+
+def drilldown_levels(path):
+    """The district level plus the finer levels whose boundaries are in `path`."""
+    return ['district'] + [level for level, (file_name, _) in list(ADMIN_LEVELS.items())[1:]
+                           if (Path(path) / file_name).exists()]
+
+
+def load_admin_layer(path, level):
+    file_name, layer = ADMIN_LEVELS[level]
+    data = gpd.read_file(Path(path) / file_name, layer=layer)
+    data[level] = data[level].str.lower()
+    return data
+
+
+# positions 0..len(codes)-1 grouped by code: those with code c are
+# order[offsets[c]:offsets[c + 1]]; codes of -1 are left out
+def _group(codes, n):
+    kept = np.flatnonzero(codes >= 0)
+    order = kept[np.argsort(codes[kept], kind="stable")]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[kept], minlength=n))])
+    return order, offsets
+
+
+def _members(grouping, units):
+    order, offsets = grouping
+    return np.concatenate([order[offsets[u]:offsets[u + 1]] for u in units] + [np.array([], dtype=int)])
+
+
+class AdminHierarchy:
+    """Farms, children and totals of every unit of the nested `layers`.
+
+    `layers` maps each level to its boundaries (EPSG:4326), coarsest first.
+    Units are referred to by their position in their level's layer.
+    """
+
+    def __init__(self, data_farms, layers):
+        self.farms = data_farms
+        self.layers = dict(layers)
+        self.levels = list(self.layers)
+        lats, lngs = data_farms.geometry.y.to_numpy(), data_farms.geometry.x.to_numpy()
+        months = registration_months(data_farms)
+        values = pd.DataFrame({
+            "farms": 1,
+            "area": data_farms["area"],
+            "trees": pd.to_numeric(data_farms["nbr_coffee_trees"], errors="coerce"),
+        }).fillna(0)
+
+        self.locators, self.totals = {}, {}
+        self._farm_units, self._farms, self._parents, self._children = {}, {}, {}, {}
+        for i, level in enumerate(self.levels):
+            layer = self.layers[level]
+            self.locators[level] = PointLocator(layer)
+            units = self.locators[level].locate_many(lats, lngs)
+            located = units >= 0
+            self._farm_units[level] = units
+            self._farms[level] = _group(units, len(layer))
+            # monthly totals per unit, for the area card and its trend
+            self.totals[level] = MonthlyTotals(months[located], values.loc[located, ["farms", "area"]],
+                                               units[located])
+            if i:
+                parent = self.levels[i - 1]
+                points = layer.geometry.representative_point()
+                self._parents[level] = self.locators[parent].locate_many(points.y, points.x)
+                self._children[parent] = _group(self._parents[level], len(self.layers[parent]))
+
+        self.rollups = {}
+        for i in reversed(range(len(self.levels))):
+            level = self.levels[i]
+            n, units = len(self.layers[level]), self._farm_units[level]
+            direct = units >= 0
+            if i + 1 < len(self.levels):
+                child = self.levels[i + 1]
+                direct &= self._farm_units[child] < 0
+            rollup = pd.DataFrame({
+                col: np.bincount(units[direct], weights=values[col].to_numpy()[direct], minlength=n)
+                for col in ROLLUP_COLUMNS
+            })
+            if i + 1 < len(self.levels):
+                parents = self._parents[child]
+                has_parent = parents >= 0
+                rollup += (self.rollups[child].loc[has_parent, ROLLUP_COLUMNS]
+                           .groupby(parents[has_parent]).sum()
+                           .reindex(range(n), fill_value=0))
+            rollup.insert(0, level, self.layers[level][level].to_numpy())
+            self.rollups[level] = rollup
+
+    def child_level(self, level):
+        i = self.levels.index(level) + 1
+        return self.levels[i] if i < len(self.levels) else None
+
+    def positions(self, level, names):
+        """Positions of the units of `level` called `names`."""
+        return np.flatnonzero(self.layers[level][level].isin(list(names)).to_numpy())
+
+    def children(self, level, units):
+        """Positions of the units one level below `level` that lie in `units`."""
+        if self.child_level(level) is None:
+            return np.array([], dtype=int)
+        return np.sort(_members(self._children[level], units))
+
+    def units(self, level, units):
+        return self.layers[level].iloc[list(units)]
+
+    def farm_positions(self, level, units):
+        """Positions in the farms table of the farms in `units` of `level`."""
+        return np.sort(_members(self._farms[level], units))
+
+    def farms_in(self, level, units):
+        """Rows of the farms in `units` of `level`."""
+        return self.farms.iloc[self.farm_positions(level, units)]
+
+    def rollup(self, level, units):
+        """Farms, area and trees of each of `units`, summed bottom-up."""
+        return self.rollups[level].iloc[list(units)]
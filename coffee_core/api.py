@@ -0,0 +1,332 @@
+"""JSON API answering the dashboards' questions for other tools.
+
+The routes are served beside the Shiny app, from the tables and indexes of
+its `DataStore`, so scripts get the same answers as the maps without loading
+and joining the exports themselves:
+
+    GET /api/farms            farms (GeoJSON points), filtered by:
+                                district= / sector= / cell=  unit names (comma separated)
+                                point=lat,lng [&level=district]  the unit under a point
+                                bbox=west,south,east,north
+                                cws=<cws_id>  farms of the station's farmers
+                                <column>=<value>  any farm column (comma separated
+                                  values, matched ignoring case)
+                              and fields=<columns> to pick the properties
+    GET /api/cws              stations with their capacity and catchment,
+                              filtered by district=, bbox= and station columns
+    GET /api/cws/nearest      station nearest to lat=&lng=
+    GET /api/cws/{cws_id}     one station, with its catchment
+    GET /api/totals           farms, area and farmers of district= / sector= /
+                              cell= / cws= / point= (all farms otherwise),
+                              registered between start= and end= (YYYY-MM)
+    GET /api/districts        farms, trees and station capacity per district
+
+Lists are paged with offset= and limit= (at most `MAX_LIMIT`); the response
+carries the `total` count and the URL of the `next` page. Errors come as
+{"error": ...} with status 400 (bad parameters) or 404 (unknown unit or
+station).
+
+The API is on unless ``DASHBOARD_API=0``, and answers local clients only
+unless ``DASHBOARD_API_PUBLIC=1``.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopy.distance import geodesic
+
+from coffee_core import engine
+from coffee_core.instrumentation import local_only
+from coffee_core.offload import offload
+from coffee_core.timeseries import month_label, month_of
+
+ENABLED = os.environ.get("DASHBOARD_API", "1").lower() not in ("0", "false", "no")
+PUBLIC = os.environ.get("DASHBOARD_API_PUBLIC", "").lower() in ("1", "true", "yes")
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 5000
+FARM_FIELDS = ["national_id", "farm_id", "farm_name", "area", "nbr_coffee_trees", "age_range_coffee_trees"]
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class SpatialQueries:
+    """The API's queries on the current tables of `store`; `farmers` is the
+    farmers table the app ties farmers to stations with."""
+
+    def __init__(self, store, farmers="farmers"):
+        self.store = store
+        self.farmers = farmers
+
+    def farms(self, params):
+        hierarchy = self.store.get('admin')
+        data_farms = hierarchy.farms  # the farms the hierarchy was built from
+        offset, limit = _page(params)
+        fields = _names(params.pop("fields", None)) or FARM_FIELDS
+        _check_columns(fields, data_farms)
+        positions = None
+        level, units = self._units(params, hierarchy)
+        if level is not None:
+            positions = hierarchy.farm_positions(level, units)
+        if "bbox" in params:
+            west, south, east, north = _floats(params.pop("bbox"), 4, "bbox")
+            within = self.store.get('farm_index').query(south, west, north, east)
+            positions = _intersect(positions, within)
+        if "cws" in params:
+            cws_id = self._check_station(params.pop("cws"))
+            data_farmers = self.store.get(self.farmers)
+            cws_farmers, _ = engine.cws_members(data_farmers, data_farms, cws_id)
+            members = np.flatnonzero(data_farms['national_id'].isin(cws_farmers['national_id']).to_numpy())
+            positions = _intersect(positions, members)
+        if positions is None:
+            positions = np.arange(len(data_farms))
+        positions = _filter_columns(params, data_farms, positions)
+
+        rows = data_farms.iloc[positions[offset:offset + limit]]
+        features = _features(rows.geometry, rows[fields])
+        return _collection(features, len(positions), offset, limit)
+
+    def stations(self, params):
+        capacity = self.store.get('cws_capacity')
+        offset, limit = _page(params)
+        stations, geometry = capacity.stations, self._station_points()
+        keep = np.ones(len(stations), dtype=bool)
+        if "district" in params:
+            names = _names(params.pop("district"))
+            if len(self.store.get('admin').positions('district', names)) == 0:
+                raise ApiError(f"unknown district '{','.join(names)}'", 404)
+            keep &= stations['district'].isin(names).to_numpy()
+        if "bbox" in params:
+            west, south, east, north = _floats(params.pop("bbox"), 4, "bbox")
+            points = geometry.reindex(stations.index)
+            keep &= points.intersects(shapely.box(west, south, east, north)).to_numpy()
+        positions = _filter_columns(params, stations, np.flatnonzero(keep))
+
+        rows = stations.iloc[positions[offset:offset + limit]]
+        features = _features(geometry.reindex(rows.index), rows.reset_index())
+        return _collection(features, len(positions), offset, limit)
+
+    def station(self, params, cws_id):
+        _no_params(params)
+        return self._station(cws_id)
+
+    def nearest_station(self, params):
+        lat, lng = _floats(params.pop("lat", None), 1, "lat") + _floats(params.pop("lng", None), 1, "lng")
+        _no_params(params)
+        nearest = engine.nearest_cws(self.store.get('cws_locator'), lat, lng)
+        if nearest is None:
+            raise ApiError("no stations", 404)
+        feature = self._station(str(nearest['cws_id'].values[0]))
+        point = nearest.geometry.iloc[0]
+        feature["properties"]["distance_m"] = geodesic((lat, lng), (point.y, point.x)).meters
+        return feature
+
+    def totals(self, params):
+        hierarchy, kpis = self.store.get('admin'), self.store.get('kpis')
+        months = (_month(params.pop("start", None), "start"), _month(params.pop("end", None), "end"))
+        level, units = self._units(params, hierarchy)
+        if level is not None:
+            selection = (level, tuple(int(u) for u in units))
+            names = list(hierarchy.units(level, units)[level])
+        elif "cws" in params:
+            selection = ('cws', self._check_station(params.pop("cws")))
+            names = [selection[1]]
+        else:
+            selection, names = engine.ALL, None
+        _no_params(params)
+
+        farms, previous, month = engine.farm_totals(selection, months, kpis, hierarchy)
+        farmers, _, _ = engine.farmer_totals(selection, months, kpis, self.store.get(self.farmers),
+                                             hierarchy.farms, hierarchy)
+        return {
+            "selection": {"level": "all" if names is None else selection[0], "units": names},
+            "start": None if months[0] is None else month_label(months[0]),
+            "end": None if months[1] is None else month_label(months[1]),
+            "farms": _record(farms),
+            "farmers": _record(farmers),
+            # totals before the last month of the range, for trends
+            "previous": None if previous is None else _record(previous),
+            "last_month": None if month is None else month_label(month),
+        }
+
+    def districts(self, params):
+        _no_params(params)
+        districts = self.store.get('cws_capacity').districts.reset_index()
+        return {"districts": [_record(row) for row in districts.to_dict("records")]}
+
+    # (level, unit positions) selected by the district/sector/cell or point
+    # parameters, or (None, None)
+    def _units(self, params, hierarchy):
+        for level in hierarchy.levels:
+            if level in params:
+                names = _names(params.pop(level))
+                units = hierarchy.positions(level, names)
+                if len(units) == 0:
+                    raise ApiError(f"unknown {level} '{','.join(names)}'", 404)
+                return level, units
+        if "point" in params:
+            lat, lng = _floats(params.pop("point"), 2, "point")
+            level = params.pop("level", hierarchy.levels[0])
+            if level not in hierarchy.levels:
+                raise ApiError(f"level must be one of {', '.join(hierarchy.levels)}")
+            unit = hierarchy.locators[level].locate_many(np.array([lat]), np.array([lng]))[0]
+            return level, np.array([unit] if unit >= 0 else [], dtype=int)
+        return None, None
+
+    def _station_points(self):
+        return self.store.get('cws').drop_duplicates("cws_id").set_index("cws_id").geometry
+
+    def _check_station(self, cws_id):
+        if cws_id not in self.store.get('cws_capacity').stations.index:
+            raise ApiError(f"unknown cws '{cws_id}'", 404)
+        return cws_id
+
+    def _station(self, cws_id):
+        capacity = self.store.get('cws_capacity')
+        self._check_station(cws_id)
+        row = capacity.stations.loc[[cws_id]]
+        feature = _features(self._station_points().reindex(row.index), row.reset_index())[0]
+        feature["properties"]["catchment"] = _record(self.store.get('catchments').supply_base(cws_id))
+        return feature
+
+
+# Parameters
+#------------
+def _page(params):
+    try:
+        offset = int(params.pop("offset", 0))
+        limit = int(params.pop("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError("offset and limit must be integers")
+    if offset < 0 or limit < 1:
+        raise ApiError("offset must be >= 0 and limit >= 1")
+    return offset, min(limit, MAX_LIMIT)
+
+
+def _names(value):
+    return [] if not value else [name.strip() for name in value.split(",") if name.strip()]
+
+
+def _floats(value, n, name):
+    try:
+        values = [float(v) for v in (value or "").split(",")]
+    except ValueError:
+        values = []
+    if len(values) != n or not np.isfinite(values).all():
+        raise ApiError(f"{name} must be {n} comma separated number{'s' if n > 1 else ''}")
+    return values
+
+
+def _month(value, name):
+    if value is None:
+        return None
+    try:
+        return month_of(pd.Timestamp(f"{value}-01"))
+    except ValueError:
+        raise ApiError(f"{name} must be a month (YYYY-MM)")
+
+
+def _check_columns(columns, table):
+    unknown = [c for c in columns if c not in table.columns or c == "geometry"]
+    if unknown:
+        raise ApiError(f"unknown column(s) {', '.join(unknown)}")
+
+
+def _no_params(params):
+    if params:
+        raise ApiError(f"unknown parameter(s) {', '.join(params)}")
+
+
+# `positions` of `table` whose columns match the remaining parameters, as
+# text ignoring case (so coffee_harvested=true matches the booleans)
+def _filter_columns(params, table, positions):
+    _check_columns(list(params), table)
+    for column, value in params.items():
+        values = table[column].iloc[positions].astype(str).str.casefold()
+        positions = positions[values.isin([name.casefold() for name in _names(value)]).to_numpy()]
+    return positions
+
+
+def _intersect(positions, others):
+    others = np.sort(np.asarray(others, dtype=int))
+    return others if positions is None else np.intersect1d(positions, others, assume_unique=True)
+
+
+# Responses
+#-----------
+def _json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if value is pd.NA or value is pd.NaT:
+        return None
+    return value
+
+
+def _record(values):
+    return {key: _json_value(value) for key, value in dict(values).items()}
+
+
+def _features(points, properties):
+    features = []
+    for point, row in zip(points, properties.to_dict("records")):
+        geometry = None
+        if point is not None and not point.is_empty:
+            geometry = {"type": "Point", "coordinates": [point.x, point.y]}
+        features.append({"type": "Feature", "geometry": geometry, "properties": _record(row)})
+    return features
+
+
+def _collection(features, total, offset, limit):
+    return {"type": "FeatureCollection", "total": total, "offset": offset, "limit": limit,
+            "features": features}
+
+
+def _response(body, status_code=200):
+    from starlette.responses import Response
+    return Response(json.dumps(body, default=str), status_code=status_code, media_type="application/json")
+
+
+# ASGI wrapper serving the API beside the Shiny app
+#---------------------------------------------------
+def with_api_routes(app, store, farmers="farmers"):
+    """`app` with the API routes on the tables of `store` (see the module
+    docstring); `farmers` is the farmers table of the app."""
+    if not ENABLED:
+        return app
+
+    from starlette.applications import Starlette
+    from starlette.routing import Mount, Route
+
+    queries = SpatialQueries(store, farmers)
+
+    def endpoint(query):
+        async def handle(request):
+            store.start()
+            params = dict(request.query_params)
+            try:
+                body = await offload(query, params, **request.path_params)
+            except ApiError as e:
+                return _response({"error": str(e)}, e.status)
+            if "total" in body:
+                end = body["offset"] + body["limit"]
+                body["next"] = (str(request.url.include_query_params(offset=end))
+                                if end < body["total"] else None)
+            return _response(body)
+        return handle if PUBLIC else local_only(handle)
+
+    return Starlette(routes=[
+        Route("/api/farms", endpoint(queries.farms)),
+        Route("/api/cws", endpoint(queries.stations)),
+        Route("/api/cws/nearest", endpoint(queries.nearest_station)),
+        Route("/api/cws/{cws_id}", endpoint(queries.station)),
+        Route("/api/totals", endpoint(queries.totals)),
+        Route("/api/districts", endpoint(queries.districts)),
+        Mount("/", app=app),
+    ])
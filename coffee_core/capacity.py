@@ -0,0 +1,130 @@
+"""Capacity utilization of the coffee washing stations.
+
+Stations report the cherry they are built to process (`processing_capacity`),
+the cherry they processed (`actual_capacity`) and the farmers they received
+cherry from (`nbr_farmers_received`). `CwsCapacity` sets these against the
+supply base of each station's catchment (see `coffee_core.catchment`) and
+sums them per district:
+
+- `utilization`: actual over processing capacity;
+- `supply_gap_t`: cherry the trees are expected to yield (at
+  `CHERRY_KG_PER_TREE`) minus the processing capacity; positive where the
+  harvest exceeds what the stations can take, negative where they have room;
+- `farmers_gap`: farmers of the catchment minus the farmers received.
+
+It is built from the per-station sums of `Catchments` and the district
+rollups of `AdminHierarchy`, which are kept as the tables refresh, so
+building it does not go through the farm rows.
+"""
+import numpy as np
+import pandas as pd
+
+from coffee_core.catchment import CHERRY_KG_PER_TREE
+
+# (upper bound, label, color) of the utilization classes on the CWS map
+UTILIZATION_CLASSES = [
+    (0.5, "under 50%", "#d7191c"),
+    (0.8, "50-80%", "#fdae61"),
+    (1.0, "80-100%", "#1a9641"),
+    (np.inf, "over 100%", "#2b83ba"),
+]
+UNKNOWN_COLOR = "#808080"
+
+
+def utilization_class(utilization):
+    """(label, color) of the class of `utilization`."""
+    if pd.isna(utilization):
+        return "unknown", UNKNOWN_COLOR
+    for bound, label, color in UTILIZATION_CLASSES:
+        if utilization < bound:
+            return label, color
+
+
+class CwsCapacity:
+    """Capacity, supply and gaps per station (`stations`, indexed by `cws_id`)
+    and per district (`districts`, indexed by district name), with the
+    stations as a GeoJSON layer (`layer`)."""
+
+    def __init__(self, data_cws, catchments, hierarchy):
+        stations = data_cws.drop_duplicates("cws_id").set_index("cws_id")
+        processing = pd.to_numeric(stations["processing_capacity"], errors="coerce")
+        actual = pd.to_numeric(stations["actual_capacity"], errors="coerce")
+        received = pd.to_numeric(stations["nbr_farmers_received"], errors="coerce")
+        supply = catchments.summary.reindex(stations.index)
+
+        # district of each station
+        names = hierarchy.layers['district']['district'].to_numpy()
+        units = hierarchy.locators['district'].locate_many(stations.geometry.y.to_numpy(),
+                                                           stations.geometry.x.to_numpy())
+        district = pd.Series(None, index=stations.index, dtype=object)
+        district[units >= 0] = names[units[units >= 0]]
+        self.stations = pd.DataFrame({
+            "cws_name": stations["cws_name"],
+            "district": district,
+            "processing_capacity": processing,
+            "actual_capacity": actual,
+            "utilization": actual / processing.where(processing > 0),
+            "farms": supply["farms"],
+            "area": supply["area"],
+            "trees": supply["trees"],
+            "expected_cherry_t": supply["expected_cherry_t"],
+            "supply_gap_t": supply["expected_cherry_t"] - processing,
+            "farmers": supply["farmers"],
+            "farmers_received": received,
+            "farmers_gap": supply["farmers"] - received,
+        })
+
+        # farms of each district (all of them, not only those of its
+        # stations' catchments) against the capacity of its stations
+        rollup = hierarchy.rollups['district'].groupby('district')[["farms", "area", "trees"]].sum()
+        capacity = self.stations.groupby("district")[["processing_capacity", "actual_capacity",
+                                                      "farmers_received"]].sum()
+        capacity.insert(0, "stations", self.stations.groupby("district").size())
+        districts = rollup.join(capacity, how="outer").fillna(0)
+        districts["expected_cherry_t"] = districts["trees"] * CHERRY_KG_PER_TREE / 1000
+        districts["utilization"] = (districts["actual_capacity"]
+                                    / districts["processing_capacity"].where(districts["processing_capacity"] > 0))
+        districts["supply_gap_t"] = districts["expected_cherry_t"] - districts["processing_capacity"]
+        self.districts = districts
+
+        self.layer = self._layer(stations.geometry)
+
+    def _layer(self, geometry):
+        features = []
+        for cws_id, row in self.stations.iterrows():
+            point = geometry.loc[cws_id]
+            if point is None or point.is_empty:
+                continue
+            label, color = utilization_class(row["utilization"])
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [point.x, point.y]},
+                "properties": {
+                    "cws_id": cws_id,
+                    "cws_name": row["cws_name"],
+                    "utilization": label if pd.isna(row["utilization"]) else f"{row['utilization']:.0%}",
+                    "supply_gap": _tonnes(row["supply_gap_t"], signed=True),
+                    "farmers_gap": "n/a" if pd.isna(row["farmers_gap"]) else f"{row['farmers_gap']:+,.0f}",
+                    "color": color,
+                },
+            })
+        return {"type": "FeatureCollection", "features": features}
+
+    def station_lines(self, cws_id):
+        """(label, text) pairs describing the capacity of station `cws_id`, for popups."""
+        if cws_id not in self.stations.index:
+            return []
+        row = self.stations.loc[cws_id]
+        utilization = "n/a" if pd.isna(row["utilization"]) else f"{row['utilization']:.0%}"
+        return [
+            ("Processing capacity", _tonnes(row["processing_capacity"])),
+            ("Capacity used", utilization),
+            ("Supply gap", _tonnes(row["supply_gap_t"], signed=True)),
+            ("Farmers received", "n/a" if pd.isna(row["farmers_received"]) else f"{row['farmers_received']:,.0f}"),
+        ]
+
+
+def _tonnes(value, signed=False):
+    if pd.isna(value):
+        return "n/a"
+    return f"{value:+,.0f} Tonnes" if signed else f"{value:,.0f} Tonnes"
@@ -0,0 +1,196 @@
+"""Catchment areas of the coffee washing stations.
+
+Every farm is assigned to its nearest CWS (or to its `k` nearest) in one
+vectorized pass, with distances measured in the projected CRS used for the
+farm areas. Per-CWS aggregates of the farms assigned to each station (count,
+area, trees, farm owners) are precomputed, together with the cherry supply
+those trees are expected to deliver and how it compares with the station's
+`actual_capacity`.
+
+`service_areas` gives the matching coverage polygons: the Voronoi cell of each
+station clipped to the country, optionally capped at `SERVICE_RADIUS_KM` so
+that land far from every station shows up as a gap.
+"""
+import copy
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from coffee_core.ingest import AREA_CRS
+
+# average cherry yield of a coffee tree, used to estimate the supply of a catchment
+CHERRY_KG_PER_TREE = 2.0
+CHUNKSIZE = 10_000
+# per-CWS sums of the assigned farms, which appended farms add to
+SUM_COLUMNS = ["farms", "farmers", "area", "trees", "distance_m"]
+# cap on the service areas drawn on the CWS map, 0 for plain Voronoi cells
+SERVICE_RADIUS_KM = float(os.environ.get("DASHBOARD_CWS_SERVICE_RADIUS_KM", 0))
+
+
+def nearest_cws(data_farms, data_cws, k=1):
+    """Nearest `k` stations of every farm.
+
+    Returns a frame aligned with `data_farms`: `cws_id` and `distance_m` for
+    k=1, otherwise `cws_id_1`, `distance_m_1`, ..., `cws_id_k`, `distance_m_k`
+    in increasing distance.
+    """
+    farms = data_farms.geometry.to_crs(AREA_CRS)
+    stations = data_cws.geometry.to_crs(AREA_CRS)
+    cws_ids = data_cws["cws_id"].to_numpy()
+
+    if k == 1:
+        tree = shapely.STRtree(stations.values)
+        (farm_idx, cws_idx), distance = tree.query_nearest(
+            farms.values, return_distance=True, all_matches=False
+        )
+        cws = np.full(len(farms), None, dtype=object)
+        distances = np.full(len(farms), np.nan)
+        cws[farm_idx] = cws_ids[cws_idx]
+        distances[farm_idx] = distance
+        return pd.DataFrame({"cws_id": cws, "distance_m": distances}, index=data_farms.index)
+
+    # k nearest: there are few stations, so take the distances to all of them
+    # for a chunk of farms at a time and keep the k smallest
+    k = min(k, len(cws_ids))
+    fx, fy = farms.centroid.x.to_numpy(), farms.centroid.y.to_numpy()
+    sx, sy = stations.x.to_numpy(), stations.y.to_numpy()
+    nearest = np.empty((len(fx), k), dtype=int)
+    distances = np.empty((len(fx), k))
+    for start in range(0, len(fx), CHUNKSIZE):
+        end = start + CHUNKSIZE
+        d = np.hypot(fx[start:end, None] - sx[None, :], fy[start:end, None] - sy[None, :])
+        idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, idx, axis=1)
+        order = np.argsort(d, axis=1)
+        nearest[start:end] = np.take_along_axis(idx, order, axis=1)
+        distances[start:end] = np.take_along_axis(d, order, axis=1)
+
+    columns = {}
+    for j in range(k):
+        columns[f"cws_id_{j + 1}"] = cws_ids[nearest[:, j]]
+        columns[f"distance_m_{j + 1}"] = distances[:, j]
+    return pd.DataFrame(columns, index=data_farms.index)
+
+
+class Catchments:
+    """Nearest-CWS assignment of the farms and the resulting per-CWS aggregates.
+
+    The aggregates are kept as sums, so that `appended` can extend them with
+    farms appended to the table without assigning the other farms again.
+    """
+
+    def __init__(self, data_farms, data_cws):
+        self.stations = data_cws.drop_duplicates("cws_id").set_index("cws_id")
+        self.assignment, self._sums = _assign(data_farms, data_cws)
+        # CWS of each farm owner, from the owner's first farm
+        first = self.assignment.drop_duplicates("national_id")
+        self._owners = pd.Series(first["cws_id"].to_numpy(), index=first["national_id"].to_numpy())
+        self._sums["farmers"] = self._owners.groupby(self._owners.to_numpy()).size()
+        self.summary = self._summarize()
+
+    def appended(self, data_farms, data_cws):
+        """Catchments of `data_farms`, the farms these were built from
+        followed by new ones; only the new farms are assigned."""
+        n = len(self.assignment)
+        if len(data_farms) < n:
+            return Catchments(data_farms, data_cws)
+        extended = copy.copy(self)
+        assignment, sums = _assign(data_farms.iloc[n:], data_cws)
+        first = assignment.drop_duplicates("national_id")
+        first = first[~first["national_id"].isin(self._owners.index)]
+        owners = pd.Series(first["cws_id"].to_numpy(), index=first["national_id"].to_numpy())
+        sums["farmers"] = owners.groupby(owners.to_numpy()).size()
+        extended.assignment = pd.concat([self.assignment, assignment])
+        extended._owners = pd.concat([self._owners, owners])
+        extended._sums = self._sums.add(sums, fill_value=0)
+        extended.summary = extended._summarize()
+        return extended
+
+    def _summarize(self):
+        # stations without any farm nearby still get a (zero) row
+        summary = self._sums.reindex(self.stations.index)
+        summary[SUM_COLUMNS] = summary[SUM_COLUMNS].fillna(0)
+        summary["mean_distance_m"] = summary.pop("distance_m") / summary["farms"].where(summary["farms"] > 0)
+        summary["capacity"] = pd.to_numeric(self.stations["actual_capacity"], errors="coerce")
+        summary["expected_cherry_t"] = summary["trees"] * CHERRY_KG_PER_TREE / 1000
+        # expected supply over actual capacity (not capacity.CwsCapacity's `utilization`)
+        summary["supply_ratio"] = summary["expected_cherry_t"] / summary["capacity"].where(summary["capacity"] > 0)
+        return summary
+
+    def owner_cws(self):
+        """CWS of each farm owner (by `national_id`), from the owner's first farm."""
+        return self._owners
+
+    def supply_base(self, cws_id):
+        """Catchment aggregates of station `cws_id`, or None if it is unknown."""
+        if cws_id not in self.summary.index:
+            return None
+        return self.summary.loc[cws_id].to_dict()
+
+
+# nearest-CWS assignment of `data_farms` and its per-CWS sums
+def _assign(data_farms, data_cws):
+    assignment = nearest_cws(data_farms, data_cws)
+    assignment["national_id"] = data_farms["national_id"]
+    farms = pd.DataFrame({
+        "cws_id": assignment["cws_id"],
+        "area": data_farms["area"],
+        "trees": pd.to_numeric(data_farms["nbr_coffee_trees"], errors="coerce"),
+        "distance_m": assignment["distance_m"],
+    })
+    sums = farms.groupby("cws_id").agg(
+        farms=("area", "size"),
+        area=("area", "sum"),
+        trees=("trees", "sum"),
+        distance_m=("distance_m", "sum"),
+    )
+    return assignment, sums
+
+
+# (label, text) pairs describing a station's catchment, for popups
+def supply_base_lines(base):
+    supply_ratio = "n/a" if pd.isna(base["supply_ratio"]) else f"{base['supply_ratio']:.0%}"
+    return [
+        ("Catchment farms", f"{base['farms']:,.0f}"),
+        ("Catchment farmers", f"{base['farmers']:,.0f}"),
+        ("Catchment area", f"{base['area']:,.1f} ha"),
+        ("Coffee trees", f"{base['trees']:,.0f}"),
+        ("Expected cherry", f"{base['expected_cherry_t']:,.0f} Tonnes"),
+        ("Supply / capacity", supply_ratio),
+    ]
+
+
+def service_areas(data_cws, country, max_distance_km=SERVICE_RADIUS_KM):
+    """Service area polygon of every station, in EPSG:4326.
+
+    Each station gets its Voronoi cell (the land closer to it than to any other
+    station) clipped to `country` and, if `max_distance_km` is set, to a disc
+    of that radius around the station. Returns `cws_id`, `cws_name`,
+    `area_km2` and the polygons.
+    """
+    stations = data_cws.drop_duplicates("cws_id").reset_index(drop=True)
+    points = stations.geometry.to_crs(AREA_CRS).values
+    boundary = shapely.union_all(country.geometry.to_crs(AREA_CRS).values)
+
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.MultiPoint(list(points)), extend_to=boundary))
+    if len(cells):
+        # voronoi_polygons does not keep the input order: match cells to stations
+        point_idx, cell_idx = shapely.STRtree(cells).query(points, predicate="within")
+        areas = np.full(len(points), None, dtype=object)
+        areas[point_idx] = cells[cell_idx]
+        areas = shapely.intersection(areas, boundary)
+    else:
+        # a single station serves the whole country
+        areas = np.full(len(points), boundary, dtype=object)
+    if max_distance_km:
+        areas = shapely.intersection(areas, shapely.buffer(points, max_distance_km * 1000))
+
+    result = gpd.GeoDataFrame({
+        "cws_id": stations["cws_id"],
+        "cws_name": stations["cws_name"],
+        "area_km2": (shapely.area(areas) / 1e6).round(1),
+    }, geometry=gpd.GeoSeries(areas, crs=AREA_CRS))
+    return result.to_crs(epsg=4326)
@@ -0,0 +1,62 @@
+"""Debouncing for reactive values that change in quick bursts (map pans,
+zooms, clicks and tab switches)."""
+import os
+import time
+
+from shiny import reactive
+
+# how long map clicks and tab switches must settle before the selection follows
+CLICK_DEBOUNCE_SECS = float(os.environ.get("DASHBOARD_CLICK_DEBOUNCE_SECS", 0.25))
+
+
+def debounce(delay_secs):
+    """Decorator turning a reactive calc into one that only updates after its
+    dependencies have been quiet for `delay_secs`.
+
+    Adapted from the Shiny for Python debounce recipe: a primer effect notes
+    every change, a timer effect waits for the quiet period, and the returned
+    calc only re-executes when the timer fires. Changes arriving during the
+    quiet period are coalesced, so only the last one is ever computed on.
+    """
+    def wrapper(f):
+        when = reactive.Value(None)
+        trigger = reactive.Value(0)
+        primed = False
+
+        @reactive.Calc
+        def cached():
+            return f()
+
+        @reactive.Effect(priority=102)
+        def primer():
+            nonlocal primed
+            try:
+                cached()
+            except Exception:
+                ...
+            finally:
+                # the debounced calc already starts from the first value
+                if primed:
+                    when.set(time.monotonic() + delay_secs)
+                primed = True
+
+        @reactive.Effect(priority=101)
+        def timer():
+            deadline = when.get()
+            if deadline is None:
+                return
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger.get() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_none=False)
+        def debounced():
+            return cached()
+
+        return debounced
+    return wrapper
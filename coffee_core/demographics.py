@@ -0,0 +1,103 @@
+"""Farmer demographics (gender, age bands, youth) per district and per CWS.
+
+The farmers export holds ages, genders and household youth counts as text.
+`typed_farmers` casts those columns once when the table is loaded, and
+`Demographics` buckets the farmers of every district and CWS by the month
+their first farm was registered (see `coffee_core.timeseries.MonthlyTotals`),
+so the demographic cards of any selection and period are a lookup.
+
+Both dashboards count farmers younger than `YOUTH_AGE` as young. The age
+bands split at `AGE_BANDS` and at `YOUTH_AGE`.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from coffee_core.timeseries import MonthlyTotals
+
+YOUTH_AGE = int(os.environ.get("DASHBOARD_YOUTH_AGE", 30))
+AGE_BANDS = [int(age) for age in os.environ.get("DASHBOARD_AGE_BANDS", "45,60").split(",") if age.strip()]
+# household youth counts, under the name used by either export
+YOUTH_COLUMNS = ["youth_in_hh", "young_in_hh"]
+
+
+def typed_farmers(data_farmers):
+    """`data_farmers` with `gender` as a category, `age` as a number and the
+    household youth count as a number in `youth_in_hh` (NaN where unknown)."""
+    data_farmers['gender'] = data_farmers['gender'].str.strip().str.lower().astype('category')
+    data_farmers['age'] = pd.to_numeric(data_farmers['age'], errors='coerce').astype('float32')
+    youth_column = next((c for c in YOUTH_COLUMNS if c in data_farmers.columns), None)
+    if youth_column is None:
+        data_farmers['youth_in_hh'] = np.float32(np.nan)
+    else:
+        data_farmers['youth_in_hh'] = pd.to_numeric(data_farmers[youth_column], errors='coerce').astype('float32')
+    return data_farmers
+
+
+def age_bands(youth_age=YOUTH_AGE, edges=AGE_BANDS):
+    """(label, lowest age, lowest age of the next band) of the age bands, youngest first."""
+    bounds = [0, *sorted(set(edges) | {youth_age}), np.inf]
+    bands = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        if low == 0:
+            label = f"under {high}"
+        elif high == np.inf:
+            label = f"{low}+"
+        else:
+            label = f"{low}-{high - 1}"
+        bands.append((label, low, high))
+    return bands
+
+
+class Demographics:
+    """Monthly farmer counts per district and per CWS.
+
+    Metrics are `farmers`, `women`, `men`, `young`, `hh_with_youth` (farmers
+    whose household has youth), `youth_in_hh` (young people in the
+    households) and one `age <band>` count per age band. Farmers of an
+    unknown age are in no band.
+    """
+
+    def __init__(self, data_farmers, months, youth_age=YOUTH_AGE, edges=AGE_BANDS):
+        self.youth_age = youth_age
+        bands = age_bands(youth_age, edges)
+        self.bands = [label for label, _, _ in bands]
+        age = data_farmers['age'].to_numpy()
+        youth_in_hh = data_farmers['youth_in_hh']
+        values = pd.DataFrame({
+            "farmers": 1,
+            "women": (data_farmers['gender'] == 'female').to_numpy(),
+            "men": (data_farmers['gender'] == 'male').to_numpy(),
+            "young": age < youth_age,
+            "hh_with_youth": youth_in_hh.to_numpy() > 0,
+            "youth_in_hh": youth_in_hh.fillna(0).to_numpy(),
+            **{f"age {label}": (age >= low) & (age < high) for label, low, high in bands},
+        }, index=data_farmers.index)
+        self.by_district = MonthlyTotals(months, values, data_farmers['district'])
+        self.by_cws = MonthlyTotals(months, values, data_farmers['farmer_cws'])
+        # per farmer, for the totals of farmers picked by id
+        self._national_ids = data_farmers['national_id'].to_numpy()
+        self._months = np.asarray(months, dtype=float)
+        self._values = values
+
+    def total_with_change(self, by=None, groups=None, start=None, end=None):
+        """`MonthlyTotals.total_with_change` for the farmers of the districts
+        (`by='district'`) or CWS ids (`by='cws'`) in `groups`, or of all the
+        farmers if `by` is None."""
+        if by is None:
+            return self.by_district.total_with_change(None, start, end)
+        totals = self.by_cws if by == 'cws' else self.by_district
+        return totals.total_with_change(list(groups), start, end)
+
+    def farmers_total_with_change(self, national_ids, start=None, end=None):
+        """`total_with_change` for the farmers whose `national_id` is in
+        `national_ids` (the owners of the farms of a sector or cell, say)."""
+        picked = np.where(np.isin(self._national_ids, np.asarray(national_ids)), True, None)
+        # grouped among all the farmers, so the months are those of the other totals
+        return MonthlyTotals(self._months, self._values, picked).total_with_change([True], start, end)
+
+    def band_shares(self, totals):
+        """(band, % of the farmers) of the age bands in `totals`."""
+        farmers = totals['farmers']
+        return [(band, totals[f"age {band}"] / farmers * 100 if farmers else 0.0) for band in self.bands]
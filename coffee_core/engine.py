@@ -0,0 +1,337 @@
+"""Data and query engine shared by the Folium and ipyleaflet dashboards.
+
+Both apps load the same exports and answer the same questions about a map
+selection; this module does it once for them:
+
+- `load_data` / `load_geo_data` read the CSV exports and boundary layers, and
+  `build_store` registers them, with the indexes and aggregates derived from
+  them, in a `DataStore` shared by all sessions;
+- the selection queries (`locate_district`, `unit_farms`, `nearest_cws`,
+  `cws_members`, `district_farmers`, `selection_farmers`, `farm_totals`,
+  `farmer_totals`) and the chart data
+  (`coffee_trees_data`, `training_topics_data`) are computed once per
+  selection and kept in `selection_cache` for all sessions.
+
+Queries take the tables they read as arguments: the apps keep reading the
+tables reactively, so a data refresh invalidates them, while the work and its
+cache are shared. A selection is identified by a tuple: `(level, units)` for
+administrative units (`level` 'district', 'sector' or 'cell', `units` a tuple
+of unit positions), `('cws', cws_id)` for a station, or `ALL`.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+from shapely import wkt
+
+from coffee_core import viewport
+from coffee_core.admin import ADMIN_LEVELS, AdminHierarchy, drilldown_levels, load_admin_layer
+from coffee_core.capacity import CwsCapacity
+from coffee_core.catchment import Catchments, service_areas
+from coffee_core.demographics import typed_farmers
+from coffee_core.hexbin import FarmHexbins
+from coffee_core.ingest import append_farms, read_farms_cache, read_farms_index
+from coffee_core.instrumentation import instrument
+from coffee_core.locate import PointLocator
+from coffee_core.memo import SelectionCache
+from coffee_core.refresh import DataStore
+from coffee_core.reports import report_map_layers
+from coffee_core.rtree import FarmIndex
+from coffee_core.timeseries import FarmKpis
+from coffee_core.topology import BoundaryTopology
+
+ALL = ('all',)
+TREE_AGE_RANGES = ["less_3", "3_to_7", "8_to_15", "16_to_30", "more_30"]
+
+# results per selected district/sector/cell or CWS, shared by all sessions
+selection_cache = SelectionCache()
+
+
+# Load and prepare csv data
+#---------------------------
+def load_cws(path):
+    data_cws = pd.read_csv(f"{path}/Coffee_Washing_Stations.csv")
+    data_cws.columns = data_cws.columns.str.lower()
+    data_cws = gpd.GeoDataFrame(
+        data_cws,
+        geometry=gpd.GeoSeries.from_wkt(data_cws['geom']),
+        crs="EPSG:4326"
+    ).drop('geom', axis=1)
+
+    # Convert columns to numeric
+    data_cws['actual_capacity'] = pd.to_numeric(data_cws['actual_capacity'])
+    return data_cws
+
+
+def load_farmers(path, require_cws=False):
+    """The farmers export; with `require_cws`, only the farmers recorded at a CWS."""
+    data_farmers = pd.read_csv(f"{path}/Coffee_farmers.csv")
+    data_farmers.columns = data_farmers.columns.str.lower()
+    if require_cws:
+        data_farmers = data_farmers[data_farmers['farmer_cws'].notna()].copy()
+
+    # convert farmer_cws to lower case and replace spaces by underscores
+    data_farmers['farmer_cws'] = data_farmers['farmer_cws'].str.lower().str.replace(' ', '_')
+    return typed_farmers(data_farmers)
+
+
+def load_farms(path):
+    # Prefer the columnar cache written by `python -m coffee_core.ingest`
+    data_farms = read_farms_cache(f"{path}/Coffee_farms.csv")
+    if data_farms is not None:
+        return data_farms
+
+    data_farms = pd.read_csv(f"{path}/Coffee_farms.csv")
+    data_farms.columns = data_farms.columns.str.lower()
+
+    # define a function to filter out farms with invalid WKT strings
+    def safe_load_wkt(wkt_string):
+        try:
+            return wkt.loads(wkt_string)
+        except Exception:
+            return None
+
+    # Apply the WKT validation function to filter out invalid geometries
+    data_farms['geometry'] = data_farms['geom'].apply(safe_load_wkt)
+    data_farms = data_farms[data_farms['geometry'].notnull()].copy()
+
+    # Convert to GeoDataFrame and project to UTM to allow area calculation
+    data_farms = gpd.GeoDataFrame(data_farms, geometry='geometry', crs='EPSG:4326').to_crs(epsg=32736)
+
+    # Calculate farm areas, in hectares
+    data_farms['area'] = data_farms.area / 10_000
+
+    # Calculate centroids for farms
+    data_farms['geometry'] = data_farms.geometry.centroid
+    data_farms.to_crs(epsg=4326, inplace=True)
+    data_farms = data_farms.drop('geom', axis=1)
+    return data_farms
+
+
+@instrument()
+def load_data(path, require_cws=False):
+    return load_cws(path), load_farmers(path, require_cws), load_farms(path)
+
+
+# load geometry data
+#--------------------
+GEO_LAYERS = {
+    'country': ("RW_country.gpkg", "country"),
+    'lakes': ("RW_lakes.gpkg", "lakes"),
+    'parks': ("RW_national_parks.gpkg", "np"),
+    'districts': ("RW_districts.gpkg", "districts"),
+}
+
+
+def load_geo_layer(path, name):
+    file_name, layer = GEO_LAYERS[name]
+    data = gpd.read_file(f"{path}/{file_name}", layer=layer)
+    if name == 'districts':
+        data['district'] = data['district'].str.lower()  # Convert district names to lowercase
+    return data
+
+
+@instrument()
+def load_geo_data(path):
+    return tuple(load_geo_layer(path, name) for name in GEO_LAYERS)
+
+
+def farmers_by_catchment(data_farmers, catchments):
+    """`data_farmers` with each farmer at the CWS whose catchment holds their
+    farms (their recorded CWS when they have no farm)."""
+    farmers = data_farmers.copy()
+    farmers['farmer_cws'] = farmers['national_id'].map(catchments.owner_cws()).fillna(farmers['farmer_cws'])
+    return farmers
+
+
+class CwsLocator:
+    """Finds the station nearest to a point.
+
+    Great-circle distances to all the stations are one vectorized pass. They
+    are within 0.6% of the distances on the ellipsoid, so only the stations
+    within 2% of the nearest one are then measured with geopy's `geodesic`,
+    giving the same station as measuring all of them.
+    """
+
+    def __init__(self, data_cws):
+        self.data_cws = data_cws
+        self._lat = np.radians(data_cws.geometry.y.to_numpy())
+        self._lng = np.radians(data_cws.geometry.x.to_numpy())
+
+    def position(self, lat, lng):
+        """Position of the station nearest to (`lat`, `lng`), None if there is none."""
+        phi, lam = np.radians(lat), np.radians(lng)
+        # haversine, in radians of the sphere
+        a = (np.sin((self._lat - phi) / 2) ** 2
+             + np.cos(phi) * np.cos(self._lat) * np.sin((self._lng - lam) / 2) ** 2)
+        distances = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        if not np.isfinite(distances).any():
+            return None
+        candidates = np.flatnonzero(distances <= np.nanmin(distances) * 1.02)
+        if len(candidates) == 1:
+            return int(candidates[0])
+        exact = [geodesic((lat, lng), (np.degrees(self._lat[i]), np.degrees(self._lng[i]))).meters
+                 for i in candidates]
+        return int(candidates[np.argmin(exact)])
+
+
+def build_store(data_path, geo_path, catchment_cws=False):
+    """`DataStore` of the exports and boundary layers, and of the indexes and
+    aggregates derived from them.
+
+    With `catchment_cws`, the farmers are tied to the CWS of their farms'
+    catchment (table 'farmers_by_catchment', also used for the KPIs) and
+    farmers recorded at no CWS are left out.
+    """
+    store = DataStore()
+    store.register('cws', [data_path / "Coffee_Washing_Stations.csv"], lambda: load_cws(data_path))
+    store.register('farmers', [data_path / "Coffee_farmers.csv"],
+                   lambda: load_farmers(data_path, require_cws=catchment_cws))
+    store.register('farms', [data_path / "Coffee_farms.csv"], lambda: load_farms(data_path),
+                   append=append_farms)
+    for name, (file_name, layer) in GEO_LAYERS.items():
+        store.register(name, [geo_path / file_name], lambda name=name: load_geo_layer(geo_path, name))
+    # sectors and cells for the drill-down, when their boundaries are there
+    admin_levels = drilldown_levels(geo_path)
+    for level in admin_levels[1:]:
+        file_name, table = ADMIN_LEVELS[level]
+        store.register(table, [geo_path / file_name], lambda level=level: load_admin_layer(geo_path, level))
+    # bounding-box queries on the farms, from the index written by the ingest
+    # (memory-mapped) when it goes with the loaded farms
+    store.derive('farm_index', 'farms',
+                 lambda farms: FarmIndex(farms, read_farms_index(data_path / "Coffee_farms.csv")),
+                 append=FarmIndex.appended)
+    if viewport.ENABLED:
+        store.derive('farms_view_index', ['farms', 'farm_index'], viewport.FarmViewportIndex)
+        store.derive('farm_hexbins', 'farms', FarmHexbins)
+    store.derive('catchments', ['farms', 'cws'], Catchments, append=Catchments.appended)
+    farmers = 'farmers'
+    if catchment_cws:
+        store.derive('farmers_by_catchment', ['farmers', 'catchments'], farmers_by_catchment)
+        farmers = 'farmers_by_catchment'
+    store.derive('kpis', ['farms', farmers], FarmKpis)
+    store.derive('cws_service_areas', ['cws', 'country'], service_areas)
+    store.derive('district_locator', 'districts', PointLocator)
+    store.derive('cws_locator', 'cws', CwsLocator)
+    store.derive('admin', ['farms'] + [ADMIN_LEVELS[level][1] for level in admin_levels],
+                 lambda farms, *layers: AdminHierarchy(farms, zip(admin_levels, layers)))
+    store.derive('cws_capacity', ['cws', 'catchments', 'admin'], CwsCapacity)
+    store.derive('report_map_layers', list(GEO_LAYERS), report_map_layers)
+    store.derive('boundary_topology', list(GEO_LAYERS),
+                 lambda *layers: BoundaryTopology(dict(zip(GEO_LAYERS, layers))))
+    return store
+
+
+# Selection queries, cached for all sessions
+#--------------------------------------------
+def locate_district(locator, lat, lng):
+    """Rows of the district under (`lat`, `lng`), the same rows for every
+    point inside it."""
+    current_district = locator.locate(lat, lng)
+    return selection_cache.get("selected_district", tuple(current_district['district']), [locator],
+                               lambda: current_district)
+
+
+def unit_farms(hierarchy, level, units):
+    """Farms in the `units` (positions) of `level`."""
+    return selection_cache.get("selected_farms", (level, tuple(units)), [hierarchy],
+                               lambda: hierarchy.farms_in(level, units))
+
+
+def nearest_cws(locator, lat, lng):
+    """Row of the station nearest to (`lat`, `lng`), the same row for every
+    point closest to it; None if there are no stations."""
+    nearest = locator.position(lat, lng)
+    if nearest is None:
+        return None
+    cws = locator.data_cws
+    return selection_cache.get("selected_cws", cws['cws_id'].iloc[nearest], [cws], lambda: cws.iloc[[nearest]])
+
+
+def cws_members(data_farmers, data_farms, cws_id):
+    """(farmers, farms) of the station `cws_id`."""
+    def members():
+        cws_farmers = data_farmers[data_farmers['farmer_cws'] == cws_id]
+        return cws_farmers, data_farms[data_farms['national_id'].isin(cws_farmers['national_id'].unique())]
+    return selection_cache.get("selected_cws_members", cws_id, [data_farmers, data_farms], members)
+
+
+def district_farmers(data_farmers, district):
+    return selection_cache.get("district_farmers", district, [data_farmers],
+                               lambda: data_farmers[data_farmers['district'] == district])
+
+
+def selection_farmers(selection, data_farmers, data_farms, hierarchy):
+    """Farmers of `selection`: those of the district or station, the owners of
+    the farms of a sector or cell (farmers are not recorded per sector or
+    cell), or all of them."""
+    if selection == ALL:
+        return data_farmers
+    if selection[0] == 'cws':
+        return cws_members(data_farmers, data_farms, selection[1])[0]
+    level, units = selection
+    if level == 'district':
+        names = tuple(hierarchy.units(level, units)[level])
+        return selection_cache.get("district_farmers", names, [data_farmers],
+                                   lambda: data_farmers[data_farmers['district'].isin(names)])
+    return selection_cache.get(
+        "unit_farmers", selection, [data_farmers, hierarchy],
+        lambda: data_farmers[data_farmers['national_id'].isin(unit_farms(hierarchy, level, units)['national_id'])])
+
+
+def farm_totals(selection, months, kpis, hierarchy):
+    """Farm count and area of `selection` over `months` (start, end), with
+    the totals before the last month (see `MonthlyTotals.total_with_change`)."""
+    def totals():
+        if selection == ALL:
+            return kpis.farms.total_with_change(None, *months)
+        if selection[0] == 'cws':
+            return kpis.farms_by_cws.total_with_change([selection[1]], *months)
+        level, units = selection
+        return hierarchy.totals[level].total_with_change(list(units), *months)
+    return selection_cache.get("farm_totals", (selection, months), [kpis, hierarchy], totals)
+
+
+def farmer_totals(selection, months, kpis, data_farmers, data_farms, hierarchy):
+    """Farmer counts (see `Demographics`) of `selection` over `months`, with
+    the totals before the last month; sectors and cells count the farmers
+    `selection_farmers` gives them."""
+    demographics = kpis.demographics
+
+    def totals():
+        if selection == ALL:
+            return demographics.total_with_change(None, None, *months)
+        if selection[0] == 'cws':
+            return demographics.total_with_change('cws', [selection[1]], *months)
+        level, units = selection
+        if level == 'district':
+            return demographics.total_with_change('district', hierarchy.units(level, units)[level], *months)
+        farmers = selection_farmers(selection, data_farmers, data_farms, hierarchy)
+        return demographics.farmers_total_with_change(farmers['national_id'], *months)
+    return selection_cache.get("farmer_totals", (selection, months), [kpis, data_farmers, hierarchy], totals)
+
+
+# Chart data of a selection, from its farms or farmers
+#------------------------------------------------------
+def coffee_trees_data(selection, data_farms):
+    """Coffee trees per age range of the farms `data_farms` of `selection`."""
+    return selection_cache.get(
+        "coffee_trees_data", selection, [data_farms],
+        lambda: data_farms.groupby('age_range_coffee_trees')['nbr_coffee_trees'].sum().reset_index())
+
+
+def training_topics_data(selection, data_farmers):
+    """Farmers per training topic ('topic', 'count'), most frequent first, of
+    the farmers `data_farmers` of `selection`."""
+    def topics():
+        data = (
+            data_farmers['training_topics']
+            .str.split(' ')
+            .explode()
+            .value_counts()
+            .reset_index()
+        )
+        # Rename columns for clarity
+        data.columns = ['topic', 'count']
+        return data.sort_values('count', ascending=False)
+    return selection_cache.get("training_topics_data", selection, [data_farmers], topics)
@@ -0,0 +1,151 @@
+"""Streaming exports of the current selection as CSV, GeoJSON or GeoParquet.
+
+Each format is written `CHUNKSIZE` rows at a time by a generator of bytes, so
+an export never holds more than one encoded chunk (plus, for GeoParquet, the
+row group being written). `stream` runs such a generator on a worker thread
+one chunk at a time, which keeps the Shiny event loop free while a large
+selection downloads:
+
+    @render.download(filename=...)
+    async def export_farms():
+        async for chunk in stream(export_chunks(farms, "csv")):
+            yield chunk
+"""
+import asyncio
+import io
+import json
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from coffee_core.ingest import _geo_metadata
+
+CHUNKSIZE = 10_000
+
+# format: (label, media type, file extension)
+EXPORT_FORMATS = {
+    'csv': ("CSV", "text/csv", "csv"),
+    'geojson': ("GeoJSON", "application/geo+json", "geojson"),
+    'parquet': ("GeoParquet", "application/vnd.apache.parquet", "parquet"),
+}
+
+
+def file_stem(kind, selection):
+    return re.sub(r"[^\w-]+", "_", f"{kind}_{selection}".lower()).strip("_")
+
+
+def export_filename(kind, selection, fmt):
+    """File name such as ``farms_district_20.csv``."""
+    return f"{file_stem(kind, selection)}.{EXPORT_FORMATS[fmt][2]}"
+
+
+def export_media_type(fmt):
+    return EXPORT_FORMATS[fmt][1]
+
+
+def _geometry_column(frame):
+    return frame.geometry.name if "geometry" in frame.columns else None
+
+
+def _csv_chunks(frame, chunksize):
+    geometry = _geometry_column(frame)
+    for start in range(0, max(len(frame), 1), chunksize):
+        chunk = pd.DataFrame(frame.iloc[start:start + chunksize])
+        if geometry is not None:
+            chunk[geometry] = shapely.to_wkt(chunk[geometry].values)
+        yield chunk.to_csv(index=False, header=start == 0).encode()
+
+
+def _geojson_chunks(frame, chunksize):
+    geometry = _geometry_column(frame)
+    properties = frame.drop(columns=geometry) if geometry is not None else frame
+    yield b'{"type": "FeatureCollection", "features": ['
+    for start in range(0, len(frame), chunksize):
+        end = start + chunksize
+        records = json.loads(properties.iloc[start:end].to_json(orient="records", date_format="iso"))
+        if geometry is not None:
+            geometries = shapely.to_geojson(frame[geometry].values[start:end])
+        else:
+            geometries = [None] * len(records)
+        features = ", ".join(
+            f'{{"type": "Feature", "properties": {json.dumps(p)}, "geometry": {g or "null"}}}'
+            for p, g in zip(records, geometries)
+        )
+        yield (", " if start else "").encode() + features.encode()
+    yield b"]}"
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last `drain`."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _to_arrow(chunk, geometry, schema=None):
+    df = pd.DataFrame(chunk)
+    if geometry is not None:
+        df[geometry] = shapely.to_wkb(chunk[geometry].values)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table if schema is None else table.cast(schema)
+
+
+def _parquet_chunks(frame, chunksize):
+    geometry = _geometry_column(frame)
+    sink, writer = _Sink(), None
+    for start in range(0, max(len(frame), 1), chunksize):
+        table = _to_arrow(frame.iloc[start:start + chunksize], geometry, writer and writer.schema)
+        if writer is None:
+            # columns that are empty in the first chunk are written as text
+            schema = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                                for f in table.schema])
+            if geometry is not None:
+                metadata = _geo_metadata(frame.crs)
+                metadata["primary_column"] = geometry
+                metadata["columns"] = {geometry: metadata["columns"]["geometry"]}
+                metadata["columns"][geometry]["geometry_types"] = sorted(frame.geom_type.dropna().unique())
+                schema = schema.with_metadata({**(schema.metadata or {}), b"geo": json.dumps(metadata).encode()})
+            table = table.cast(schema)
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+_WRITERS = {'csv': _csv_chunks, 'geojson': _geojson_chunks, 'parquet': _parquet_chunks}
+
+
+def export_chunks(frame, fmt, chunksize=CHUNKSIZE):
+    """Bytes of `frame` in format `fmt`, one chunk of rows at a time."""
+    return _WRITERS[fmt](frame, chunksize)
+
+
+async def stream(chunks):
+    """Iterate the blocking generator `chunks` on a worker thread."""
+    chunks = iter(chunks)
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,101 @@
+"""Hexagonal density grid of the farms, for the zoomed-out farms maps.
+
+Farm centroids are binned into pointy-top hexagons laid out in the projected
+CRS used for the farm areas, at a few sizes (one per zoom band in
+`HEX_LEVELS`). For every level, the hexagons holding farms are kept with
+their farm count, summed `area` and summed `nbr_coffee_trees`, their outline
+in EPSG:4326 and a fill colour from the count quantiles, all computed once
+per data refresh. The maps then only filter the precomputed hexagons to the
+viewport.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from coffee_core.ingest import AREA_CRS
+
+# (lowest zoom, hexagon size in m, centre to corner); the maps switch to the
+# farm points themselves from `viewport.MIN_ZOOM` on
+HEX_LEVELS = [(0, 12_000), (8, 5_000), (9, 2_000)]
+DENSITY_COLORS = ["#edf8e9", "#bae4b3", "#74c476", "#31a354", "#006d2c"]
+SQRT3 = np.sqrt(3)
+
+
+def hex_cells(x, y, size):
+    """Axial (q, r) of the hexagons of `size` holding the points (x, y)."""
+    q = (SQRT3 / 3 * x - y / 3) / size
+    r = 2 / 3 * y / size
+    # round the cube coordinates (q, -q-r, r), fixing the one that moved most
+    rq, rr, rs = np.round(q), np.round(r), np.round(-q - r)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs + q + r)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def hex_polygons(q, r, size):
+    """Outlines of the hexagons (q, r) of `size`, in the projected CRS."""
+    cx = size * SQRT3 * (q + r / 2)
+    cy = size * 1.5 * r
+    angles = np.radians(30 + 60 * np.arange(7))
+    xs = cx[:, None] + size * np.cos(angles)[None, :]
+    ys = cy[:, None] + size * np.sin(angles)[None, :]
+    return shapely.polygons(np.stack([xs, ys], axis=-1))
+
+
+class FarmHexbins:
+    """Farm density hexagons at every level of `levels`."""
+
+    def __init__(self, data_farms, levels=HEX_LEVELS):
+        self.levels = list(levels)
+        farms = data_farms.geometry.to_crs(AREA_CRS)
+        x, y = farms.x.to_numpy(), farms.y.to_numpy()
+        values = pd.DataFrame({
+            "farms": 1,
+            "area": data_farms["area"].to_numpy(),
+            "trees": pd.to_numeric(data_farms["nbr_coffee_trees"], errors="coerce").to_numpy(),
+        }).fillna(0)
+        to_wgs84 = Transformer.from_crs(AREA_CRS, "EPSG:4326", always_xy=True)
+
+        self._features, self._bounds = [], []
+        for _, size in self.levels:
+            q, r = hex_cells(x, y, size)
+            cells = values.groupby([q, r]).sum()
+            q, r = (cells.index.get_level_values(i).to_numpy() for i in (0, 1))
+            outlines = shapely.transform(hex_polygons(q, r, size),
+                                         lambda xy: np.column_stack(to_wgs84.transform(xy[:, 0], xy[:, 1])))
+            # five classes of farm counts, darker for denser hexagons
+            breaks = np.quantile(cells["farms"], [0.2, 0.4, 0.6, 0.8]) if len(cells) else []
+            classes = np.searchsorted(breaks, cells["farms"].to_numpy(), side="right")
+            self._bounds.append(shapely.bounds(outlines))
+            self._features.append([
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Polygon", "coordinates": [shapely.get_coordinates(outline).tolist()]},
+                    "properties": {
+                        "farms": int(farms_count),
+                        "area": round(float(area), 1),
+                        "trees": int(trees),
+                        "style": {"color": DENSITY_COLORS[c], "fillColor": DENSITY_COLORS[c],
+                                  "weight": 0.5, "fillOpacity": 0.6},
+                    },
+                }
+                for outline, farms_count, area, trees, c in zip(
+                    outlines, cells["farms"], cells["area"], cells["trees"], classes)
+            ])
+
+    def level_for(self, zoom):
+        """Index of the level shown at `zoom`."""
+        return max((i for i, (min_zoom, _) in enumerate(self.levels) if zoom >= min_zoom), default=0)
+
+    def to_geojson(self, zoom, bounds):
+        """Hexagons of the level for `zoom` overlapping ((south, west), (north, east))."""
+        level = self.level_for(zoom)
+        (south, west), (north, east) = bounds
+        minx, miny, maxx, maxy = self._bounds[level].T
+        idx = np.flatnonzero((maxx >= west) & (minx <= east) & (maxy >= south) & (miny <= north))
+        features = self._features[level]
+        return {"type": "FeatureCollection", "features": [features[i] for i in idx]}
@@ -0,0 +1,260 @@
+"""Chunked ingest of farm CSV exports into a columnar (GeoParquet) cache.
+
+National exports are far larger than the sample in ``data/``, so instead of
+reading the whole CSV before parsing the WKT, the export is streamed
+`chunksize` rows at a time: each chunk is parsed, validated, projected to
+compute areas, reduced to centroids and appended to the cache, while running
+aggregates are kept. Peak memory is bounded by the chunk size, plus the
+centroid and polygon bounds of each farm (48 bytes a farm) kept for the
+spatial index written at the end (see `coffee_core.rtree`).
+
+    python -m coffee_core.ingest data/Coffee_farms.csv
+
+`load_data` in both apps reads the cache instead of the CSV whenever it is
+newer than the export, and the dashboards' bounding-box queries read the
+index, memory-mapped, as long as it was written with that cache.
+"""
+import json
+import os
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS
+
+from coffee_core.refresh import read_appended_csv
+from coffee_core.rtree import PackedRTree, write_rtree
+
+CHUNKSIZE = 50_000
+CACHE_DIR = "cache"
+AREA_CRS = "EPSG:32736"  # UTM zone 36S, used to compute farm areas
+# unit of the `area` column, recorded in the cache; caches without it (or
+# with another unit) are ignored and must be rebuilt
+AREA_UNIT = "ha"
+
+# Columns the dashboards compute with; everything else is kept as text so
+# every chunk has the same schema whatever values it happens to contain.
+INTEGER_COLUMNS = ["national_id", "nbr_coffee_trees", "day", "year"]
+FLOAT_COLUMNS = ["area_ares", "nbr_young_coffee_trees", "nbr_shade_trees"]
+
+
+def cache_path(csv_path):
+    csv_path = Path(csv_path)
+    return csv_path.parent / CACHE_DIR / f"{csv_path.stem}.parquet"
+
+
+def summary_path(cached):
+    return Path(cached).with_suffix(".summary.json")
+
+
+def index_path(cached):
+    return Path(cached).with_suffix(".rtree")
+
+
+# size and mtime of the cache, recorded in the index written with it
+def _stamp(cached):
+    stat = Path(cached).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def prepare_chunk(chunk):
+    """Parse, validate and project one chunk of the farms export.
+
+    Returns the farms as centroids in EPSG:4326 with their `area` (in
+    hectares, as computed by `load_farms`) and the number of rows dropped.
+    """
+    farms, n_invalid, _ = _prepare_chunk(chunk)
+    return farms, n_invalid
+
+
+# `prepare_chunk`, plus the bounds of the farms' polygons (EPSG:4326)
+def _prepare_chunk(chunk):
+    chunk.columns = chunk.columns.str.lower()
+    for col in INTEGER_COLUMNS:
+        if col in chunk.columns:
+            chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("Int64")
+    for col in FLOAT_COLUMNS:
+        if col in chunk.columns:
+            chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("float64")
+
+    # filter out farms with missing or invalid WKT strings
+    wkt_strings = chunk["geom"].where(chunk["geom"].notna(), None).to_numpy(dtype=object)
+    geometry = shapely.from_wkt(wkt_strings, on_invalid="ignore")
+    valid = ~shapely.is_missing(geometry)
+    chunk = chunk.loc[valid].drop(columns="geom")
+    bounds = shapely.bounds(geometry[valid])
+
+    # project to UTM for the area calculation, then keep centroids in WGS84
+    farms = gpd.GeoDataFrame(chunk, geometry=geometry[valid], crs="EPSG:4326").to_crs(AREA_CRS)
+    farms["area"] = farms.area / 10_000
+    farms["geometry"] = farms.geometry.centroid
+    farms = farms.to_crs(epsg=4326)
+    return farms, int((~valid).sum()), bounds
+
+
+def _geo_metadata(crs):
+    return {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Point"],
+                "crs": CRS.from_user_input(crs).to_json_dict(),
+            }
+        },
+    }
+
+
+def _to_arrow(farms, schema=None):
+    df = pd.DataFrame(farms.drop(columns="geometry"))
+    df["geometry"] = shapely.to_wkb(farms.geometry.values)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if schema is not None:
+        table = table.cast(schema)
+    return table
+
+
+class RunningTotals:
+    def __init__(self):
+        self.rows_read = 0
+        self.rows_invalid_geometry = 0
+        self.farms = 0
+        self.total_area = 0.0
+        self.total_trees = 0.0
+        self.trees_by_age_range = {}
+
+    def add(self, farms, n_read, n_invalid):
+        self.rows_read += n_read
+        self.rows_invalid_geometry += n_invalid
+        self.farms += len(farms)
+        self.total_area += float(farms["area"].sum())
+        self.total_trees += float(farms["nbr_coffee_trees"].sum())
+        for age_range, trees in farms.groupby("age_range_coffee_trees")["nbr_coffee_trees"].sum().items():
+            self.trees_by_age_range[age_range] = self.trees_by_age_range.get(age_range, 0.0) + float(trees)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def print_progress(bytes_done, bytes_total, totals):
+    pct = 100 * bytes_done / bytes_total if bytes_total else 100
+    print(f"\r{pct:5.1f}%  {totals.rows_read:,} rows read, {totals.farms:,} farms kept",
+          end="", file=sys.stderr, flush=True)
+
+
+def ingest_farms(csv_path, out_path=None, chunksize=CHUNKSIZE, progress=print_progress, index=True):
+    """Stream `csv_path` into the GeoParquet cache (and, with `index`, write
+    its spatial index) and return the aggregates."""
+    csv_path = Path(csv_path)
+    out_path = Path(out_path) if out_path else cache_path(csv_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_suffix(".parquet.tmp")
+    bytes_total = csv_path.stat().st_size
+
+    totals = RunningTotals()
+    writer = None
+    points, bounds = [], []
+    try:
+        with open(csv_path, "rb") as f:
+            reader = pd.read_csv(f, chunksize=chunksize, dtype=str, keep_default_na=True)
+            for chunk in reader:
+                n_read = len(chunk)
+                farms, n_invalid, farm_bounds = _prepare_chunk(chunk)
+                totals.add(farms, n_read, n_invalid)
+                if index:
+                    points.append(np.column_stack([farms.geometry.x, farms.geometry.y]))
+                    bounds.append(farm_bounds)
+                if writer is None:
+                    table = _to_arrow(farms)
+                    metadata = dict(table.schema.metadata or {})
+                    metadata[b"geo"] = json.dumps(_geo_metadata(farms.crs)).encode()
+                    metadata[b"area_unit"] = AREA_UNIT.encode()
+                    schema = table.schema.with_metadata(metadata)
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                    table = table.cast(schema)
+                else:
+                    table = _to_arrow(farms, schema)
+                writer.write_table(table)
+                if progress is not None:
+                    progress(f.tell(), bytes_total, totals)
+    finally:
+        if writer is not None:
+            writer.close()
+    if progress is not None:
+        print(file=sys.stderr)
+
+    if writer is None:
+        raise ValueError(f"{csv_path} has no rows to ingest")
+    # swap the finished file in so readers never see a half-written cache
+    os.replace(tmp_path, out_path)
+    if index and totals.farms:
+        tmp_index = index_path(out_path).with_suffix(".rtree.tmp")
+        write_rtree(tmp_index, np.concatenate(points), np.concatenate(bounds), {"cache": _stamp(out_path)})
+        os.replace(tmp_index, index_path(out_path))
+    summary = totals.as_dict()
+    summary_path(out_path).write_text(json.dumps(summary, indent=2))
+    return summary
+
+
+# True if `cached` exists, is newer than `csv_path` and has its areas in `AREA_UNIT`
+def _is_current(cached, csv_path):
+    if not cached.exists() or cached.stat().st_mtime < csv_path.stat().st_mtime:
+        return False
+    return (pq.read_schema(cached).metadata or {}).get(b"area_unit") == AREA_UNIT.encode()
+
+
+def read_farms_cache(csv_path):
+    """Return the cached farms for `csv_path`, or None if the cache is missing,
+    older than the CSV or written with another `AREA_UNIT`."""
+    csv_path = Path(csv_path)
+    cached = cache_path(csv_path)
+    if not _is_current(cached, csv_path):
+        return None
+    return restore_integer_dtypes(gpd.read_parquet(cached))
+
+
+def read_farms_index(csv_path):
+    """Return the spatial index of the cached farms for `csv_path`, memory-
+    mapped, or None if it is missing or was not written with the cache
+    `read_farms_cache` reads."""
+    csv_path = Path(csv_path)
+    cached, indexed = cache_path(csv_path), index_path(cache_path(csv_path))
+    if not indexed.exists() or not _is_current(cached, csv_path):
+        return None
+    tree = PackedRTree(indexed)
+    return tree if tree.header.get("cache") == _stamp(cached) else None
+
+
+# use the numpy dtypes the in-memory CSV parse produces where there are no gaps
+def restore_integer_dtypes(farms):
+    for col in INTEGER_COLUMNS:
+        if col in farms.columns and not farms[col].isna().any():
+            farms[col] = farms[col].astype(np.int64)
+    return farms
+
+
+def append_farms(data_farms, csv_path, offset):
+    """Return `data_farms` plus the farms appended to `csv_path` after `offset` bytes."""
+    new_rows = read_appended_csv(csv_path, offset, dtype=str, keep_default_na=True)
+    if new_rows.empty:
+        return data_farms
+    farms, _ = prepare_chunk(new_rows)
+    return restore_integer_dtypes(pd.concat([data_farms, farms], ignore_index=True))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest a farms CSV export into the columnar cache")
+    parser.add_argument("csv_path")
+    parser.add_argument("--out", help=f"cache file (default: <csv dir>/{CACHE_DIR}/<name>.parquet)")
+    parser.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    parser.add_argument("--no-index", action="store_true", help="do not write the spatial index")
+    args = parser.parse_args()
+    print(json.dumps(ingest_farms(args.csv_path, args.out, args.chunksize, index=not args.no_index), indent=2))
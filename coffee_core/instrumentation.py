@@ -0,0 +1,221 @@
+"""Opt-in timing instrumentation for the dashboards' reactives.
+
+Set ``DASHBOARD_INSTRUMENT=1`` before starting an app to record, for every
+wrapped ``reactive.Calc``, ``reactive.Effect`` and render function (downloads
+included), its call count, wall time and payload size. When disabled,
+``instrument`` returns the function untouched, so there is no overhead.
+
+The numbers are exposed in a hidden diagnostics panel (toggle with
+Ctrl+Shift+D) and, for local clients only, at:
+
+    /diagnostics/metrics.json   JSON snapshot
+    /diagnostics/metrics        Prometheus text format
+"""
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+ENABLED = os.environ.get("DASHBOARD_INSTRUMENT", "").lower() in ("1", "true", "yes")
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+# estimate how many bytes a reactive result puts on the wire or holds in memory
+def payload_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(payload_size(v) for v in value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=False))
+    if hasattr(value, "to_plotly_json"):
+        return len(value.to_json())
+    if hasattr(value, "get_state"):
+        return len(json.dumps(value.get_state(), default=str))
+    return sys.getsizeof(value)
+
+
+def record(name, seconds, value=None, size=None):
+    size = payload_size(value) if size is None else size
+    with _lock:
+        m = _metrics.setdefault(name, {
+            "calls": 0, "total_s": 0.0, "max_s": 0.0, "last_s": 0.0,
+            "last_payload_bytes": 0, "total_payload_bytes": 0,
+        })
+        m["calls"] += 1
+        m["total_s"] += seconds
+        m["max_s"] = max(m["max_s"], seconds)
+        m["last_s"] = seconds
+        m["last_payload_bytes"] = size
+        m["total_payload_bytes"] += size
+
+
+def instrument(name=None):
+    """Decorator recording wall time, call count and payload size of `fn`.
+
+    Place it innermost, directly above the function, so Shiny's decorators see
+    the wrapped function (its ``__name__`` is preserved).
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        label = name or fn.__name__
+
+        # streamed downloads: timed until the last chunk, sized by the chunks
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def async_gen_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                size = 0
+                try:
+                    async for chunk in fn(*args, **kwargs):
+                        size += payload_size(chunk)
+                        yield chunk
+                finally:
+                    record(label, time.perf_counter() - start, size=size)
+            return async_gen_wrapper
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                value = None
+                try:
+                    value = await fn(*args, **kwargs)
+                    return value
+                finally:
+                    record(label, time.perf_counter() - start, value)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            value = None
+            try:
+                value = fn(*args, **kwargs)
+                return value
+            finally:
+                record(label, time.perf_counter() - start, value)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        rows = {name: dict(m) for name, m in _metrics.items()}
+    for m in rows.values():
+        m["mean_s"] = m["total_s"] / m["calls"] if m["calls"] else 0.0
+    return rows
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def to_prometheus(rows):
+    series = [
+        ("dashboard_reactive_calls_total", "counter", "calls", "Number of executions"),
+        ("dashboard_reactive_seconds_total", "counter", "total_s", "Total wall time in seconds"),
+        ("dashboard_reactive_seconds_max", "gauge", "max_s", "Slowest execution in seconds"),
+        ("dashboard_reactive_seconds_last", "gauge", "last_s", "Latest execution in seconds"),
+        ("dashboard_reactive_payload_bytes_last", "gauge", "last_payload_bytes", "Payload size of the latest result"),
+        ("dashboard_reactive_payload_bytes_total", "counter", "total_payload_bytes", "Payload bytes produced"),
+    ]
+    lines = []
+    for metric, kind, key, help_text in series:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, m in sorted(rows.items()):
+            lines.append(f'{metric}{{name="{name}"}} {m[key]}')
+    return "\n".join(lines) + "\n"
+
+
+# Shiny UI/server pieces for the hidden diagnostics panel
+#---------------------------------------------------------
+def diagnostics_panel():
+    from shiny import ui
+
+    if not ENABLED:
+        return None
+    return ui.TagList(
+        ui.panel_conditional(
+            "input.show_diagnostics % 2 == 1",
+            ui.card(
+                ui.card_header("Diagnostics"),
+                ui.output_table("diagnostics_table"),
+            ),
+        ),
+        ui.tags.script("""
+            var diagnosticsToggles = 0;
+            $(document).on('keydown', function(e) {
+                if (e.ctrlKey && e.shiftKey && (e.key === 'D' || e.key === 'd')) {
+                    Shiny.setInputValue('show_diagnostics', ++diagnosticsToggles);
+                }
+            });
+        """),
+    )
+
+
+def register_diagnostics(input, output, session, refresh_secs=2):
+    from shiny import reactive, render
+
+    if not ENABLED:
+        return
+
+    @output
+    @render.table
+    def diagnostics_table():
+        reactive.invalidate_later(refresh_secs)
+        rows = snapshot()
+        table = pd.DataFrame.from_dict(rows, orient="index")
+        if table.empty:
+            return table
+        table = table[["calls", "mean_s", "max_s", "last_s", "total_s", "last_payload_bytes"]]
+        return table.sort_values("total_s", ascending=False).reset_index(names="reactive")
+
+
+# ASGI wrapper serving the metrics endpoints beside the Shiny app
+#-----------------------------------------------------------------
+def local_only(endpoint):
+    """Starlette `endpoint` answering 403 to clients not on this machine."""
+    from starlette.responses import PlainTextResponse
+
+    async def guarded(request, *args):
+        if request.client is None or request.client.host not in LOCAL_HOSTS:
+            return PlainTextResponse("Forbidden", status_code=403)
+        return await endpoint(request, *args)
+    return guarded
+
+
+def with_metrics_routes(app):
+    if not ENABLED:
+        return app
+
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, PlainTextResponse
+    from starlette.routing import Mount, Route
+
+    async def metrics_json(request):
+        return JSONResponse(snapshot())
+
+    async def metrics_text(request):
+        return PlainTextResponse(to_prometheus(snapshot()), media_type="text/plain; version=0.0.4")
+
+    return Starlette(routes=[
+        Route("/diagnostics/metrics.json", local_only(metrics_json)),
+        Route("/diagnostics/metrics", local_only(metrics_text)),
+        Mount("/", app=app),
+    ])
@@ -0,0 +1,35 @@
+"""Point-in-polygon lookups for map clicks.
+
+`PointLocator` indexes a boundary layer (districts, sectors or cells)
+once: its polygons are prepared and put in an STR-tree, so finding the
+polygon under a clicked lat/lng is a tree query plus a prepared
+`intersects` test instead of a spatial join against a new GeoDataFrame.
+"""
+import numpy as np
+import shapely
+
+
+class PointLocator:
+    """Finds the rows of `polygons` (EPSG:4326) under a point."""
+
+    def __init__(self, polygons):
+        self.polygons = polygons
+        geometries = np.asarray(polygons.geometry.values)
+        shapely.prepare(geometries)
+        self.tree = shapely.STRtree(geometries)
+
+    # positions of the polygons intersecting the point
+    def positions(self, lat, lng):
+        return np.sort(self.tree.query(shapely.Point(lng, lat), predicate="intersects"))
+
+    def locate(self, lat, lng):
+        """Rows of the polygons under (`lat`, `lng`), empty if there are none."""
+        return self.polygons.iloc[self.positions(lat, lng)]
+
+    def locate_many(self, lats, lngs):
+        """Position of a polygon under each point, -1 where there is none."""
+        points = shapely.points(np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float))
+        point_idx, polygon_idx = self.tree.query(points, predicate="intersects")
+        result = np.full(len(points), -1)
+        result[point_idx] = polygon_idx
+        return result
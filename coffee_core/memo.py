@@ -0,0 +1,72 @@
+"""Process-wide memoization of what is computed for a map selection.
+
+A click is turned into the identity of what it selects (a district name, a
+`cws_id`, a sector or cell) as early as possible, and the results computed for
+that selection (its rows, area sums, chart data) are cached under it, so
+clicking back and forth between two districts, or anywhere inside the same
+one, does the work once for all sessions. The cache is an LRU of at most
+`CACHE_SIZE` entries, each kept for `CACHE_TTL_SECS`.
+
+Entries are also keyed on the tables they were computed from, which keeps a
+data refresh from serving stale results:
+
+    farms = selection_cache.get("selected_farms", ("district", name), [admin()],
+                                lambda: admin().farms_in(...))
+
+Cached values are shared, so callers must not modify them.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.environ.get("DASHBOARD_CACHE_SIZE", 256))  # 0 disables the cache
+CACHE_TTL_SECS = float(os.environ.get("DASHBOARD_CACHE_TTL_SECS", 600))
+
+
+class SelectionCache:
+    """LRU cache with a time to live, safe to share between sessions."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl_secs=CACHE_TTL_SECS):
+        self.maxsize = maxsize
+        self.ttl_secs = ttl_secs
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, stage, identity, sources, compute):
+        """`compute()` for the selection `identity` at `stage`, cached.
+
+        `sources` are the tables (or derived objects) `compute` reads. The
+        entry holds on to them, so their ids cannot be reused by the tables
+        of a later refresh while it is cached.
+        """
+        if self.maxsize <= 0:
+            return compute()
+        sources = tuple(sources)
+        key = (stage, identity, tuple(map(id, sources)))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        # computed outside the lock: two sessions missing at once both compute
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now + self.ttl_secs, sources, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,81 @@
+"""Shared executor for the expensive steps behind the dashboards' outputs.
+
+Spatial lookups, geodesic scans, group-bys and the plotly/folium builds run
+on a thread pool shared by all sessions (`OFFLOAD_WORKERS` threads, 0 to run
+them inline), so the event loop keeps serving the other sessions meanwhile.
+Outputs read their reactive inputs first and then await the work:
+
+    @render.ui
+    async def chart():
+        farms = selected_farms()
+        return ui.HTML(await offload(build_chart_html, farms))
+
+Calcs read by many outputs are declared with `offloaded_calc` instead: their
+work runs as a Shiny extended task, a new invocation drops the one still in
+flight, and outputs reading the calc show as recalculating until the latest
+result resolves.
+
+Only plain data may cross to the executor: the work must not call reactives.
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from shiny import reactive
+
+from coffee_core.instrumentation import instrument
+
+OFFLOAD_WORKERS = int(os.environ.get("DASHBOARD_OFFLOAD_WORKERS", 4))
+
+_executor = None
+_lock = threading.Lock()
+
+
+def executor():
+    """The process-wide pool, started on first use."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(OFFLOAD_WORKERS, thread_name_prefix="offload")
+    return _executor
+
+
+async def offload(fn, *args, **kwargs):
+    """Run `fn(*args, **kwargs)` on the shared executor and await its result."""
+    if OFFLOAD_WORKERS <= 0:
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), functools.partial(fn, *args, **kwargs))
+
+
+def offloaded_calc(prepare):
+    """Decorator for a calc whose work runs on the executor.
+
+    `prepare()` runs as a reactive effect in the session: it reads the
+    reactive inputs and returns a function of no arguments doing the actual
+    work, or None when there is nothing to compute (the calc then gives
+    None). That function runs as an extended task on the executor; when the
+    inputs change before it is done, its result is dropped (the thread still
+    finishes it) and only the latest one is computed on. The returned calc
+    gives the latest result.
+    """
+    run = instrument(f"{prepare.__name__}[offloaded]")
+
+    @reactive.extended_task
+    async def task(job):
+        if job is None:
+            return None
+        return await offload(run(job))
+
+    @reactive.Effect(priority=100)
+    def _():
+        job = prepare()
+        task.cancel()
+        task.invoke(job)
+
+    @reactive.Calc
+    def result():
+        return task.result()
+    return result
@@ -0,0 +1,360 @@
+"""Compact binary encoding of the map layers sent to the Folium maps.
+
+With ``DASHBOARD_PACKED_LAYERS=1`` the boundary, station and farm layers of
+the Folium maps (and the farms sent for the viewport in lazy farms mode) are
+not embedded as GeoJSON text but packed:
+
+- coordinates are quantized to `PRECISION` decimals (5, about 1 m) and
+  delta-encoded, as little-endian int32;
+- the geometries are described by their offset arrays (the GeoArrow layout
+  of `shapely.to_ragged_array`), the properties by one JSON list;
+- the whole is deflated and base64-encoded.
+
+`UNPACK_JS` defines ``unpackLayer(packed)`` in the map's page; it returns a
+promise of the GeoJSON FeatureCollection (plain GeoJSON is passed through),
+whose features have the ids packed with them or, by default, their position
+in the layer. It decompresses with the browser's `DecompressionStream`.
+Other JSON can be sent deflated with `pack_json` and read back with
+``unpackJson(packed)``, and a selection of features as a bitmask with
+`pack_mask` (``unpackMask``).
+
+A layer mixing geometry types (points and polygons) cannot be packed and is
+sent as GeoJSON.
+"""
+import base64
+import json
+import os
+import zlib
+
+import folium
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from folium.map import Layer
+from folium.plugins import MarkerCluster
+from jinja2 import Template
+
+ENABLED = os.environ.get("DASHBOARD_PACKED_LAYERS", "").lower() in ("1", "true", "yes")
+# decimals kept of the coordinates; at most 6 so the deltas fit in int32
+PRECISION = min(int(os.environ.get("DASHBOARD_PACKED_PRECISION", 5)), 6)
+
+GEOMETRY_TYPES = ["Point", "LineString", "LinearRing", "Polygon", "MultiPoint", "MultiLineString", "MultiPolygon"]
+
+
+def _features(data):
+    # (geometries, property records, feature ids or None) of a GeoDataFrame or
+    # FeatureCollection
+    if isinstance(data, gpd.GeoDataFrame):
+        properties = pd.DataFrame(data.drop(columns=data.geometry.name))
+        records = (json.loads(properties.to_json(orient="records", date_format="iso", double_precision=15))
+                   if len(properties.columns) else [{} for _ in range(len(data))])
+        return np.asarray(data.geometry.values, dtype=object), records, None
+    features = data["features"]
+    geometries = [None if f.get("geometry") is None else shapely.geometry.shape(f["geometry"]) for f in features]
+    ids = [f.get("id") for f in features]
+    return (np.array(geometries, dtype=object), [dict(f.get("properties") or {}) for f in features],
+            None if all(i is None for i in ids) else ids)
+
+
+def pack_features(geometries, records, precision=PRECISION, ids=None):
+    """Packed layer (a base64 string) of `geometries` with the properties
+    `records` (and the feature `ids`), or None if the geometries are of
+    several types."""
+    try:
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+    except ValueError:
+        return None
+    missing = np.flatnonzero(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    quantized = np.round(np.nan_to_num(coords) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).astype("<i4")
+
+    properties = None if all(not r for r in records) else records
+    header = json.dumps({
+        "type": GEOMETRY_TYPES[geometry_type],
+        "precision": precision,
+        "offsets": [len(o) for o in offsets],
+        "coordinates": len(coords),
+        "missing": missing.tolist(),
+        "properties": properties,
+        "ids": ids,
+    }, default=_json_default, allow_nan=False).encode()
+    header += b" " * (-len(header) % 4)  # keep the int32 arrays aligned
+    raw = b"".join([np.uint32(len(header)).astype("<u4").tobytes(), header]
+                   + [np.asarray(o).astype("<i4").tobytes() for o in offsets]
+                   + [deltas.tobytes()])
+    return base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+
+def pack(data, precision=PRECISION):
+    """`data` (a GeoDataFrame or FeatureCollection) packed, or as GeoJSON if
+    it cannot be; `unpackLayer` takes either."""
+    geometries, records, ids = _features(data)
+    packed = pack_features(geometries, records, precision, ids)
+    if packed is not None:
+        return packed
+    return data.__geo_interface__ if isinstance(data, gpd.GeoDataFrame) else data
+
+
+def pack_json(value):
+    """`value` as deflated, base64-encoded JSON, for `unpackJson`."""
+    return base64.b64encode(zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)).decode("ascii")
+
+
+def pack_mask(positions, n):
+    """The selection of the features at `positions` among `n` as a deflated,
+    base64-encoded bitmask (feature i is bit i % 8 of byte i // 8), for
+    `unpackMask`."""
+    mask = np.zeros(n, dtype=bool)
+    mask[np.asarray(positions, dtype=int)] = True
+    return base64.b64encode(zlib.compress(np.packbits(mask, bitorder="little").tobytes(), 6)).decode("ascii")
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+UNPACK_JS = """
+function inflatePacked(packed) {
+    var bytes = Uint8Array.from(atob(packed), function(c) { return c.charCodeAt(0); });
+    var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return new Response(stream).arrayBuffer();
+}
+function unpackJson(packed) {
+    return inflatePacked(packed).then(function(buffer) {
+        return JSON.parse(new TextDecoder().decode(buffer));
+    });
+}
+function unpackMask(packed) {
+    // a promise of the test of whether feature i is selected
+    return inflatePacked(packed).then(function(buffer) {
+        var bytes = new Uint8Array(buffer);
+        return function(i) { return i >= 0 && ((bytes[i >> 3] >> (i & 7)) & 1) === 1; };
+    });
+}
+function unpackLayer(packed) {
+    if (typeof packed !== 'string') {
+        return Promise.resolve(packed);
+    }
+    return inflatePacked(packed).then(function(buffer) {
+        var headerLength = new DataView(buffer).getUint32(0, true);
+        var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+        var position = 4 + headerLength;
+        var offsets = header.offsets.map(function(n) {
+            var values = new Int32Array(buffer, position, n);
+            position += 4 * n;
+            return values;
+        });
+        // undo the deltas and the quantization
+        var deltas = new Int32Array(buffer, position, 2 * header.coordinates);
+        var scale = Math.pow(10, header.precision), xy = new Float64Array(deltas.length), x = 0, y = 0;
+        for (var i = 0; i < header.coordinates; i++) {
+            x += deltas[2 * i];
+            y += deltas[2 * i + 1];
+            xy[2 * i] = x / scale;
+            xy[2 * i + 1] = y / scale;
+        }
+        function nest(depth, lo, hi) {
+            var parts = [];
+            for (var k = lo; k < hi; k++) {
+                parts.push(depth === 0 ? [xy[2 * k], xy[2 * k + 1]]
+                                       : nest(depth - 1, offsets[depth - 1][k], offsets[depth - 1][k + 1]));
+            }
+            return parts;
+        }
+        var depth = offsets.length, missing = new Set(header.missing), features = [];
+        var n = depth ? offsets[depth - 1].length - 1 : header.coordinates;
+        for (var j = 0; j < n; j++) {
+            var coordinates = depth ? nest(depth - 1, offsets[depth - 1][j], offsets[depth - 1][j + 1])
+                                    : [xy[2 * j], xy[2 * j + 1]];
+            features.push({
+                type: 'Feature',
+                id: header.ids ? header.ids[j] : j,
+                geometry: missing.has(j) ? null : {type: header.type, coordinates: coordinates},
+                properties: header.properties ? header.properties[j] : {}
+            });
+        }
+        return {type: 'FeatureCollection', features: features};
+    });
+}
+"""
+
+
+def add_decoder(m):
+    """Define `unpackLayer` (and `unpackJson`, `unpackMask`) in the page of the folium map `m`."""
+    m.get_root().header.add_child(folium.Element(f"<script>{UNPACK_JS}</script>"), name="unpack_layer")
+
+
+class PackedGeoJson(Layer):
+    """`folium.GeoJson` sending its data packed, for the options the
+    dashboard uses: `style_function`, a `GeoJsonTooltip` (its fields and
+    aliases) and a `CircleMarker` for points. Added to a `MarkerCluster`,
+    its points are clustered. ``<name>_ready`` is a promise of its features
+    being added."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_styles = {{ this.styles|tojson }};
+        var {{ this.get_name() }} = L.geoJson(null, {
+            style: function(feature) {
+                return {{ this.get_name() }}_styles[feature.properties._style || 0];
+            },
+            {%- if this.marker_options %}
+            pointToLayer: function(feature, latlng) {
+                return L.circleMarker(latlng, Object.assign({}, {{ this.marker_options|tojson }},
+                                                            {{ this.get_name() }}_styles[feature.properties._style || 0]));
+            },
+            {%- endif %}
+            {%- if this.tooltip_fields %}
+            onEachFeature: function(feature, layer) {
+                var aliases = {{ this.tooltip_aliases|tojson }};
+                layer.bindTooltip('<table>' + {{ this.tooltip_fields|tojson }}.map(function(field, i) {
+                    return '<tr><th>' + aliases[i] + '</th><td>' + feature.properties[field] + '</td></tr>';
+                }).join('') + '</table>', {sticky: true});
+            },
+            {%- endif %}
+        });
+        {%- if this.clustered %}
+        var {{ this.get_name() }}_ready = unpackLayer({{ this.packed|tojson }}).then(function(data) {
+            {{ this.get_name() }}.addData(data);
+            {{ this._parent.get_name() }}.addLayers({{ this.get_name() }}.getLayers());
+        });
+        {%- else %}
+        {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        var {{ this.get_name() }}_ready = unpackLayer({{ this.packed|tojson }}).then(function(data) {
+            {{ this.get_name() }}.addData(data);
+        });
+        {%- endif %}
+        {% endmacro %}
+        """)
+
+    def __init__(self, data, name=None, style_function=None, tooltip=None, marker=None,
+                 overlay=True, control=True, show=True, precision=PRECISION):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "PackedGeoJson"
+        geometries, records, _ = _features(data)
+        # the styles of the features, each given once
+        self.styles = [{}]
+        if style_function is not None:
+            keys = {}
+            for record in records:
+                style = style_function({"type": "Feature", "properties": record})
+                key = json.dumps(style, sort_keys=True, default=str)
+                if key not in keys:
+                    keys[key] = len(keys)
+                    self.styles.append(style)
+                record["_style"] = keys[key] + 1
+        self.marker_options = None if marker is None else marker.options
+        self.tooltip_fields = None if tooltip is None else list(tooltip.fields)
+        self.tooltip_aliases = None if tooltip is None else list(tooltip.aliases or tooltip.fields)
+        self.packed = pack_features(geometries, records, precision)
+        if self.packed is None:
+            self.packed = {"type": "FeatureCollection", "features": [
+                {"type": "Feature", "properties": record,
+                 "geometry": None if geometry is None else shapely.geometry.mapping(geometry)}
+                for geometry, record in zip(geometries, records)]}
+        self.clustered = False
+
+    def render(self, **kwargs):
+        self.clustered = isinstance(self._parent, MarkerCluster)
+        add_decoder(self.get_root())
+        super().render(**kwargs)
+
+
+class SelectedFeatures(Layer):
+    """The features of `layer` (a `folium.GeoJson` or `PackedGeoJson` of
+    points, with their positions as feature ids) selected in the browser,
+    drawn again as `marker` (a `CircleMarker`) above the map.
+
+    The selection is sent to the page in Shiny custom messages of type
+    `message`, ``{"mask": pack_mask(positions, n) or None}``: only the
+    bitmask is sent, the points are taken from `layer` wherever it is (in a
+    `MarkerCluster` too), and each message replaces the previous selection.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.featureGroup().addTo({{ this._parent.get_name() }});
+        var {{ this.get_name() }}_mask = null;
+        parent.Shiny.addCustomMessageHandler({{ this.message|tojson }}, function(msg) {
+            var mask = {{ this.get_name() }}_mask = msg.mask;
+            Promise.all([mask ? unpackMask(mask) : null, {{ this.ready }}]).then(function(results) {
+                // a later selection was sent meanwhile
+                if (mask !== {{ this.get_name() }}_mask) {
+                    return;
+                }
+                var selected = results[0];
+                {{ this.get_name() }}.clearLayers();
+                if (selected === null) {
+                    return;
+                }
+                {{ this.layer.get_name() }}.eachLayer(function(feature) {
+                    if (selected(Number(feature.feature.id))) {
+                        L.circleMarker(feature.getLatLng(), {{ this.marker_options|tojson }}).addTo({{ this.get_name() }});
+                    }
+                });
+            });
+        });
+        {% endmacro %}
+        """)
+
+    def __init__(self, layer, message, marker, name=None, overlay=True, control=False, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "SelectedFeatures"
+        self.layer = layer
+        self.message = message
+        self.marker_options = marker.options
+        self.ready = f"{layer.get_name()}_ready" if isinstance(layer, PackedGeoJson) else "Promise.resolve()"
+
+    def render(self, **kwargs):
+        add_decoder(self.get_root())
+        super().render(**kwargs)
+
+
+class SentGeoJson(Layer):
+    """A GeoJSON layer drawn from the data sent to the page in Shiny custom
+    messages of type `message`, ``{"layer": pack(data) or None}``; each
+    message replaces the features of the previous one. `style` is the style
+    of all the features, `tooltip_fields` the properties shown on hover."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.geoJson(null, {
+            style: function(feature) { return {{ this.style|tojson }}; },
+            {%- if this.tooltip_fields %}
+            onEachFeature: function(feature, layer) {
+                layer.bindTooltip({{ this.tooltip_fields|tojson }}.map(function(field) {
+                    return feature.properties[field];
+                }).join('<br>'), {sticky: true});
+            },
+            {%- endif %}
+        }).addTo({{ this._parent.get_name() }});
+        var {{ this.get_name() }}_data = null;
+        parent.Shiny.addCustomMessageHandler({{ this.message|tojson }}, function(msg) {
+            var data = {{ this.get_name() }}_data = msg.layer;
+            (data ? unpackLayer(data) : Promise.resolve(null)).then(function(layer) {
+                // a later layer was sent meanwhile
+                if (data !== {{ this.get_name() }}_data) {
+                    return;
+                }
+                {{ this.get_name() }}.clearLayers();
+                if (layer !== null) {
+                    {{ this.get_name() }}.addData(layer);
+                }
+            });
+        });
+        {% endmacro %}
+        """)
+
+    def __init__(self, message, style=None, tooltip_fields=None, name=None, overlay=True, control=True, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "SentGeoJson"
+        self.message = message
+        self.style = style or {}
+        self.tooltip_fields = tooltip_fields
+
+    def render(self, **kwargs):
+        add_decoder(self.get_root())
+        super().render(**kwargs)
@@ -0,0 +1,196 @@
+"""Process-wide data tables that refresh themselves when their files change.
+
+Each table is registered with the files it is read from and a loader. A
+background thread polls the files (size and mtime, plus a hash of the bytes
+already read to tell appends from rewrites) every `REFRESH_SECS`. Only the
+table whose files changed is reloaded; for CSVs that were only appended to,
+an `append` function can parse just the new rows. The new table is built
+off the session threads and swapped in atomically, and its version number is
+bumped so sessions can invalidate only the reactives that read it:
+
+    data_farms = store.reactive_table("farms")  # inside the Shiny server
+
+Derived objects (spatial indexes, aggregates and the like) can be attached to
+one or more tables (or other derived objects) with `derive`; they are rebuilt
+right after any of their sources is swapped, or extended with the new rows
+when the table was only appended to and they know how.
+"""
+import hashlib
+import io
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import pandas as pd
+
+REFRESH_SECS = float(os.environ.get("DASHBOARD_REFRESH_SECS", 10))
+POLL_SECS = 1  # how often each session checks the (cheap) table versions
+HASH_BYTES = 64 * 1024
+
+
+class FileStamp:
+    """Size, mtime and hashes of the first/last bytes of a file."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        stat = self.path.stat()
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.head = _hash_range(self.path, 0, min(self.size, HASH_BYTES))
+        self.tail = _hash_range(self.path, max(0, self.size - HASH_BYTES), self.size)
+
+    def changed(self):
+        stat = self.path.stat()
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime_ns
+
+    # True if the file still starts with exactly the bytes we read last time
+    def is_appended_to(self):
+        stat = self.path.stat()
+        if stat.st_size <= self.size:
+            return False
+        return (_hash_range(self.path, 0, min(self.size, HASH_BYTES)) == self.head
+                and _hash_range(self.path, max(0, self.size - HASH_BYTES), self.size) == self.tail)
+
+
+def _hash_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return hashlib.blake2b(f.read(end - start), digest_size=16).digest()
+
+
+def read_appended_csv(path, offset, **read_csv_kwargs):
+    """Read the rows appended to the CSV at `path` after byte `offset`."""
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(offset)
+        tail = f.read()
+    return pd.read_csv(io.BytesIO(header + tail), **read_csv_kwargs)
+
+
+class DataStore:
+    def __init__(self, refresh_secs=REFRESH_SECS):
+        self.refresh_secs = refresh_secs
+        self._sources = {}
+        self._derived = {}
+        self._tables = {}
+        self._stamps = {}
+        self._versions = {}
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def register(self, name, files, load, append=None):
+        """Register table `name`, read by `load()` from `files`.
+
+        `append(old_table, path, offset)`, if given, returns the table with
+        the rows appended to `path` after `offset` bytes added.
+        """
+        self._sources[name] = (list(map(Path, files)), load, append)
+        self._versions[name] = 0
+
+    def derive(self, name, sources, build, append=None):
+        """Keep `build(*tables)` of the table(s) `sources` available as `name`.
+
+        `append(previous, *tables)`, if given, is called instead of `build`
+        when rows were only appended to one of the tables, to extend the
+        `previous` object with them.
+        """
+        sources = [sources] if isinstance(sources, str) else list(sources)
+        self._derived[name] = (sources, build, append)
+        self._versions[name] = 0
+
+    def version(self, name):
+        return self._versions[name]
+
+    def reactive_table(self, name, poll_secs=POLL_SECS):
+        """Reactive calc returning table `name`; it invalidates (only) its
+        dependents when the table is swapped. Call inside a Shiny session."""
+        from shiny import reactive
+
+        @reactive.poll(lambda: self.version(name), poll_secs)
+        def table():
+            return self.get(name)
+        return table
+
+    def get(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            with self._lock:
+                if name not in self._tables:
+                    self._load(name)
+                table = self._tables[name]
+        return table
+
+    def _load(self, name):
+        if name in self._derived:
+            sources, build, _ = self._derived[name]
+            self._tables[name] = build(*(self.get(source) for source in sources))
+            return
+        files, load, _ = self._sources[name]
+        stamps = [FileStamp(f) for f in files]
+        self._tables[name] = load()
+        self._stamps[name] = stamps
+
+    def _swap(self, name, table, stamps, appended=False):
+        # derived objects are rebuilt before anything is published, in the
+        # order they were declared, so objects derived from derived ones see
+        # the rebuilt versions
+        derived = {name: table}
+        for d, (sources, build, append) in self._derived.items():
+            if d in self._tables and any(source in derived for source in sources):
+                tables = [derived[source] if source in derived else self.get(source) for source in sources]
+                if appended and append is not None and name in sources:
+                    derived[d] = append(self._tables[d], *tables)
+                else:
+                    derived[d] = build(*tables)
+        del derived[name]
+        with self._lock:
+            self._tables[name] = table
+            self._stamps[name] = stamps
+            self._versions[name] += 1
+            for d, value in derived.items():
+                self._tables[d] = value
+                self._versions[d] += 1
+
+    def refresh(self):
+        """Reload the loaded tables whose files changed; returns their names."""
+        refreshed = []
+        for name, (files, load, append) in self._sources.items():
+            stamps = self._stamps.get(name)
+            if stamps is None:
+                continue  # never loaded, nothing to refresh
+            try:
+                if not any(s.changed() for s in stamps):
+                    continue
+                appended = (append is not None and len(stamps) == 1 and stamps[0].is_appended_to())
+                new_stamps = [FileStamp(f) for f in files]
+                if appended:
+                    table = append(self._tables[name], files[0], stamps[0].size)
+                else:
+                    table = load()
+                self._swap(name, table, new_stamps, appended)
+            except Exception:
+                # a half-written file, or a table its derived objects cannot
+                # be built from: keep serving the old tables (nothing is
+                # swapped in until all of them are built) and retry next time
+                traceback.print_exc(file=sys.stderr)
+                continue
+            refreshed.append(name)
+        return refreshed
+
+    def start(self):
+        """Start the background refresh thread (once per process)."""
+        if self.refresh_secs <= 0:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._watch, name="data-refresh", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.refresh_secs)
+            self.refresh()
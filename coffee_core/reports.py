@@ -0,0 +1,223 @@
+"""Printable PDF/PNG reports of a selection, rendered on a process pool.
+
+A report lays out the metric cards, the coffee trees and touch points charts
+and a static map of the selection in one plotly figure, and writes it with
+plotly's static image export (this needs the `kaleido` package). The session
+only gathers a small, picklable snapshot of what is on screen
+(`report_snapshot`); `ReportJobs` queues the rendering on a pool of worker
+processes, which send their progress back through a multiprocessing queue.
+Sessions poll their job instead of rendering on their reactive thread.
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+REPORT_WORKERS = int(os.environ.get("DASHBOARD_REPORT_WORKERS", 2))
+# format: (label, media type)
+REPORT_FORMATS = {
+    'pdf': ("PDF", "application/pdf"),
+    'png': ("PNG", "image/png"),
+}
+POLL_SECS = 0.5  # how often a session checks its report job
+MAX_MAP_FARMS = 20_000
+SIMPLIFY_DEGREES = 0.001  # about 100 m, plenty for a printed map
+WIDTH, HEIGHT = 1400, 1000
+
+
+def report_map_layers(country, lakes, parks, districts):
+    """Simplified outlines of the geo layers, shared by all the reports."""
+    return {
+        name: shapely.simplify(np.asarray(layer.geometry.values), SIMPLIFY_DEGREES)
+        for name, layer in (("country", country), ("districts", districts), ("parks", parks), ("lakes", lakes))
+    }
+
+
+def report_snapshot(title, subtitle, cards, farms, farmers, layers, selection=None, stations=None):
+    """What a report shows, small enough to send to a worker process.
+
+    `cards` are (label, value) pairs, `farms`/`farmers` the rows of the
+    selection, `selection` the outlines to highlight and `stations` the CWS
+    to mark on the map.
+    """
+    trees = farms.groupby('age_range_coffee_trees')['nbr_coffee_trees'].sum()
+    topics = farmers['training_topics'].str.split(' ').explode().value_counts()
+    if len(farms) > MAX_MAP_FARMS:
+        farms = farms.sample(MAX_MAP_FARMS, random_state=0)
+    return {
+        "title": title,
+        "subtitle": subtitle,
+        "cards": list(cards),
+        "trees": (trees.index.tolist(), trees.tolist()),
+        "topics": (topics.index.tolist(), topics.tolist()),
+        "farms": shapely.get_coordinates(farms.geometry.values),
+        "layers": layers,
+        "selection": None if selection is None else shapely.simplify(np.asarray(selection), SIMPLIFY_DEGREES / 10),
+        "stations": None if stations is None else shapely.get_coordinates(np.asarray(stations)),
+    }
+
+
+# x, y of the rings of `geometries`, separated by NaN, for filled scatter traces
+def _outline_xy(geometries):
+    rings = shapely.get_rings(shapely.get_parts(geometries))
+    coords, ring = shapely.get_coordinates(rings, return_index=True)
+    xy = np.insert(coords, np.flatnonzero(np.diff(ring)) + 1, np.nan, axis=0)
+    return xy[:, 0], xy[:, 1]
+
+
+def build_report_figure(snapshot):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(
+        rows=3, cols=2,
+        column_widths=[0.6, 0.4],
+        row_heights=[0.14, 0.43, 0.43],
+        specs=[[{"type": "table", "colspan": 2}, None], [{"rowspan": 2}, {}], [None, {}]],
+        subplot_titles=("", "", "# Coffee trees per age", "# Farmers per training touch points"),
+        vertical_spacing=0.07,
+    )
+    labels, values = zip(*snapshot["cards"]) if snapshot["cards"] else ((), ())
+    fig.add_trace(go.Table(
+        header=dict(values=list(labels), fill_color="#2c3e50", font=dict(color="white", size=13)),
+        cells=dict(values=[[v] for v in values], font=dict(size=18), height=34),
+    ), row=1, col=1)
+
+    layer_styles = {
+        "country": dict(fillcolor="#f4f4f4", line=dict(color="#7f7f7f", width=1)),
+        "districts": dict(fillcolor="rgba(0,0,0,0)", line=dict(color="#b0b0b0", width=0.6)),
+        "parks": dict(fillcolor="rgba(46,139,87,0.35)", line=dict(color="#2e8b57", width=0.5)),
+        "lakes": dict(fillcolor="rgba(70,130,180,0.6)", line=dict(color="#4682b4", width=0.5)),
+    }
+    for name, style in layer_styles.items():
+        x, y = _outline_xy(snapshot["layers"][name])
+        fig.add_trace(go.Scatter(x=x, y=y, mode="lines", fill="toself", hoverinfo="skip", **style),
+                      row=2, col=1)
+    if snapshot["selection"] is not None:
+        x, y = _outline_xy(snapshot["selection"])
+        fig.add_trace(go.Scatter(x=x, y=y, mode="lines", fill="toself", fillcolor="rgba(255,120,0,0.35)",
+                                 line=dict(color="#000000", width=1.5)), row=2, col=1)
+    farms = snapshot["farms"]
+    fig.add_trace(go.Scattergl(x=farms[:, 0], y=farms[:, 1], mode="markers",
+                               marker=dict(size=2, color="#011e0b", opacity=0.6)), row=2, col=1)
+    if snapshot["stations"] is not None:
+        stations = snapshot["stations"]
+        fig.add_trace(go.Scatter(x=stations[:, 0], y=stations[:, 1], mode="markers",
+                                 marker=dict(size=12, color="red", symbol="star")), row=2, col=1)
+    map_axes = fig.get_subplot(2, 1)
+    fig.update_xaxes(visible=False, row=2, col=1)
+    fig.update_yaxes(visible=False, scaleanchor=map_axes.yaxis.anchor, row=2, col=1)
+
+    ages, trees = snapshot["trees"]
+    fig.add_trace(go.Bar(x=ages, y=trees, marker=dict(color="rgba(50, 171, 96, 0.6)")), row=2, col=2)
+    topics, counts = snapshot["topics"]
+    fig.add_trace(go.Bar(x=topics, y=counts, marker=dict(color="rgba(50, 171, 96, 0.6)")), row=3, col=2)
+    fig.update_yaxes(tickformat=",", row=2, col=2)
+    fig.update_yaxes(tickformat=",", row=3, col=2)
+    fig.update_xaxes(tickangle=45, row=3, col=2)
+
+    fig.update_layout(
+        title=dict(text=f"{snapshot['title']}<br><sup>{snapshot['subtitle']}</sup>", x=0.02),
+        showlegend=False,
+        width=WIDTH, height=HEIGHT,
+        margin=dict(l=20, r=20, t=80, b=20),
+        paper_bgcolor="white", plot_bgcolor="white",
+    )
+    return fig
+
+
+def render_report(snapshot, fmt, path, progress=None):
+    """Write the report of `snapshot` to `path` as `fmt` ('pdf' or 'png')."""
+    def step(fraction, message):
+        if progress is not None:
+            progress(fraction, message)
+
+    step(0.1, "Laying out the cards, charts and map")
+    fig = build_report_figure(snapshot)
+    step(0.4, f"Exporting the {REPORT_FORMATS[fmt][0]}")
+    fig.write_image(path, format=fmt, width=WIDTH, height=HEIGHT)
+    step(1.0, "Done")
+    return path
+
+
+# set in every worker process by the pool initializer
+_progress_queue = None
+
+
+def _init_worker(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def _run_job(job_id, snapshot, fmt, path):
+    return render_report(snapshot, fmt, path, lambda fraction, message: _progress_queue.put((job_id, fraction, message)))
+
+
+class ReportJobs:
+    """Queue of report jobs rendered on a (lazily started) process pool."""
+
+    def __init__(self, max_workers=REPORT_WORKERS, out_dir=None):
+        self.max_workers = max_workers
+        self.out_dir = Path(out_dir) if out_dir else None
+        self._jobs = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._progress = None
+
+    def _start(self):
+        # the app runs threads, so workers are spawned rather than forked
+        context = multiprocessing.get_context("spawn")
+        self._progress = context.Queue()
+        self._pool = ProcessPoolExecutor(self.max_workers, mp_context=context,
+                                         initializer=_init_worker, initargs=(self._progress,))
+        if self.out_dir is None:
+            self.out_dir = Path(tempfile.mkdtemp(prefix="coffee-reports-"))
+        threading.Thread(target=self._watch_progress, name="report-progress", daemon=True).start()
+
+    def submit(self, snapshot, fmt, filename):
+        """Queue a report of `snapshot`; returns the job id to poll."""
+        with self._lock:
+            if self._pool is None:
+                self._start()
+            job_id = uuid.uuid4().hex
+            self._submitted += 1
+            self._jobs[job_id] = {"state": "queued", "progress": 0.0, "message": "Waiting for a worker",
+                                  "path": None, "filename": filename, "format": fmt, "seq": self._submitted}
+            future = self._pool.submit(_run_job, job_id, snapshot, fmt, str(self.out_dir / f"{job_id}.{fmt}"))
+        future.add_done_callback(lambda future: self._finish(job_id, future))
+        return job_id
+
+    def _finish(self, job_id, future):
+        error = future.exception()
+        with self._lock:
+            job = self._jobs[job_id]
+            if error is not None:
+                job.update(state="failed", message=str(error).strip() or type(error).__name__)
+            else:
+                job.update(state="done", progress=1.0, message="Ready", path=future.result())
+
+    def _watch_progress(self):
+        while True:
+            job_id, fraction, message = self._progress.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                # progress can arrive after the job finished
+                if job is not None and job["state"] in ("queued", "running"):
+                    job.update(state="running", progress=fraction, message=message)
+
+    def status(self, job_id):
+        """State ('queued', 'running', 'done' or 'failed'), progress, message,
+        and once done the path of the report, of job `job_id`."""
+        with self._lock:
+            status = dict(self._jobs[job_id])
+            if status["state"] == "queued":
+                ahead = sum(job["state"] == "queued" and job["seq"] < status["seq"] for job in self._jobs.values())
+                status["message"] = f"Waiting for a worker ({ahead} jobs ahead)" if ahead else status["message"]
+        return status
@@ -0,0 +1,180 @@
+"""Packed Hilbert R-tree over the farms, kept on disk and memory-mapped.
+
+`python -m coffee_core.ingest` writes the tree next to the farms cache
+(``cache/Coffee_farms.rtree``), laid out like the index of a FlatGeobuf file:
+the farms are sorted along a Hilbert curve over their extent and packed
+`NODE_SIZE` to a node, and the levels of the tree are stored root first as
+(box, offset) entries. An inner entry's offset is the first of its children;
+a leaf entry's offset is the farm's position in the farms table, its box the
+bounds of the farm's polygon, and its point (the centroid) is stored beside
+it.
+
+The file is opened with `np.memmap`: a query walks down from the root one
+level at a time and reads only the entries under the boxes it meets, so the
+pages of the file it never touches are never read, and the workers share
+the pages it does read through the OS page cache.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+from shapely.geometry import box
+
+NODE_SIZE = 16
+HILBERT_ORDER = 16
+MAGIC = b"FARMTREE"
+
+ENTRY = np.dtype([("min_x", "<f8"), ("min_y", "<f8"), ("max_x", "<f8"), ("max_y", "<f8"), ("offset", "<u8")])
+POINT = np.dtype([("x", "<f8"), ("y", "<f8")])
+
+
+def _hilbert(x, y, order=HILBERT_ORDER):
+    # distance along the Hilbert curve of the cells (x, y) of a 2**order grid
+    n = 1 << order
+    x, y = x.astype(np.int64), y.astype(np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant
+        flip = ~ry & rx
+        x, y = np.where(flip, n - 1 - x, x), np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return d
+
+
+# level sizes, leaves first
+def _level_sizes(n, node_size):
+    sizes = [n]
+    while sizes[-1] > 1:
+        sizes.append(-(-sizes[-1] // node_size))
+    return sizes
+
+
+def write_rtree(path, points, bounds=None, header=None, node_size=NODE_SIZE):
+    """Write the tree of the farms at `points` (an (n, 2) array of x, y) to
+    `path`; `bounds` (n, 4: min x, min y, max x, max y) are the boxes of the
+    items, their points by default. `header` is kept in the file's header."""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(points)
+    if n == 0:
+        raise ValueError("no farms to index")
+    boxes = np.hstack([points, points]) if bounds is None else np.asarray(bounds, dtype=float).copy()
+    # the boxes hold their points, whatever the rounding of the centroids
+    boxes[:, :2] = np.fmin(boxes[:, :2], points)
+    boxes[:, 2:] = np.fmax(boxes[:, 2:], points)
+
+    # Hilbert order of the box centers over the extent
+    # (farms without a point have NaN boxes, which no query meets)
+    extent = np.array([np.nanmin(boxes[:, 0]), np.nanmin(boxes[:, 1]), np.nanmax(boxes[:, 2]), np.nanmax(boxes[:, 3])])
+    size = np.maximum(extent[2:] - extent[:2], np.finfo(float).tiny)
+    centers = np.nan_to_num(((boxes[:, :2] + boxes[:, 2:]) / 2 - extent[:2]) / size)
+    cells = np.clip(centers * ((1 << HILBERT_ORDER) - 1), 0, (1 << HILBERT_ORDER) - 1)
+    order = np.argsort(_hilbert(cells[:, 0], cells[:, 1]), kind="stable")
+
+    sizes = _level_sizes(n, node_size)
+    # start of each level in the file, root first
+    starts = np.cumsum([0] + sizes[::-1])[:-1][::-1]
+    entries = np.empty(sum(sizes), dtype=ENTRY)
+    leaves = entries[starts[0]:starts[0] + n]
+    for i, field in enumerate(["min_x", "min_y", "max_x", "max_y"]):
+        leaves[field] = boxes[order, i]
+    leaves["offset"] = order
+    for level in range(1, len(sizes)):
+        children = entries[starts[level - 1]:starts[level - 1] + sizes[level - 1]]
+        first = np.arange(0, sizes[level - 1], node_size)
+        parents = entries[starts[level]:starts[level] + sizes[level]]
+        for field, reduce in [("min_x", np.fmin), ("min_y", np.fmin), ("max_x", np.fmax), ("max_y", np.fmax)]:
+            parents[field] = reduce.reduceat(children[field], first)
+        parents["offset"] = starts[level - 1] + first
+
+    leaf_points = np.empty(n, dtype=POINT)
+    leaf_points["x"], leaf_points["y"] = points[order, 0], points[order, 1]
+
+    header = json.dumps(dict(header or {}, items=n, node_size=node_size,
+                             levels=[[int(starts[i]), int(sizes[i])] for i in reversed(range(len(sizes)))],
+                             extent=extent.tolist())).encode()
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 8)  # keep the arrays aligned
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(header)).astype("<u4").tobytes())
+        f.write(header)
+        f.write(entries.tobytes())
+        f.write(leaf_points.tobytes())
+
+
+class PackedRTree:
+    """The tree written by `write_rtree`, memory-mapped from `path`."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a farms index")
+            length = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+            self.header = json.loads(f.read(length))
+        offset = len(MAGIC) + 4 + length
+        self.levels = [tuple(level) for level in self.header["levels"]]  # (start, size), root first
+        self.node_size = self.header["node_size"]
+        n_entries = sum(size for _, size in self.levels)
+        self.entries = np.memmap(self.path, dtype=ENTRY, mode="r", offset=offset, shape=(n_entries,))
+        self.points = np.memmap(self.path, dtype=POINT, mode="r", offset=offset + n_entries * ENTRY.itemsize,
+                                shape=(self.header["items"],))
+
+    def __len__(self):
+        return self.header["items"]
+
+    def search(self, min_x, min_y, max_x, max_y):
+        """Positions (in the farms table) of the farms whose point lies in the
+        box, in no particular order."""
+        idx = np.arange(self.levels[0][0], self.levels[0][0] + self.levels[0][1])
+        for level in range(len(self.levels)):
+            boxes = self.entries[idx]
+            hit = ((boxes["min_x"] <= max_x) & (boxes["max_x"] >= min_x)
+                   & (boxes["min_y"] <= max_y) & (boxes["max_y"] >= min_y))
+            idx, boxes = idx[hit], boxes[hit]
+            if level + 1 == len(self.levels):
+                break
+            # the children of the boxes met, in the next level
+            child_start, child_size = self.levels[level + 1]
+            first = boxes["offset"].astype(np.int64)
+            counts = np.minimum(first + self.node_size, child_start + child_size) - first
+            idx = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        points = self.points[idx - self.levels[-1][0]]
+        inside = ((points["x"] >= min_x) & (points["x"] <= max_x)
+                  & (points["y"] >= min_y) & (points["y"] <= max_y))
+        return boxes["offset"][inside].astype(np.int64)
+
+
+class FarmIndex:
+    """Bounding-box queries over the farm centroids of `data_farms`.
+
+    With `tree` (a `PackedRTree` of the farms table it was loaded with), the
+    farms it covers are looked up on disk and only the rows appended since
+    are held in memory; without it, the farms' in-memory STR-tree is used.
+    """
+
+    def __init__(self, data_farms, tree=None):
+        # a tree over more farms than the table is not this table's
+        self.tree = tree if tree is not None and len(tree) <= len(data_farms) else None
+        self.farms = data_farms
+        start = len(self.tree) if self.tree is not None else len(data_farms)
+        appended = data_farms.geometry.iloc[start:]
+        self._appended = (np.arange(start, len(data_farms)), appended.x.to_numpy(), appended.y.to_numpy())
+
+    def appended(self, data_farms):
+        """Index of `data_farms`, the farms this one was built from followed by
+        new ones: the tree is kept for the farms it covers."""
+        return FarmIndex(data_farms, self.tree)
+
+    def query(self, south, west, north, east):
+        """Sorted positions of the farms inside (south, west, north, east)."""
+        if self.tree is None:
+            return np.sort(self.farms.sindex.query(box(west, south, east, north)))
+        positions, x, y = self._appended
+        inside = (x >= west) & (x <= east) & (y >= south) & (y <= north)
+        return np.sort(np.concatenate([self.tree.search(west, south, east, north), positions[inside]]))
+
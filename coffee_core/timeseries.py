@@ -0,0 +1,191 @@
+"""Monthly KPI totals with prefix sums for constant-time date-range queries.
+
+The farms export records when each farm was registered (`day`, `month`,
+`year`). `MonthlyTotals` buckets metric columns by registration month and by
+group (CWS, district), then keeps running totals along the month axis. The
+total of any metric, for any group and any range of months, is then the
+difference of two rows instead of a rescan of the table.
+
+Months are numbered `year * 12 + month - 1`. Rows without a usable date are
+only counted when a range covers every month in the data.
+"""
+import calendar
+import datetime
+
+import numpy as np
+import pandas as pd
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+_MONTH_NUMBERS = {name.lower(): i for i, name in enumerate(MONTHS)}
+
+
+def month_of(date):
+    return date.year * 12 + date.month - 1
+
+
+def month_start(month):
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def month_end(month):
+    year, month = month // 12, month % 12 + 1
+    return datetime.date(year, month, calendar.monthrange(year, month)[1])
+
+
+def month_label(month):
+    return f"{MONTHS[month % 12]} {month // 12}"
+
+
+def registration_months(data_farms):
+    """Month each farm was registered in, NaN where the date is missing."""
+    if "month" not in data_farms.columns or "year" not in data_farms.columns:
+        return pd.Series(np.nan, index=data_farms.index)
+    # month names ('Sep') in the exports, numbers accepted too
+    month = data_farms["month"].astype(str).str[:3].str.lower().map(_MONTH_NUMBERS)
+    month = month.fillna(pd.to_numeric(data_farms["month"], errors="coerce") - 1)
+    year = pd.to_numeric(data_farms["year"], errors="coerce")
+    return year * 12 + month
+
+
+class MonthlyTotals:
+    """Running totals of `values` per group along the registration months."""
+
+    def __init__(self, months, values, groups=None):
+        months = pd.Series(np.asarray(months, dtype=float))
+        values = values.fillna(0).astype(float)
+        self.metrics = list(values.columns)
+        dated = months.notna().to_numpy()
+        if dated.any():
+            self.first, self.last = int(months[dated].min()), int(months[dated].max())
+            n_months = self.last - self.first + 1
+        else:
+            self.first = self.last = None
+            n_months = 0
+
+        if groups is None:
+            codes, keys = np.full(len(values), -1), []
+        else:
+            codes, keys = pd.factorize(np.asarray(groups))
+        # slot 0 holds all rows; rows without a group only count there
+        self._groups = {key: code + 1 for code, key in enumerate(keys)}
+        slots = codes + 1
+        buckets = np.zeros((len(keys) + 1, n_months + 1, len(self.metrics)))
+        undated = np.zeros((len(keys) + 1, len(self.metrics)))
+        vals = values.to_numpy()
+        if n_months:
+            positions = months[dated].to_numpy().astype(int) - self.first + 1
+            np.add.at(buckets, (slots[dated], positions), vals[dated])
+        np.add.at(undated, slots[~dated], vals[~dated])
+        buckets[0] += buckets[1:].sum(axis=0)
+        undated[0] += undated[1:].sum(axis=0)
+
+        self._cumulative = np.cumsum(buckets, axis=1)
+        self._undated = undated
+        self._n_months = n_months
+
+    def _bounds(self, start, end):
+        lo = 0 if start is None else int(np.clip(start - self.first, 0, self._n_months))
+        hi = self._n_months if end is None else int(np.clip(end - self.first + 1, 0, self._n_months))
+        return lo, max(lo, hi)
+
+    def _sum(self, slots, lo, hi):
+        totals = np.zeros(len(self.metrics))
+        for slot in slots:
+            totals += self._cumulative[slot, hi] - self._cumulative[slot, lo]
+            if lo == 0 and hi == self._n_months:
+                totals += self._undated[slot]
+        return totals
+
+    def _slots(self, groups):
+        if groups is None:
+            return [0]
+        return [self._groups[g] for g in groups if g in self._groups]
+
+    def total(self, groups=None, start=None, end=None):
+        """Totals per metric over the months `start`..`end` (inclusive, open
+        ended if None), for the rows of `groups` (all rows if None)."""
+        if self.first is None:
+            start = end = None
+        return pd.Series(self._sum(self._slots(groups), *self._bounds(start, end)), index=self.metrics)
+
+    def total_with_change(self, groups=None, start=None, end=None):
+        """`total` plus the same totals before the last month of the range and
+        that month, or None as previous totals if the range is a single month."""
+        current = self.total(groups, start, end)
+        if self.first is None:
+            return current, None, None
+        lo, hi = self._bounds(start, end)
+        if hi - lo < 2:
+            return current, None, None
+        slots = self._slots(groups)
+        last_month = self._sum(slots, hi - 1, hi)
+        return current, current - last_month, self.first + hi - 1
+
+
+class FarmKpis:
+    """Monthly totals behind the metric cards.
+
+    Farm area is bucketed per CWS (the CWS of the farm owner's records),
+    matching how the cards filter farms for a selected CWS; the totals per
+    district, sector and cell are kept by `coffee_core.admin.AdminHierarchy`.
+    Farmer counts are bucketed by the month their first farm was registered,
+    per district and CWS (see `coffee_core.demographics.Demographics`).
+    """
+
+    def __init__(self, data_farms, data_farmers, youth_age=None):
+        # imported here, coffee_core.demographics builds on MonthlyTotals
+        from coffee_core.demographics import YOUTH_AGE, Demographics
+
+        months = registration_months(data_farms)
+        farms = pd.DataFrame({
+            "national_id": data_farms["national_id"],
+            "month": months,
+            "farms": 1,
+            "area": data_farms["area"],
+        })
+        self.farms = MonthlyTotals(farms["month"], farms[["farms", "area"]])
+
+        # a farm counts for every CWS its owner is recorded at
+        owners = data_farmers[["national_id", "farmer_cws"]].drop_duplicates()
+        by_cws = farms.merge(owners, on="national_id", how="inner")
+        self.farms_by_cws = MonthlyTotals(by_cws["month"], by_cws[["farms", "area"]], by_cws["farmer_cws"])
+
+        first_month = farms.groupby("national_id")["month"].min()
+        farmer_months = data_farmers["national_id"].map(first_month)
+        self.demographics = Demographics(data_farmers, farmer_months,
+                                         YOUTH_AGE if youth_age is None else youth_age)
+        # slot 0 of the per-district totals counts every farmer
+        self.farmers = self.demographics.by_district
+
+    # (first day, last day) of the registration months in the data
+    def date_span(self):
+        first = [t.first for t in (self.farms, self.farmers) if t.first is not None]
+        last = [t.last for t in (self.farms, self.farmers) if t.last is not None]
+        if not first:
+            return None, None
+        return month_start(min(first)), month_end(max(last))
+
+
+def percent(part, whole):
+    return part / whole * 100 if whole else 0.0
+
+
+def describe_change(current, previous, month, points=False):
+    """Trend text and css class (e.g. "↑ 2.3% in Sep 2024", "positive") of
+    `current` against `previous`, or None if there is nothing to compare.
+
+    With `points`, the values are percentages and the change is given in
+    percentage points.
+    """
+    if previous is None:
+        return None
+    if points:
+        delta, unit = current - previous, " pts"
+    elif previous:
+        delta, unit = (current - previous) / previous * 100, "%"
+    else:
+        return None
+    if round(delta, 1) == 0:
+        return f"no change in {month_label(month)}", ""
+    arrow, direction = ("↑", "positive") if delta > 0 else ("↓", "negative")
+    return f"{arrow} {abs(delta):.1f}{unit} in {month_label(month)}", direction
@@ -0,0 +1,211 @@
+"""Shared-arc TopoJSON of the boundary layers drawn on every map.
+
+`country`, `districts`, `parks` and `lakes` share most of their edges (the
+districts tile the country, lakes and parks lie along district borders).
+`BoundaryTopology` encodes them once, when they are loaded, as a TopoJSON
+topology: the coordinates are quantized to a `QUANTIZATION` x
+`QUANTIZATION` grid over the layers' extent, the rings are cut into arcs at
+the points where they stop sharing an edge, and each arc is stored once,
+delta-encoded, for all the rings running along it.
+
+`TopoJsonLayer` draws one of the layers on a folium map. The topology is
+embedded in the page once, however many of its layers the map draws (packed,
+with ``DASHBOARD_PACKED_LAYERS=1``, see `coffee_core.packed`), and turned
+back into GeoJSON in the browser with topojson-client (the library
+`folium.TopoJson` loads).
+"""
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+from folium import Element
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from jinja2 import Template
+
+from coffee_core import packed
+
+QUANTIZATION = int(os.environ.get("DASHBOARD_TOPOLOGY_QUANTIZATION", 100_000))
+
+
+def _rings(geometry):
+    # rings of each polygon of `geometry`, exterior first
+    if geometry is None or geometry.is_empty:
+        return []
+    return [[polygon.exterior, *polygon.interiors] for polygon in shapely.get_parts(geometry)]
+
+
+def encode_topology(layers, quantization=QUANTIZATION):
+    """TopoJSON topology (a dict) of the polygon `layers` ({name: GeoDataFrame}),
+    one GeometryCollection object per layer, with the layers' other columns as
+    properties."""
+    bounds = np.array([layer.total_bounds for layer in layers.values() if len(layer)])
+    x0, y0 = bounds[:, 0].min(), bounds[:, 1].min()
+    kx = (bounds[:, 2].max() - x0) / (quantization - 1) or 1
+    ky = (bounds[:, 3].max() - y0) / (quantization - 1) or 1
+
+    # quantized points of every ring (without the closing point, and without
+    # the repeated points quantization makes), and their ring
+    shapes, rings = {}, []
+    for name, layer in layers.items():
+        shapes[name] = []
+        for geometry in layer.geometry:
+            polygons = []
+            for polygon in _rings(geometry):
+                ring_ids = []
+                for ring in polygon:
+                    points = np.round((shapely.get_coordinates(ring) - (x0, y0)) / (kx, ky)).astype(np.int64)
+                    points = points[np.r_[True, (np.diff(points, axis=0) != 0).any(axis=1)]]
+                    if len(points) > 1 and (points[0] == points[-1]).all():
+                        points = points[:-1]
+                    ring_ids.append(len(rings))
+                    rings.append(points)
+                polygons.append(ring_ids)
+            shapes[name].append(polygons)
+
+    # a point is a junction where the rings through it do not all go on to
+    # the same neighbours
+    codes = [ring[:, 0] * (quantization + 1) + ring[:, 1] for ring in rings]
+    points = np.concatenate(codes + [np.array([], dtype=np.int64)])
+    previous = np.concatenate([np.roll(c, 1) for c in codes] + [np.array([], dtype=np.int64)])
+    following = np.concatenate([np.roll(c, -1) for c in codes] + [np.array([], dtype=np.int64)])
+    neighbours = pd.DataFrame({"point": points,
+                               "a": np.minimum(previous, following),
+                               "b": np.maximum(previous, following)}).drop_duplicates()
+    counts = neighbours.groupby("point").size()
+    junctions = counts.index[counts > 1].to_numpy()
+
+    # cut the rings into arcs at the junctions, each arc stored once
+    arcs, arc_ids, ring_arcs = [], {}, []
+    for ring, code in zip(rings, codes):
+        cuts = np.flatnonzero(np.isin(code, junctions))
+        # a ring without junctions is one arc, starting at its lowest point so
+        # that the same ring is the same arc in every layer
+        start = cuts[0] if len(cuts) else int(np.argmin(code))
+        ring = np.roll(ring, -start, axis=0)
+        cuts = np.r_[cuts - start, len(ring)] if len(cuts) else np.array([0, len(ring)])
+        closed = np.vstack([ring, ring[:1]])
+        ids = []
+        for lo, hi in zip(cuts[:-1], cuts[1:]):
+            arc = closed[lo:hi + 1]
+            key = arc.tobytes()
+            if key in arc_ids:
+                ids.append(arc_ids[key])
+            elif arc[::-1].tobytes() in arc_ids:
+                ids.append(~arc_ids[arc[::-1].tobytes()])
+            else:
+                arc_ids[key] = len(arcs)
+                ids.append(len(arcs))
+                arcs.append(arc)
+        ring_arcs.append(ids)
+
+    objects = {}
+    for name, layer in layers.items():
+        properties = pd.DataFrame(layer.drop(columns=layer.geometry.name))
+        records = json.loads(properties.to_json(orient="records", date_format="iso", double_precision=15))
+        geometries = []
+        for i, (polygons, record) in enumerate(zip(shapes[name], records)):
+            polygons = [[ring_arcs[r] for r in polygon] for polygon in polygons]
+            # ids are the rows' positions in the layer
+            if not polygons:
+                geometries.append({"type": None, "id": i, "properties": record})
+            elif len(polygons) == 1:
+                geometries.append({"type": "Polygon", "id": i, "arcs": polygons[0], "properties": record})
+            else:
+                geometries.append({"type": "MultiPolygon", "id": i, "arcs": polygons, "properties": record})
+        objects[name] = {"type": "GeometryCollection", "geometries": geometries}
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [kx, ky], "translate": [x0, y0]},
+        "objects": objects,
+        "arcs": [np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist() for arc in arcs],
+    }
+
+
+class BoundaryTopology:
+    """Topology of the boundary `layers` ({name: GeoDataFrame}), and its JSON
+    ready to embed in a page (`json`)."""
+
+    def __init__(self, layers, quantization=QUANTIZATION):
+        self.layers = list(layers)
+        self.topology = encode_topology(layers, quantization)
+        # "</" escaped so that the JSON can sit inside a <script>
+        self.json = json.dumps(self.topology, separators=(",", ":")).replace("</", "<\\/")
+
+    @functools.cached_property
+    def packed_json(self):
+        return packed.pack_json(self.topology)
+
+
+class TopoJsonLayer(JSCSSMixin, Layer):
+    """Layer `object_name` of `boundaries` (a `BoundaryTopology`) on a folium
+    map, styled by `style_function` and with a `GeoJsonTooltip` (its fields
+    and aliases), like `folium.GeoJson`."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_styles = {{ this.styles|tojson }};
+        var {{ this.get_name() }}_style_of = {{ this.style_of|tojson }};
+        var {{ this.get_name() }} = L.geoJson(null,
+            {
+                style: function(feature) {
+                    return {{ this.get_name() }}_styles[{{ this.get_name() }}_style_of[feature.id]];
+                },
+                {%- if this.tooltip_fields %}
+                onEachFeature: function(feature, layer) {
+                    var aliases = {{ this.tooltip_aliases|tojson }};
+                    layer.bindTooltip('<table>' + {{ this.tooltip_fields|tojson }}.map(function(field, i) {
+                        return '<tr><th>' + aliases[i] + '</th><td>' + feature.properties[field] + '</td></tr>';
+                    }).join('') + '</table>', {sticky: true});
+                },
+                {%- endif %}
+            }
+        ).addTo({{ this._parent.get_name() }});
+        boundary_topology.then(function(topology) {
+            {{ this.get_name() }}.addData(topojson.feature(topology, topology.objects[{{ this.object_name|tojson }}]));
+        });
+        {% endmacro %}
+        """)
+
+    default_js = [
+        ("topojson", "https://cdnjs.cloudflare.com/ajax/libs/topojson/1.6.9/topojson.min.js"),
+    ]
+
+    def __init__(self, boundaries, object_name, name=None, style_function=None, tooltip=None,
+                 overlay=True, control=True, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "TopoJsonLayer"
+        self.boundaries = boundaries
+        self.object_name = object_name
+        # the style of each feature, each distinct style given once
+        geometries = boundaries.topology["objects"][object_name]["geometries"]
+        self.styles, self.style_of, keys = [], [], {}
+        for geometry in geometries:
+            style = {} if style_function is None else style_function(
+                {"type": "Feature", "properties": geometry.get("properties", {})})
+            key = json.dumps(style, sort_keys=True, default=str)
+            if key not in keys:
+                keys[key] = len(self.styles)
+                self.styles.append(style)
+            self.style_of.append(keys[key])
+        self.tooltip_fields = None if tooltip is None else list(tooltip.fields)
+        self.tooltip_aliases = None if tooltip is None else list(tooltip.aliases or tooltip.fields)
+
+    def render(self, **kwargs):
+        # (a promise of) the topology, once per page, before the layers drawn from it
+        figure = self.get_root()
+        if "boundary_topology" not in figure.script._children:
+            data = Element()
+            if packed.ENABLED:
+                packed.add_decoder(figure)
+                data._template = Template("var boundary_topology = unpackJson({{ this.packed|tojson }});")
+                data.packed = self.boundaries.packed_json
+            else:
+                data._template = Template("var boundary_topology = Promise.resolve({{ this.json }});")
+                data.json = self.boundaries.json
+            figure.script.add_child(data, name="boundary_topology")
+        super().render(**kwargs)
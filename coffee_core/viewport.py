@@ -0,0 +1,81 @@
+"""Viewport-driven lazy loading of farm points for the farms maps.
+
+When ``DASHBOARD_LAZY_FARMS=1``, `map_farms` starts without any farm points
+and instead reports its bounds and zoom; only the farms inside the current
+viewport are looked up in a spatial index over `data_farms` and sent to the
+browser. Below `MIN_ZOOM`, or when more than `MAX_FEATURES` farms are in
+view, the farm density hexagons of `coffee_core.hexbin` are sent instead
+(or nothing, without them) along with a "zoom in" hint.
+"""
+import os
+
+import numpy as np
+
+from coffee_core.rtree import FarmIndex
+
+ENABLED = os.environ.get("DASHBOARD_LAZY_FARMS", "").lower() in ("1", "true", "yes")
+MIN_ZOOM = int(os.environ.get("DASHBOARD_LAZY_MIN_ZOOM", 10))
+MAX_FEATURES = int(os.environ.get("DASHBOARD_LAZY_MAX_FEATURES", 5000))
+DEBOUNCE_SECS = float(os.environ.get("DASHBOARD_LAZY_DEBOUNCE_SECS", 0.3))
+
+# farm attributes sent along with each point
+FARM_PROPERTIES = ["farm_id", "farm_name", "area"]
+
+
+class FarmViewportIndex:
+    """Farm centroids answering bounding-box queries, from `index` (a
+    `coffee_core.rtree.FarmIndex`, the farms' own STR-tree by default)."""
+
+    def __init__(self, data_farms, index=None, properties=FARM_PROPERTIES):
+        self.index = index if index is not None else FarmIndex(data_farms)
+        self.x = data_farms.geometry.x.to_numpy()
+        self.y = data_farms.geometry.y.to_numpy()
+        self.properties = {
+            col: data_farms[col].to_numpy() for col in properties if col in data_farms.columns
+        }
+
+    def __len__(self):
+        return len(self.x)
+
+    # positional indices of the farms inside (south, west, north, east)
+    def query(self, south, west, north, east):
+        return self.index.query(south, west, north, east)
+
+    def to_geojson(self, idx):
+        features = []
+        for i in idx:
+            features.append({
+                "type": "Feature",
+                "id": int(i),
+                "geometry": {"type": "Point", "coordinates": [float(self.x[i]), float(self.y[i])]},
+                "properties": {col: _json_value(values[i]) for col, values in self.properties.items()},
+            })
+        return {"type": "FeatureCollection", "features": features}
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+EMPTY = {"type": "FeatureCollection", "features": []}
+
+
+def farms_in_view(index, bounds, zoom, hexbins=None):
+    """Return (geojson, hint) for the farms visible in `bounds` at `zoom`.
+
+    `bounds` is ((south, west), (north, east)) as reported by Leaflet. The hint
+    is an empty string when the points were sent. When there are too many
+    points to send, the geojson holds the `hexbins` density hexagons in view.
+    """
+    if not bounds or zoom is None:
+        return EMPTY, ""
+    (south, west), (north, east) = bounds
+    density = EMPTY if hexbins is None else hexbins.to_geojson(zoom, bounds)
+    if zoom < MIN_ZOOM:
+        return density, f"Zoom in to level {MIN_ZOOM} to see individual farms"
+    idx = index.query(south, west, north, east)
+    if len(idx) > MAX_FEATURES:
+        return density, f"{len(idx):,} farms in view, zoom in to see them"
+    return index.to_geojson(idx), ""
@@ -3,75 +3,47 @@
 
 from shiny import App, render, ui, reactive
 import shinyswatch
-import pandas as pd
-import geopandas as gpd
 import folium
 from folium.plugins import MarkerCluster
 from jinja2 import Template
-from geopy.distance import geodesic
 import plotly.graph_objects as go
-from shapely import wkt
-from shapely.geometry import Point
 import jenkspy
 from pathlib import Path
+from coffee_core.instrumentation import instrument, diagnostics_panel, register_diagnostics, with_metrics_routes
+from coffee_core.timeseries import month_of, month_label, percent, describe_change
+from coffee_core.demographics import YOUTH_AGE
+from coffee_core.catchment import supply_base_lines
+from coffee_core.capacity import UTILIZATION_CLASSES
+from coffee_core.export import EXPORT_FORMATS, export_chunks, export_filename, export_media_type, file_stem, stream
+from coffee_core.reports import REPORT_FORMATS, ReportJobs, report_snapshot
+from coffee_core import reports
+from coffee_core.engine import ALL, TREE_AGE_RANGES, build_store, selection_cache
+from coffee_core import engine
+from coffee_core.offload import offload, offloaded_calc
+from coffee_core.api import with_api_routes
+from coffee_core.debounce import CLICK_DEBOUNCE_SECS, debounce
+from coffee_core import viewport
+from coffee_core import packed
+from coffee_core.topology import TopoJsonLayer
 
-# Load and prepare csv data
-def load_data(path):
-    # Load CSV data
-    data_cws = pd.read_csv(f"{path}/Coffee_Washing_Stations.csv")
-    data_farmers = pd.read_csv(f"{path}/Coffee_farmers.csv")
-    data_farms = pd.read_csv(f"{path}/Coffee_farms.csv")
+# Process-wide data tables, reloaded in the background when their files change
+#-------------------------------------------------------------------------------
+current_dir = Path(__file__).parent # Get the directory of the current script
+coffee_data_path = current_dir / "data" 
+geo_data_path = current_dir / "data_wgs84"  
 
-    # Convert column names to lower case
-    data_cws.columns = data_cws.columns.str.lower()
-    data_farmers.columns = data_farmers.columns.str.lower()
-    data_farms.columns = data_farms.columns.str.lower()
+store = build_store(coffee_data_path, geo_data_path)
 
-    # convert farmer_cws  in data_farmers dataframe to lower and replace space by underscore
-    data_farmers['farmer_cws'] = data_farmers['farmer_cws'].str.lower().str.replace(' ', '_')
+# printable reports are rendered on a process pool shared by all sessions
+report_jobs = ReportJobs()
 
-    
-    data_cws = gpd.GeoDataFrame(
-        data_cws, 
-        geometry=gpd.GeoSeries.from_wkt(data_cws['geom']), 
-        crs="EPSG:4326"
-    ).drop('geom', axis=1)
-    
-    # define a function to filter out farms with invalid WKT strings
-    def safe_load_wkt(wkt_string):
-        try:
-            return wkt.loads(wkt_string)
-        except Exception:
-            return None
+# map layers are sent packed (quantized and compressed) with DASHBOARD_PACKED_LAYERS=1
+GeoJson = packed.PackedGeoJson if packed.ENABLED else folium.GeoJson
 
-     # Apply the WKT validation function to filter out invalid geometries
-    data_farms['geometry'] = data_farms['geom'].apply(safe_load_wkt)
-    data_farms = data_farms[data_farms['geometry'].notnull()].copy()
-
-    # Convert to GeoDataFrame and project to UTM to allow area calculation
-    data_farms = gpd.GeoDataFrame(data_farms, geometry='geometry', crs='EPSG:4326').to_crs(epsg=32736) 
-
-    # Calculate farm areas
-    data_farms['area'] = data_farms.area / 100
-    
-    # Calculate centroids for farms
-    data_farms['geometry'] = data_farms.geometry.centroid 
-    data_farms.to_crs(epsg=4326, inplace=True)
-    data_farms = data_farms.drop('geom', axis=1)
-    
-    # Convert columns to numeric
-    data_cws['actual_capacity'] = pd.to_numeric(data_cws['actual_capacity'])
-    
-    return data_cws, data_farmers, data_farms
 
-# load geometry data
-def load_geo_data(path):
-    country = gpd.read_file(f"{path}/RW_country.gpkg", layer="country")
-    lakes = gpd.read_file(f"{path}/RW_lakes.gpkg", layer="lakes")
-    parks = gpd.read_file(f"{path}/RW_national_parks.gpkg", layer="np")
-    districts = gpd.read_file(f"{path}/RW_districts.gpkg", layer="districts")
-    districts['district'] = districts['district'].str.lower() # Convert district names to lowercase   
-    return country, lakes, parks, districts
+# a layer sent to the maps' pages, packed when the map layers are
+def packed_layer(data):
+    return packed.pack(data) if packed.ENABLED else data.__geo_interface__
 
 
 # App UI
@@ -99,6 +71,17 @@ app_ui = ui.page_fluid(
                 margin: 0 !important;
                 padding: 0 !important;
         }
+        /* download buttons of the export card */
+        .export-buttons {
+            display: flex;
+            gap: 10px;
+        }
+        /* drill-down selects above the farms map */
+        .drilldown {
+            display: flex;
+            gap: 10px;
+            padding: 6px 10px 0 10px;
+        }
         
         /* bg of the map tabs headers */
         .nav-tabs.card-header-tabs {
@@ -238,6 +221,11 @@ app_ui = ui.page_fluid(
             margin-bottom: 15px !important;
             }
 
+        .card:has(div.shiny-html-output#capacity_chart) {
+            height: 350px !important;
+            margin-bottom: 15px !important;
+            }
+
         /* Style for card bodies containing charts */
         .card:has(div.shiny-html-output[id$="chart"]) .card-body {
             padding: 10px !important;
@@ -311,7 +299,8 @@ app_ui = ui.page_fluid(
         ui.column(12,
             ui.div(
                 ui.h2("Coffee Extension Activities Dashboard"),
-                ui.h4("A dashboard to track key extension-related KPIs for Rwanda's coffee program")
+                ui.h4("A dashboard to track key extension-related KPIs for Rwanda's coffee program"),
+                ui.output_ui("date_range_filter")
             )
         )
     ),
@@ -324,6 +313,7 @@ app_ui = ui.page_fluid(
                     ui.div(
                         ui.output_text("nbr_farmers"),
                         ui.span("registered coffee farmers", class_="metric-label"),
+                        ui.output_ui("nbr_farmers_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -333,7 +323,7 @@ app_ui = ui.page_fluid(
                     ui.div(
                         ui.output_text("nbr_farmers_women"),
                         ui.span("of total farmers are women", class_="metric-label"),
-                        #ui.div("↑ 2.3% from last season", class_="metric-trend positive"),
+                        ui.output_ui("nbr_farmers_women_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -342,8 +332,9 @@ app_ui = ui.page_fluid(
                     ui.card_header("Youth Engagement", class_="youth-header"),
                     ui.div(
                         ui.output_text("nbr_farmers_young"),
-                        ui.span("of all the farmers are young", class_="metric-label"),
-                        #ui.div("↑ 1.8% from last season", class_="metric-trend positive"),
+                        ui.span(f"of all the farmers are young (under {YOUTH_AGE})", class_="metric-label"),
+                        ui.output_ui("nbr_farmers_young_trend"),
+                        ui.output_ui("farmer_age_bands"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -378,6 +369,7 @@ app_ui = ui.page_fluid(
                         )
                     ),
                     ui.nav_panel("Coffee Farms View",
+                        ui.output_ui("admin_drilldown"),
                         ui.div(
                             ui.output_ui("map_farms"),
                             class_="map-container"
@@ -392,7 +384,7 @@ app_ui = ui.page_fluid(
                     ui.div(
                         ui.output_text("farm_area"),
                         ui.span("Hectares", class_="metric-label"),
-                        #ui.div("↑ 3.2% from last season", class_="metric-trend positive"),
+                        ui.output_ui("farm_area_trend"),
                         class_="metric-value"
                     ),
                     class_="metric-card"
@@ -404,10 +396,36 @@ app_ui = ui.page_fluid(
                 ui.card(
                     ui.card_header("# Farmers per training touch points", class_="hh-with-youth-header"),
                     ui.output_ui("touch_points_chart")
+                ),
+                ui.card(
+                    ui.card_header("CWS capacity and expected cherry per district", class_="area-header"),
+                    ui.output_ui("capacity_chart")
+                ),
+                ui.card(
+                    ui.card_header("Export the current selection", class_="farmers-header"),
+                    ui.input_select("export_format", None,
+                                    {fmt: label for fmt, (label, _, _) in EXPORT_FORMATS.items()}),
+                    ui.div(
+                        ui.download_button("export_farms", "Farms"),
+                        ui.download_button("export_farmers", "Farmers"),
+                        class_="export-buttons"
+                    )
+                ),
+                ui.card(
+                    ui.card_header("Printable report", class_="youth-header"),
+                    ui.div(
+                        ui.input_select("report_format", None,
+                                        {fmt: label for fmt, (label, _) in REPORT_FORMATS.items()}),
+                        ui.input_action_button("generate_report", "Generate"),
+                        class_="export-buttons"
+                    ),
+                    ui.output_ui("report_status")
                 )
             )
         )
     ),
+    # hidden diagnostics panel (only present when instrumentation is enabled)
+    diagnostics_panel(),
     # Remove spinners when the content is fully loaded
     ui.tags.script("""
         $(document).on('shiny:outputinvalidated', function(event) {
@@ -426,520 +444,973 @@ app_ui = ui.page_fluid(
 
 # Define the server function
 def server(input, output, session):
-    # Load data
+    # Data tables, shared by all sessions and refreshed when their files change
+    #-------------------------------
+    store.start()
+    data_cws, data_farmers, data_farms = (store.reactive_table(name) for name in ('cws', 'farmers', 'farms'))
+    boundary_topology = store.reactive_table('boundary_topology')
+    register_diagnostics(input, output, session)
+
+    kpis = store.reactive_table('kpis')
+    catchments = store.reactive_table('catchments')
+    cws_service_areas = store.reactive_table('cws_service_areas')
+    cws_capacity = store.reactive_table('cws_capacity')
+    district_locator = store.reactive_table('district_locator')
+    cws_locator = store.reactive_table('cws_locator')
+    admin = store.reactive_table('admin')
+    report_layers = store.reactive_table('report_map_layers')
+
+    # Monthly KPI totals and the registration period filter
     #-------------------------------
-    current_dir = Path(__file__).parent # Get the directory of the current script
-    coffee_data_path = current_dir / "data" 
-    geo_data_path = current_dir / "data_wgs84"  
-    country, lakes, parks, districts = load_geo_data(geo_data_path)
-    data_cws, data_farmers, data_farms = load_data(coffee_data_path)
+    @output
+    @render.ui
+    @instrument()
+    def date_range_filter():
+        first, last = kpis().date_span()
+        if first is None:
+            return None
+        return ui.input_date_range("date_range", "Farms registered between", start=first, end=last,
+                                   min=first, max=last, format="M yyyy", startview="year")
+
+    # (start, end) months of the filter, open ended until it is set
+    @reactive.Calc
+    @instrument()
+    def selected_months():
+        if not input.date_range.is_set():
+            return None, None
+        start, end = input.date_range()
+        return (month_of(start) if start else None, month_of(end) if end else None)
+
+    # demographics of the farmers of the selected district/sector/cell or CWS
+    # (all farmers otherwise)
+    @reactive.Calc
+    @instrument()
+    def farmer_totals():
+        return engine.farmer_totals(current_selection(), selected_months(), kpis(),
+                                    data_farmers(), data_farms(), admin())
+
+    # change of `value(totals)` over the last month of the period, as a trend line
+    def trend_ui(value, totals, previous, month, points=False):
+        if previous is None:
+            return None
+        trend = describe_change(value(totals), value(previous), month, points)
+        if trend is None:
+            return None
+        text, direction = trend
+        return ui.div(text, class_=f"metric-trend {direction}")
+
+    def women_share(totals):
+        return percent(totals['women'], totals['farmers'])
+
+    def young_share(totals):
+        return percent(totals['young'], totals['farmers'])
 
     @output
     @render.text
+    @instrument()
     def nbr_farmers():
-        return f"{len(data_farmers):,.0f}"
-     
+        totals, _, _ = farmer_totals()
+        return f"{totals['farmers']:,.0f}"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_trend():
+        return trend_ui(lambda totals: totals['farmers'], *farmer_totals())
     
     @output
     @render.text
+    @instrument()
     def nbr_farmers_women():
-        women = len(data_farmers[data_farmers['gender'] == 'female'])
-        return f"{(women / len(data_farmers)) * 100:.1f}%"
+        totals, _, _ = farmer_totals()
+        return f"{women_share(totals):.1f}%"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_women_trend():
+        return trend_ui(women_share, *farmer_totals(), points=True)
     
     @output
     @render.text
+    @instrument()
     def nbr_farmers_young():
-        young = len(data_farmers[data_farmers['age'].astype(int) < 30])
-        return f"{(young / len(data_farmers)) * 100:.1f}%"
+        totals, _, _ = farmer_totals()
+        return f"{young_share(totals):.1f}%"
+
+    @output
+    @render.ui
+    @instrument()
+    def nbr_farmers_young_trend():
+        return trend_ui(young_share, *farmer_totals(), points=True)
+
+    @output
+    @render.ui
+    @instrument()
+    def farmer_age_bands():
+        totals, _, _ = farmer_totals()
+        shares = kpis().demographics.band_shares(totals)
+        return ui.div(" · ".join(f"{band}: {share:.0f}%" for band, share in shares), class_="metric-label")
     
     @output
     @render.text
+    @instrument()
     def hh_with_youth():
-        hh_with_youth = data_farmers[data_farmers['youth_in_hh'] != 0].shape[0]
-        return f"{(hh_with_youth / len(data_farmers)) * 100:.1f}%"
+        totals, _, _ = farmer_totals()
+        return f"{percent(totals['hh_with_youth'], totals['farmers']):.1f}%"
     
     @output
     @render.text
+    @instrument()
     def youth_in_hh():
-        youth_in_hh = data_farmers['youth_in_hh'].dropna().astype(int).sum()
-        return f"{youth_in_hh:,.0f}"
+        totals, _, _ = farmer_totals()
+        return f"{totals['youth_in_hh']:,.0f}"
     
-    # Initialize reactive value for coordinates
-    clicked_coords = reactive.Value({'lat': None, 'lng': None})
+    # Initialize reactive value for coordinates (clicks land here, see map_state);
+    # resetting to the same `no_click` again does not invalidate anything
+    no_click = {'lat': None, 'lng': None}
+    pending_coords = reactive.Value(no_click)
 
     # Update the clicked coordinates variable
     @reactive.Effect
     @reactive.event(input.clicked_coords)
+    @instrument("update_clicked_coords")
     def _():
         coords = input.clicked_coords()
         if coords is not None:
-            clicked_coords.set({
+            pending_coords.set({
                 'lat': float(coords[0]),
                 'lng': float(coords[1])
             })
 
+    # the tab in focus and the clicked spot, updated together once clicks and
+    # tab switches have settled for CLICK_DEBOUNCE_SECS: a burst of clicks
+    # recomputes the selection once, for the last click only
+    @debounce(CLICK_DEBOUNCE_SECS)
+    @instrument()
+    def map_state():
+        return input.map_tabs(), pending_coords.get()
+
+    @reactive.Calc
+    @instrument()
+    def active_tab():
+        return map_state()[0]
+
+    @reactive.Calc
+    @instrument()
+    def clicked_coords():
+        return map_state()[1]
+
     # Calculate reactive variables used for interactivity
     #------------------------------------------------
     #1. get the clicked district
     @reactive.Calc
+    @instrument()
     def selected_district():
-        coords = clicked_coords.get()
+        coords = clicked_coords()
         if coords['lat'] is not None and coords['lng'] is not None:
-            point = gpd.GeoDataFrame(
-                [{"geometry": Point(coords['lng'], coords['lat'])}],
-                crs="EPSG:4326"
-            )
-            current_district = gpd.sjoin(districts, point, how="inner", predicate="intersects")
-            return current_district
+            return engine.locate_district(district_locator(), coords['lat'], coords['lng'])
         return None
     
-    #2. get the farms in the selected district
+    # (level, unit positions) from the clicked district down to the sector
+    # and cell picked within it in the drill-down
     @reactive.Calc
-    def selected_farms():
+    @instrument()
+    def drill_path():
         cur_district = selected_district()
-        if cur_district is not None:
-            distr_farms = gpd.sjoin(data_farms, cur_district.loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-            return distr_farms
+        if cur_district is None:
+            return None
+        hierarchy = admin()
+        path = [('district', hierarchy.positions('district', cur_district['district']))]
+        child = hierarchy.child_level('district')
+        while child is not None and input[f"drill_{child}"].is_set():
+            picked = input[f"drill_{child}"]()
+            # a pick left over from another district does not apply
+            if not picked or int(picked) not in hierarchy.children(*path[-1]):
+                break
+            path.append((child, [int(picked)]))
+            child = hierarchy.child_level(child)
+        return path
+
+    # the unit drilled into, (level, unit positions)
+    @reactive.Calc
+    @instrument()
+    def selected_unit():
+        path = drill_path()
+        return path[-1] if path is not None else None
+
+    # drill-down selects for the sectors and cells of the clicked district
+    # (only when their boundaries are available), labelled with their rollups
+    @output
+    @render.ui
+    @instrument()
+    def admin_drilldown():
+        hierarchy = admin()
+        path = drill_path()
+        if len(hierarchy.levels) < 2 or path is None or not len(path[0][1]):
+            return None
+        selects = []
+        for i, (level, units) in enumerate(path):
+            child = hierarchy.child_level(level)
+            if child is None:
+                break
+            rollup = hierarchy.rollup(child, hierarchy.children(level, units))
+            choices = {"": f"All {child}s"}
+            for pos, row in rollup.iterrows():
+                choices[str(pos)] = f"{row[child].title()} ({row['farms']:,.0f} farms, {row['area']:,.1f} ha)"
+            picked = str(path[i + 1][1][0]) if i + 1 < len(path) else ""
+            selects.append(ui.input_select(f"drill_{child}", child.title(), choices, selected=picked))
+        return ui.div(*selects, class_="drilldown")
+
+    #2. get the farms in the selected district (or sector/cell), on the executor
+    @offloaded_calc
+    @instrument()
+    def selected_farms():
+        cur_unit = selected_unit()
+        if cur_unit is not None:
+            level, units = cur_unit
+            hierarchy = admin()
+            return lambda: engine.unit_farms(hierarchy, level, units)
         return None
     
-    #3. Get the nearest CWS to the clicked spot on the CWS map
+    #3. Get the nearest CWS to the clicked spot on the CWS map (an index lookup)
     @reactive.Calc
+    @instrument()
     def selected_cws():
-        clicked_spot = clicked_coords.get()
+        clicked_spot = clicked_coords()
         if clicked_spot['lat'] is not None and clicked_spot['lng'] is not None:
-            point_coords = (clicked_spot['lat'], clicked_spot['lng'])
-            
-            # Calculate distances from clicked point to all CWS locations
-            distances = data_cws.geometry.apply(
-                lambda x: geodesic(
-                    point_coords,
-                    (x.y, x.x)
-                ).meters
-            )
-            
-            # Get the index of the minimum distance
-            nearest_idx = distances.idxmin()
-            
-            # Return the nearest CWS
-            return data_cws.iloc[[nearest_idx]]
+            return engine.nearest_cws(cws_locator(), clicked_spot['lat'], clicked_spot['lng'])
         return None
     
+    # farmers of the selected CWS and their farms
+    @reactive.Calc
+    @instrument()
+    def selected_cws_members():
+        cur_cws = selected_cws()
+        if cur_cws is None:
+            return None
+        return engine.cws_members(data_farmers(), data_farms(), str(cur_cws['cws_id'].values[0]))
+
+    # what the cards and charts are about: the unit drilled into on the farms
+    # map, the station picked on the CWS map, or ALL (see coffee_core.engine)
+    @reactive.Calc
+    @instrument()
+    def current_selection():
+        current_tab = active_tab() # check which map is currently in focus
+        if current_tab == "Coffee Farms View" and selected_unit() is not None:
+            level, units = selected_unit()
+            return (level, tuple(units))
+        elif current_tab == "CWS View" and selected_cws() is not None:
+            return ('cws', str(selected_cws()['cws_id'].values[0]))
+        return ALL
+
     # Add a reactive effect to reset selected_cws and selected-district to Null 
     # This will trigger whenever the map tab changes
     @reactive.Effect
+    @instrument("reset_on_tab_change")
     def _():
         input.map_tabs()
-        clicked_coords.set({'lat': None, 'lng': None}) 
+        pending_coords.set(no_click)
   
     @output
     @render.ui
-    def map_cws():
-        # Create a folium map centered at Rwanda's center
-        m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8) 
-
-        # Style function for the country
-        def style_country(feature):
-            return {
-                'fillColor': '#acbbb4', 
-                'color': '#3f4b46',   
-                'weight': 4,     
-                'fillOpacity': 0.2
-            }
+    @instrument()
+    async def map_cws():
+        # the reactive inputs are read here and the map is built on the executor
+        def build(boundaries, cws_service_areas, data_cws, cur_cws, catchments, cws_capacity):
+            # Create a folium map centered at Rwanda's center
+            m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8) 
+
+            # Style function for the country
+            def style_country(feature):
+                return {
+                    'fillColor': '#acbbb4', 
+                    'color': '#3f4b46',   
+                    'weight': 4,     
+                    'fillOpacity': 0.2
+                }
         
-        # Style function for the districts
-        def style_districts(feature):
-            return {
-                'fillColor': '#acbbb4', 
-                'color': '#3f4b46',   
-                'weight': 2,     
-                'fillOpacity': 0.2
-            }
+            # Style function for the districts
+            def style_districts(feature):
+                return {
+                    'fillColor': '#acbbb4', 
+                    'color': '#3f4b46',   
+                    'weight': 2,     
+                    'fillOpacity': 0.2
+                }
     
-        # Style function for lakes
-        def style_lakes(feature):
-            return {
-                'fillColor': '#37a3bd', 
-                'color': '#345a6a',   
-                'weight': 1,     
-                'fillOpacity': 0.6
-            }
+            # Style function for lakes
+            def style_lakes(feature):
+                return {
+                    'fillColor': '#37a3bd', 
+                    'color': '#345a6a',   
+                    'weight': 1,     
+                    'fillOpacity': 0.6
+                }
 
-        # Style function for national parks
-        def style_parks(feature):
-            return {
-                'fillColor': '#13764b',  
-                'color': '#006600',   
-                'weight': 2,     
-                'fillOpacity': 0.6
-            }
+            # Style function for national parks
+            def style_parks(feature):
+                return {
+                    'fillColor': '#13764b',  
+                    'color': '#006600',   
+                    'weight': 2,     
+                    'fillOpacity': 0.6
+                }
 
-        # Add base layers
-        folium.GeoJson(country, name="Country boundary", 
-                       style_function=style_country
-                       ).add_to(m) 
-        folium.GeoJson(districts, name="Districts", 
-                       style_function=style_districts,
-                       tooltip=folium.GeoJsonTooltip(fields=["district"])
-                       ).add_to(m) 
-        folium.GeoJson(parks, name="National parks", 
-                       style_function=style_parks
-                       ).add_to(m)
-        folium.GeoJson(lakes, name="Lakes", 
-                       style_function=style_lakes
-                       ).add_to(m) 
-
-        # Add CWS points.
-        # we will map the size of the markers to the capacity of each CWS
-
-        # Create 3 classes using Jenks Natural Breaks
-        breaks = jenkspy.jenks_breaks(data_cws['actual_capacity'].values, n_classes=3)
-
-        # Define circle sizes for each class
-        size_classes = [4, 7, 10]  # fatory sizes: small, medium, large
-
-        # Create legend HTML
-        legend_html = f'''
-        <div style="position: fixed; 
-                    bottom: 10px; right: 10px; 
-                    width: 200px; 
-                    border:1px solid rgba(128, 128, 128, 0.6); 
-                    z-index:9999; 
-                    background-color: rgba(255, 255, 255, 0.6);
-                    padding: 12px;
-                    border-radius: 6px;
-                    box-shadow: 0 1px 5px rgba(0,0,0,0.2);">
-            <div style="font-size: 16px; font-weight: bold; margin-bottom: 10px;">
-                Capacity (Tonnes/Season)
-            </div>
-            <div style="display: flex; align-items: center; margin: 8px 0;">
-                <div style="width: 8px; height: 8px; background-color: #011e0b99; border-radius: 50%; margin-right: 8px;"></div>
-                <div>{breaks[0]:.0f} - {breaks[1]:.0f}</div>
-            </div>
-            <div style="display: flex; align-items: center; margin: 8px 0;">
-                <div style="width: 14px; height: 14px; background-color: #011e0b99; border-radius: 50%; margin-right: 8px;"></div>
-                <div>{breaks[1]:.0f} - {breaks[2]:.0f}</div>
-            </div>
-            <div style="display: flex; align-items: center; margin: 8px 0;">
-                <div style="width: 20px; height: 20px; background-color: rgba(1, 30, 11, 0.6); border-radius: 50%; margin-right: 8px;"></div>
-                <div>{breaks[2]:.0f} - {breaks[3]:.0f}</div>
-            </div>
-        </div>'''
-        m.get_root().html.add_child(folium.Element(legend_html))
-
-        # Add points with sizes based on Jenks classes
-        for idx, row in data_cws.iterrows():
-            name = row['cws_name'] 
-            capacity = row['actual_capacity']
-            if capacity <= breaks[1]:
-                radius = size_classes[0]
-            elif capacity <= breaks[2]:
-                radius = size_classes[1]
-            else:
-                radius = size_classes[2]
+            # Style function for the CWS service areas
+            def style_service_areas(feature):
+                return {
+                    'fillColor': '#bcb32e',
+                    'color': '#7a7420',
+                    'weight': 1,
+                    'dashArray': '4',
+                    'fillOpacity': 0.1
+                }
+
+            # Add base layers, drawn from the boundaries' shared topology
+            TopoJsonLayer(boundaries, 'country', name="Country boundary",
+                          style_function=style_country
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'districts', name="Districts",
+                          style_function=style_districts,
+                          tooltip=folium.GeoJsonTooltip(fields=["district"])
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'parks', name="National parks",
+                          style_function=style_parks
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'lakes', name="Lakes",
+                          style_function=style_lakes
+                          ).add_to(m)
+            # the land closest to each station, to spot coverage gaps
+            GeoJson(cws_service_areas, name="CWS service areas",
+                           style_function=style_service_areas,
+                           tooltip=folium.GeoJsonTooltip(fields=["cws_name", "area_km2"], aliases=["CWS", "Area (km²)"])
+                           ).add_to(m)
+
+            # rings colored by how much of its processing capacity each station used
+            GeoJson(cws_capacity.layer, name="CWS capacity utilization",
+                           marker=folium.CircleMarker(radius=13, fill=False, weight=3),
+                           style_function=lambda feature: {'color': feature['properties']['color']},
+                           tooltip=folium.GeoJsonTooltip(fields=["cws_name", "utilization", "supply_gap", "farmers_gap"],
+                                                         aliases=["CWS", "Capacity used", "Supply gap", "Farmers gap"])
+                           ).add_to(m)
+            utilization_legend = "".join(
+                f'<div style="display: flex; align-items: center; margin: 4px 0;">'
+                f'<div style="width: 12px; height: 12px; border: 3px solid {color}; border-radius: 50%; margin-right: 8px;"></div>'
+                f'<div>{label}</div></div>'
+                for _, label, color in UTILIZATION_CLASSES)
+            m.get_root().html.add_child(folium.Element(f'''
+            <div style="position: fixed;
+                        bottom: 10px; left: 10px;
+                        border:1px solid rgba(128, 128, 128, 0.6);
+                        z-index:9999;
+                        background-color: rgba(255, 255, 255, 0.6);
+                        padding: 12px;
+                        border-radius: 6px;
+                        box-shadow: 0 1px 5px rgba(0,0,0,0.2);">
+                <div style="font-size: 16px; font-weight: bold; margin-bottom: 10px;">Capacity used</div>
+                {utilization_legend}
+            </div>'''))
+
+            # Add CWS points.
+            # we will map the size of the markers to the capacity of each CWS
+
+            # Create 3 classes using Jenks Natural Breaks
+            breaks = jenkspy.jenks_breaks(data_cws['actual_capacity'].values, n_classes=3)
+
+            # Define circle sizes for each class
+            size_classes = [4, 7, 10]  # fatory sizes: small, medium, large
+
+            # Create legend HTML
+            legend_html = f'''
+            <div style="position: fixed; 
+                        bottom: 10px; right: 10px; 
+                        width: 200px; 
+                        border:1px solid rgba(128, 128, 128, 0.6); 
+                        z-index:9999; 
+                        background-color: rgba(255, 255, 255, 0.6);
+                        padding: 12px;
+                        border-radius: 6px;
+                        box-shadow: 0 1px 5px rgba(0,0,0,0.2);">
+                <div style="font-size: 16px; font-weight: bold; margin-bottom: 10px;">
+                    Capacity (Tonnes/Season)
+                </div>
+                <div style="display: flex; align-items: center; margin: 8px 0;">
+                    <div style="width: 8px; height: 8px; background-color: #011e0b99; border-radius: 50%; margin-right: 8px;"></div>
+                    <div>{breaks[0]:.0f} - {breaks[1]:.0f}</div>
+                </div>
+                <div style="display: flex; align-items: center; margin: 8px 0;">
+                    <div style="width: 14px; height: 14px; background-color: #011e0b99; border-radius: 50%; margin-right: 8px;"></div>
+                    <div>{breaks[1]:.0f} - {breaks[2]:.0f}</div>
+                </div>
+                <div style="display: flex; align-items: center; margin: 8px 0;">
+                    <div style="width: 20px; height: 20px; background-color: rgba(1, 30, 11, 0.6); border-radius: 50%; margin-right: 8px;"></div>
+                    <div>{breaks[2]:.0f} - {breaks[3]:.0f}</div>
+                </div>
+            </div>'''
+            m.get_root().html.add_child(folium.Element(legend_html))
+
+            # Add points with sizes based on Jenks classes
+            for idx, row in data_cws.iterrows():
+                name = row['cws_name'] 
+                capacity = row['actual_capacity']
+                if capacity <= breaks[1]:
+                    radius = size_classes[0]
+                elif capacity <= breaks[2]:
+                    radius = size_classes[1]
+                else:
+                    radius = size_classes[2]
                 
-            folium.CircleMarker(
-                location=[row.geometry.y, row.geometry.x],
-                radius=radius,
-                color='#011e0b',
-                opacity=0.6, 
-                fill=True,
-                fillColor='#011e0b', 
-                fillOpacity=0.6,
-                tooltip=f"<strong>Name:</strong> {name}<br><strong>Capacity:</strong> {capacity} Tonnes" 
-            ).add_to(m)
-
-        # hightlght currently selected CWSs
-        cur_cws = selected_cws()
-        if cur_cws is not None and not cur_cws.empty:
-            folium.CircleMarker(
-                location=[cur_cws.geometry.y, cur_cws.geometry.x],
-                radius=3,
-                color='yellow',
-                fill=True,
-                fillOpacity=0.6
-            ).add_to(m)
-
-        # attach a click event handler which captures the coordinates of
-        # the click location and sends them to shiny to update the clicked_coords variable
-        map_name = m.get_name()
-        code = """
-        {% macro script(this,kwargs) %}
-        function getLatLng(e){
-            var lat = e.latlng.lat.toFixed(6),
-                lng = e.latlng.lng.toFixed(6);
-            parent.Shiny.setInputValue('clicked_coords', [lat, lng], {priority: 'event'});
-        }; """ +  map_name + ".on('click', getLatLng){% endmacro %}"
+                folium.CircleMarker(
+                    location=[row.geometry.y, row.geometry.x],
+                    radius=radius,
+                    color='#011e0b',
+                    opacity=0.6, 
+                    fill=True,
+                    fillColor='#011e0b', 
+                    fillOpacity=0.6,
+                    tooltip=f"<strong>Name:</strong> {name}<br><strong>Capacity:</strong> {capacity} Tonnes" 
+                ).add_to(m)
+
+            # hightlght currently selected CWSs and show its supply base
+            if cur_cws is not None and not cur_cws.empty:
+                cur_station = cur_cws.iloc[0]
+                base = catchments.supply_base(cur_station['cws_id'])
+                popup = None
+                if base is not None:
+                    lines = [f"<strong>Name:</strong> {cur_station['cws_name']}"]
+                    lines += [f"<strong>{label}:</strong> {text}" for label, text in supply_base_lines(base)]
+                    lines += [f"<strong>{label}:</strong> {text}"
+                              for label, text in cws_capacity.station_lines(cur_station['cws_id'])]
+                    popup = folium.Popup("<br>".join(lines), max_width=300, show=True)
+                folium.CircleMarker(
+                    location=[cur_station.geometry.y, cur_station.geometry.x],
+                    radius=3,
+                    color='yellow',
+                    fill=True,
+                    fillOpacity=0.6,
+                    popup=popup
+                ).add_to(m)
+
+            # attach a click event handler which captures the coordinates of
+            # the click location and sends them to shiny to update the clicked_coords variable
+            map_name = m.get_name()
+            code = """
+            {% macro script(this,kwargs) %}
+            function getLatLng(e){
+                var lat = e.latlng.lat.toFixed(6),
+                    lng = e.latlng.lng.toFixed(6);
+                parent.Shiny.setInputValue('clicked_coords', [lat, lng], {priority: 'event'});
+            }; """ +  map_name + ".on('click', getLatLng){% endmacro %}"
         
-        el = folium.MacroElement().add_to(m)
-        el._template = Template(code)
+            el = folium.MacroElement().add_to(m)
+            el._template = Template(code)
         
-        # Add layer control
-        folium.LayerControl().add_to(m)
-        m.get_root().height = "100%"
+            # Add layer control
+            folium.LayerControl().add_to(m)
+            m.get_root().height = "100%"
+
+            # return the map as a HTML object
+            return m._repr_html_()
 
-        # return the map as a HTML object
-        return ui.HTML(m._repr_html_())
+        html = await offload(build, boundary_topology(), cws_service_areas(), data_cws(),
+                             selected_cws(), catchments(), cws_capacity())
+        return ui.HTML(html)
     
-    # Render the coffee farms map
+    # Render the coffee farms map, once per data load: the selection is sent to
+    # the page (see the effects below) and drawn on the map already there
     @output
     @render.ui
-    def map_farms():
-        # Create a folium map centered around Rwanda's centroid point
-        m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8) 
+    @instrument()
+    async def map_farms():
+        # the reactive inputs are read here and the map is built on the executor
+        def build(boundaries, hierarchy):
+            # Create a folium map centered around Rwanda's centroid point
+            m = folium.Map(location=[-1.9403, 29.8739], zoom_start=8) 
         
-        # Style function for the country
-        def style_country(feature):
-            return {
-                'fillColor': '#acbbb4', 
-                'color': '#3f4b46',   
-                'weight': 4,     
-                'fillOpacity': 0.2
-            }
+            # Style function for the country
+            def style_country(feature):
+                return {
+                    'fillColor': '#acbbb4', 
+                    'color': '#3f4b46',   
+                    'weight': 4,     
+                    'fillOpacity': 0.2
+                }
         
-        # Style function for the districts
-        def style_districts(feature):
-            return {
-                'fillColor': '#acbbb4', 
-                'color': '#3f4b46',   
-                'weight': 2,     
-                'fillOpacity': 0.2
-            }
+            # Style function for the districts
+            def style_districts(feature):
+                return {
+                    'fillColor': '#acbbb4', 
+                    'color': '#3f4b46',   
+                    'weight': 2,     
+                    'fillOpacity': 0.2
+                }
     
-        # Style function for lakes
-        def style_lakes(feature):
-            return {
-                'fillColor': '#37a3bd', 
-                'color': '#345a6a',   
-                'weight': 1,     
-                'fillOpacity': 0.6
-            }
+            # Style function for lakes
+            def style_lakes(feature):
+                return {
+                    'fillColor': '#37a3bd', 
+                    'color': '#345a6a',   
+                    'weight': 1,     
+                    'fillOpacity': 0.6
+                }
+
+            # Style function for national parks
+            def style_parks(feature):
+                return {
+                    'fillColor': '#13764b',  
+                    'color': '#006600',   
+                    'weight': 2,     
+                    'fillOpacity': 0.6
+                }
+
+            # Add base layers, drawn from the boundaries' shared topology
+            TopoJsonLayer(boundaries, 'country', name="Country boundary",
+                          style_function=style_country
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'districts', name="Districts",
+                          style_function=style_districts,
+                          tooltip=folium.GeoJsonTooltip(fields=["district"])
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'parks', name="National parks",
+                          style_function=style_parks
+                          ).add_to(m)
+            TopoJsonLayer(boundaries, 'lakes', name="Lakes",
+                          style_function=style_lakes
+                          ).add_to(m)
 
-        # Style function for national parks
-        def style_parks(feature):
-            return {
-                'fillColor': '#13764b',  
-                'color': '#006600',   
-                'weight': 2,     
+            # Style of the selected district
+            style_selected_district = {
+                'fillColor': '#ff7800',
+                'color': '#000000',
+                'weight': 2,
                 'fillOpacity': 0.6
             }
 
-        # Add base layers
-        folium.GeoJson(country, name="Country boundary", 
-                       style_function=style_country
-                       ).add_to(m) 
-        folium.GeoJson(districts, name="Districts", 
-                       style_function=style_districts,
-                       tooltip=folium.GeoJsonTooltip(fields=["district"])
-                       ).add_to(m) 
-        folium.GeoJson(parks, name="National parks", 
-                       style_function=style_parks
-                       ).add_to(m)
-        folium.GeoJson(lakes, name="Lakes", 
-                       style_function=style_lakes
-                       ).add_to(m) 
-
-        # Add the selected district layer
-        style_selected_district = {
-            'fillColor': '#ff7800',
-            'color': '#000000',
-            'weight': 2,
-            'fillOpacity': 0.6
-        }
-        cur_district = selected_district()
-        if cur_district is not None and not cur_district.empty:
-            folium.GeoJson(
-                cur_district,
-                name="Selected District",
-                style_function=lambda x: style_selected_district,
-                tooltip=folium.GeoJsonTooltip(fields=["district"])
-            ).add_to(m)
-
-        # Create a MarkerCluster layer for the coffee farms
-        marker_cluster_farms = MarkerCluster().add_to(m)
-
-        # Add farm points to the MarkerCluster
-        for idx, row in data_farms.iterrows():
-            folium.CircleMarker(
-                location=[row.geometry.y, row.geometry.x],
-                radius=2,
-                color='#011e0b',
-                fill=True,
-                fillOpacity=0.6
-            ).add_to(marker_cluster_farms)
-
-        # hightlght farms in the selected district
-        cur_farms = selected_farms()
-        if cur_farms is not None and not cur_farms.empty:
-            for idx, row in cur_farms.iterrows():
-                folium.CircleMarker(
-                    location=[row.geometry.y, row.geometry.x],
-                    radius=3,
-                    color='blue',
-                    fill=True,
-                    fillOpacity=0.6
+            # the selected district, and the sector/cell drilled into within
+            # it, drawn from the units sent on each click
+            packed.SentGeoJson("selected_district", name="Selected District",
+                               style=style_selected_district, tooltip_fields=["district"]).add_to(m)
+            packed.SentGeoJson("selected_unit", name="Selected Sector/Cell",
+                               style={**style_selected_district, 'fillColor': '#ffd000'},
+                               tooltip_fields=["unit"]).add_to(m)
+
+            if viewport.ENABLED:
+                # report the (debounced) viewport to shiny and draw the farms it sends
+                # back; the farms selected are highlighted, and restyled in
+                # place when the bitmask of the selection is sent
+                code = """
+                {% macro script(this,kwargs) %}
+                var farmStyles = {
+                    selected: {radius: 3, color: 'blue', fill: true, fillOpacity: 0.6},
+                    other: {radius: 2, color: '#011e0b', fill: true, fillOpacity: 0.6}
+                };
+                var selectedMask = null;
+                var selectedFarms = Promise.resolve(function(i) { return false; });
+                var farmsInView = L.layerGroup().addTo(""" + m.get_name() + """);
+                function farmStyle(selected, feature) {
+                    return selected(feature.id) ? farmStyles.selected : farmStyles.other;
+                }
+                parent.Shiny.addCustomMessageHandler('selected_farms', function(msg) {
+                    var mask = selectedMask = msg.mask;
+                    selectedFarms = mask ? unpackMask(mask) : Promise.resolve(function(i) { return false; });
+                    selectedFarms.then(function(selected) {
+                        // a later selection was sent meanwhile
+                        if (mask !== selectedMask) {
+                            return;
+                        }
+                        farmsInView.eachLayer(function(farms) {
+                            farms.eachLayer(function(layer) {
+                                if (layer.feature.properties.farms === undefined) {
+                                    layer.setStyle(farmStyle(selected, layer.feature));
+                                }
+                            });
+                        });
+                    });
+                });
+                var farmsHint = L.control({position: 'bottomright'});
+                farmsHint.onAdd = function() { return L.DomUtil.create('div', 'farms-hint'); };
+                farmsHint.addTo(""" + m.get_name() + """);
+                var viewportTimer = null;
+                function sendViewport(){
+                    clearTimeout(viewportTimer);
+                    viewportTimer = setTimeout(function() {
+                        var map = """ + m.get_name() + """, b = map.getBounds();
+                        parent.Shiny.setInputValue('farms_viewport',
+                            [b.getSouth(), b.getWest(), b.getNorth(), b.getEast(), map.getZoom()]);
+                    }, """ + str(int(viewport.DEBOUNCE_SECS * 1000)) + """);
+                };
+                parent.Shiny.addCustomMessageHandler('farms_in_view', function(msg) {
+                    Promise.all([unpackLayer(msg.farms), selectedFarms]).then(function(results) {
+                        var farms = results[0], selected = results[1];
+                        farmsInView.clearLayers();
+                        L.geoJSON(farms, {
+                            pointToLayer: function(feature, latlng) {
+                                return L.circleMarker(latlng, farmStyle(selected, feature));
+                            },
+                            // density hexagons, when zoomed out
+                            style: function(feature) { return feature.properties.style; },
+                            onEachFeature: function(feature, layer) {
+                                if (feature.properties.farms !== undefined) {
+                                    layer.bindTooltip(feature.properties.farms.toLocaleString() + ' farms');
+                                }
+                            }
+                        }).addTo(farmsInView);
+                        farmsHint.getContainer().innerHTML = msg.hint;
+                    });
+                });
+                """ + m.get_name() + """.on('moveend', sendViewport);
+                sendViewport();
+                {% endmacro %}"""
+                el = folium.MacroElement().add_to(m)
+                el._template = Template(code)
+                # the farms come packed or as GeoJSON, `unpackLayer` takes both
+                packed.add_decoder(m)
+            else:
+                # Create a MarkerCluster layer for the coffee farms, all the
+                # farm points in one layer (packed or GeoJSON), with their
+                # positions in the farms table as feature ids
+                marker_cluster_farms = MarkerCluster().add_to(m)
+                farms_layer = GeoJson(
+                    hierarchy.farms[['geometry']].reset_index(drop=True),
+                    marker=folium.CircleMarker(radius=2, color='#011e0b', fill=True, fillOpacity=0.6),
+                    control=False
+                ).add_to(marker_cluster_farms)
+
+                # hightlght farms in the selected district, from the bitmask
+                # of their positions sent on each click
+                packed.SelectedFeatures(
+                    farms_layer, "selected_farms",
+                    marker=folium.CircleMarker(radius=3, color='blue', fill=True, fillOpacity=0.6)
                 ).add_to(m)
 
-        # attach a click event handler which captures the coordinates of the click location
-        #  and sends them to shiny to update the clicked_coords variable
-        map_name = m.get_name()
-        code = """
-        {% macro script(this,kwargs) %}
-        function getLatLng(e){
-            var lat = e.latlng.lat.toFixed(6),
-                lng = e.latlng.lng.toFixed(6);
-            parent.Shiny.setInputValue('clicked_coords', [lat, lng], {priority: 'event'});
-        }; """ +  map_name + ".on('click', getLatLng){% endmacro %}"
+            # attach a click event handler which captures the coordinates of the click location
+            #  and sends them to shiny to update the clicked_coords variable
+            map_name = m.get_name()
+            code = """
+            {% macro script(this,kwargs) %}
+            function getLatLng(e){
+                var lat = e.latlng.lat.toFixed(6),
+                    lng = e.latlng.lng.toFixed(6);
+                parent.Shiny.setInputValue('clicked_coords', [lat, lng], {priority: 'event'});
+            }; """ +  map_name + ".on('click', getLatLng){% endmacro %}"
         
-        el = folium.MacroElement().add_to(m)
-        el._template = Template(code)
+            el = folium.MacroElement().add_to(m)
+            el._template = Template(code)
         
-        # Add layer control
-        folium.LayerControl().add_to(m)
-        m.get_root().height = "100%"
-            
-        # return the map as a HTML object
-        return ui.HTML(m._repr_html_())
+            # Add layer control
+            folium.LayerControl().add_to(m)
+            m.get_root().height = "100%"
+
+            # ask for the current selection once the page can draw it
+            code = """
+            {% macro script(this,kwargs) %}
+            parent.Shiny.setInputValue('farms_map_ready', Date.now(), {priority: 'event'});
+            {% endmacro %}"""
+            el = folium.MacroElement().add_to(m)
+            el._template = Template(code)
+
+            # return the map as a HTML object
+            return m._repr_html_()
+
+        html = await offload(build, boundary_topology(), admin())
+        return ui.HTML(html)
+
+    # the selected district (or sector/cell) sent to the farms map drawn on the
+    # page: the units' outlines, and the bitmask of their farms' positions
+    @reactive.Effect
+    @reactive.event(input.farms_map_ready, selected_district, ignore_none=False)
+    @instrument("highlight_selected_district")
+    async def _():
+        if not input.farms_map_ready.is_set():
+            return
+        cur_district = selected_district()
+        layer = None
+        if cur_district is not None and not cur_district.empty:
+            layer = await offload(packed_layer, cur_district[['district', 'geometry']])
+        await session.send_custom_message("selected_district", {"layer": layer})
+
+    @reactive.Effect
+    @reactive.event(input.farms_map_ready, selected_unit, ignore_none=False)
+    @instrument("highlight_selected_unit")
+    async def _():
+        if not input.farms_map_ready.is_set():
+            return
+        cur_unit = selected_unit()
+        hierarchy = admin()
+        layer = mask = None
+        if cur_unit is not None:
+            level, units = cur_unit
+            if level != 'district':
+                layer = await offload(packed_layer,
+                                      hierarchy.units(level, units)[[level, 'geometry']].rename(columns={level: 'unit'}))
+            selected = hierarchy.farm_positions(level, units)
+            if len(selected):
+                mask = packed.pack_mask(selected, len(hierarchy.farms))
+        await session.send_custom_message("selected_unit", {"layer": layer})
+        await session.send_custom_message("selected_farms", {"mask": mask})
         
+    # Lazy farms mode: send only the farms inside the reported viewport, or their
+    # density hexagons when zoomed out
+    if viewport.ENABLED:
+        farms_viewport_index = store.reactive_table('farms_view_index')
+        farm_hexbins = store.reactive_table('farm_hexbins')
+
+        @reactive.Effect
+        @reactive.event(input.farms_viewport, farms_viewport_index, farm_hexbins)
+        @instrument("update_farms_in_view")
+        async def _():
+            south, west, north, east, zoom = input.farms_viewport()
+            farms, hint = viewport.farms_in_view(farms_viewport_index(), ((south, west), (north, east)), zoom,
+                                                farm_hexbins())
+            if packed.ENABLED:
+                farms = await offload(packed.pack, farms)
+            await session.send_custom_message("farms_in_view", {"farms": farms, "hint": hint})
+
     # Calculate the reactive variables and update related charts
     #==========================================================
     #1. Farm area info card
+    # area totals of the farms in the selected district or CWS (all farms otherwise)
+    @reactive.Calc
+    @instrument()
+    def farm_totals():
+        return engine.farm_totals(current_selection(), selected_months(), kpis(), admin())
+
     @output
     @render.text
+    @instrument()
     def farm_area():
-        current_tab = input.map_tabs() # check which map is currently in focus
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Perform spatial join if a district is selected
-                filtered_farms = gpd.sjoin(data_farms, selected_district().loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-                total_area = filtered_farms['area'].sum()
-            else:
-                total_area = data_farms['area'].sum()
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_cws = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-                unique_national_ids = data_farmers_cws['national_id'].unique().tolist()
-                filtered_farms = data_farms[data_farms['national_id'].isin(unique_national_ids)]
-                total_area = filtered_farms['area'].sum()
-            else:
-                total_area = data_farms['area'].sum()
-        else:
-            total_area = data_farms['area'].sum()
+        totals, _, _ = farm_totals()
+        return f"{totals['area']:,.1f}" 
 
-        return f"{total_area:,.1f}" 
+    @output
+    @render.ui
+    @instrument()
+    def farm_area_trend():
+        return trend_ui(lambda totals: totals['area'], *farm_totals())
 
     # #2. Coffee trees chart
     @output
     @render.ui
-    def coffee_trees_chart():
-        # filter farms data based on the active tab and/or selected district-selected CWS
-        current_tab = input.map_tabs()
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Perform spatial filter if a district is selected
-                data_farms_filtered = gpd.sjoin(data_farms, selected_district().loc[:, ['district', 'geometry']], how="inner", predicate="intersects")
-            else:
-                data_farms_filtered = data_farms
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_cws = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-                unique_national_ids = data_farmers_cws['national_id'].unique().tolist()
-                data_farms_filtered = data_farms[data_farms['national_id'].isin(unique_national_ids)]
-            else:
-                data_farms_filtered = data_farms
+    @instrument()
+    async def coffee_trees_chart():
+        # the farms of the selected district/sector/cell or CWS (all farms otherwise)
+        selection = current_selection()
+        if selection == ALL:
+            data_farms_filtered = data_farms()
+        elif selection[0] == 'cws':
+            _, data_farms_filtered = selected_cws_members()
         else:
-            data_farms_filtered = data_farms
+            data_farms_filtered = selected_farms()
 
-        # Prepare the data for ploting
-        data = data_farms_filtered.groupby('age_range_coffee_trees')['nbr_coffee_trees'].sum().reset_index()
+        def chart_html():
+            # Prepare the data for ploting
+            data = engine.coffee_trees_data(selection, data_farms_filtered)
         
-        # Create the plot using plotly
-        fig = go.Figure()
-
-        fig.add_trace(go.Bar(
-            x=data['age_range_coffee_trees'],
-            y=data['nbr_coffee_trees'],
-            marker=dict(
-                color='rgba(50, 171, 96, 0.6)',
-                showscale=False,
-                colorbar=dict(title='age_range_coffee_trees')
-            )
-        ))
+            # Create the plot using plotly
+            fig = go.Figure()
 
-        # re-arrange the bars in the proper trees' age groups order
-        fig.update_layout(
-            xaxis = dict(
-                categoryorder='array',
-                categoryarray=["less_3", "3_to_7", "8_to_15", "16_to_30", "more_30"]
-            ),
-            height=260,
-            margin=dict(l=10, r=10, t=30, b=10),
-            autosize=True,
-            paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)'
-        )
+            fig.add_trace(go.Bar(
+                x=data['age_range_coffee_trees'],
+                y=data['nbr_coffee_trees'],
+                marker=dict(
+                    color='rgba(50, 171, 96, 0.6)',
+                    showscale=False,
+                    colorbar=dict(title='age_range_coffee_trees')
+                )
+            ))
+
+            # re-arrange the bars in the proper trees' age groups order
+            fig.update_layout(
+                xaxis = dict(
+                    categoryorder='array',
+                    categoryarray=TREE_AGE_RANGES
+                ),
+                height=260,
+                margin=dict(l=10, r=10, t=30, b=10),
+                autosize=True,
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)'
+            )
         
-        return ui.HTML(fig.to_html(full_html=False))
+            return fig.to_html(full_html=False)
+
+        # the chart is built once per selection, on the executor
+        return ui.HTML(await offload(selection_cache.get, "coffee_trees_chart", selection, [data_farms_filtered],
+                                     chart_html))
 
     # 3. training touchpoints chart  
     @output
     @render.ui
-    def touch_points_chart():
-        # filter farmers data based on the active tab and/or selected district-selected CWS
-        current_tab = input.map_tabs()
-        if current_tab == "Coffee Farms View":
-            if selected_district() is not None:
-                # Select the farmers in the selected district
-                cur_district = str(selected_district()['district'].values[0])
-                data_farmers_filtered = data_farmers[data_farmers['district'] == cur_district]
-            else:
-                data_farmers_filtered = data_farmers
-        elif current_tab == "CWS View":
-            if selected_cws() is not None:
-                cur_cws = str(selected_cws()['cws_id'].values[0])
-                data_farmers_filtered = data_farmers[data_farmers['farmer_cws'] == cur_cws]
-            else:
-                data_farmers_filtered = data_farmers
-        else:
-            data_farmers_filtered = data_farmers
-
-        # Prepare the training data
-        training_data = (
-            data_farmers_filtered['training_topics']
-            .str.split(' ')
-            .explode()
-            .value_counts()
-            .reset_index()
-        )
-        # Rename columns for clarity
-        training_data.columns = ['topic', 'count'] 
-        data = training_data.sort_values('count', ascending=False)
+    @instrument()
+    async def touch_points_chart():
+        # the farmers of the selection on the active tab (see current_selection)
+        selection = current_selection()
+        farmers, farms, hierarchy = data_farmers(), data_farms(), admin()
+        select_farmers = lambda: engine.selection_farmers(selection, farmers, farms, hierarchy)
+
+        def chart_html():
+            # Prepare the training data
+            data = engine.training_topics_data(selection, select_farmers())
        
-        # Create the plotly plot
-        fig = go.Figure()
-
-        fig.add_trace(go.Bar(
-            x=data['topic'],
-            y=data['count'],
-            marker=dict(
-                color='rgba(50, 171, 96, 0.6)',
-                colorscale='Greens',
-                showscale=False,
-                colorbar=dict(title='topic')
+            # Create the plotly plot
+            fig = go.Figure()
+
+            fig.add_trace(go.Bar(
+                x=data['topic'],
+                y=data['count'],
+                marker=dict(
+                    color='rgba(50, 171, 96, 0.6)',
+                    colorscale='Greens',
+                    showscale=False,
+                    colorbar=dict(title='topic')
+                )
+            ))
+
+            fig.update_layout(
+                yaxis=dict(tickformat=','),
+                xaxis=dict(tickangle=45),
+                height=290,
+                margin=dict(l=10, r=10, t=30, b=10),
+                autosize=True,
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)'
             )
-        ))
-
-        fig.update_layout(
-            yaxis=dict(tickformat=','),
-            xaxis=dict(tickangle=45),
-            height=290,
-            margin=dict(l=10, r=10, t=30, b=10),
-            autosize=True,
-            paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)'
-        )
 
-        return ui.HTML(fig.to_html(full_html=False))
+            return fig.to_html(full_html=False)
+
+        # the chart is built once per selection, on the executor
+        return ui.HTML(await offload(selection_cache.get, "touch_points_chart", selection, [farmers], chart_html))
+
+    # 4. capacity of the stations against the cherry expected from the farms,
+    # per district; it only changes with the data, not with the selection
+    @output
+    @render.ui
+    @instrument()
+    async def capacity_chart():
+        capacity = cws_capacity()
+
+        def chart_html():
+            data = capacity.districts.sort_values('processing_capacity', ascending=False)
+            fig = go.Figure()
+            for column, name, color in [('processing_capacity', 'Processing capacity', 'rgba(44, 62, 80, 0.6)'),
+                                        ('actual_capacity', 'Processed', 'rgba(50, 171, 96, 0.6)'),
+                                        ('expected_cherry_t', 'Expected cherry', 'rgba(188, 179, 46, 0.6)')]:
+                fig.add_trace(go.Bar(x=data.index, y=data[column], name=name, marker=dict(color=color)))
+
+            fig.update_layout(
+                barmode='group',
+                yaxis=dict(tickformat=',', title='Tonnes'),
+                xaxis=dict(tickangle=45),
+                legend=dict(orientation='h', y=1.1),
+                height=290,
+                margin=dict(l=10, r=10, t=30, b=10),
+                autosize=True,
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)'
+            )
+
+            return fig.to_html(full_html=False)
+
+        # the chart is built once per data refresh, on the executor
+        return ui.HTML(await offload(selection_cache.get, "capacity_chart", ALL, [capacity], chart_html))
+
+    # 5. Export of the current selection
+    # farms and farmers of the selected district/sector/cell or CWS (all of
+    # them otherwise), with the name of the selection for the file names
+    @reactive.Calc
+    @instrument()
+    def selection_tables():
+        current_tab = active_tab()
+        if current_tab == "Coffee Farms View" and selected_unit() is not None and len(selected_unit()[1]):
+            level, units = selected_unit()
+            farmers = engine.selection_farmers(current_selection(), data_farmers(), data_farms(), admin())
+            return "_".join(admin().units(level, units)[level]), selected_farms(), farmers
+        elif current_tab == "CWS View" and selected_cws() is not None:
+            cur_cws = str(selected_cws()['cws_id'].values[0])
+            farmers, farms = selected_cws_members()
+            return cur_cws, farms, farmers
+        return "all", data_farms(), data_farmers()
+
+    # the files are encoded chunk by chunk on a worker thread while they download
+    @render.download(filename=lambda: export_filename("farms", selection_tables()[0], input.export_format()),
+                     media_type=lambda: export_media_type(input.export_format()))
+    @instrument()
+    async def export_farms():
+        _, farms, _ = selection_tables()
+        async for chunk in stream(export_chunks(farms, input.export_format())):
+            yield chunk
+
+    @render.download(filename=lambda: export_filename("farmers", selection_tables()[0], input.export_format()),
+                     media_type=lambda: export_media_type(input.export_format()))
+    @instrument()
+    async def export_farmers():
+        _, _, farmers = selection_tables()
+        async for chunk in stream(export_chunks(farmers, input.export_format())):
+            yield chunk
+
+    # 6. Printable report of the selection, rendered on the worker pool
+    report_job = reactive.Value(None)
+
+    # the cards as they are shown, as (label, value)
+    def report_cards():
+        totals, _, _ = farmer_totals()
+        area, _, _ = farm_totals()
+        return [
+            ("Total farmers", f"{totals['farmers']:,.0f}"),
+            ("Women participation", f"{women_share(totals):.1f}%"),
+            ("Youth engagement", f"{young_share(totals):.1f}%"),
+            ("Households with youth", f"{percent(totals['hh_with_youth'], totals['farmers']):.1f}%"),
+            ("Youth in households", f"{totals['youth_in_hh']:,.0f}"),
+            ("Cultivated area (ha)", f"{area['area']:,.1f}"),
+        ]
+
+    @reactive.Effect
+    @reactive.event(input.generate_report)
+    @instrument("generate_report")
+    def _():
+        name, farms, farmers = selection_tables()
+        selection = stations = None
+        if active_tab() == "Coffee Farms View" and name != "all":
+            level, units = selected_unit()
+            selection = admin().units(level, units).geometry.values
+        elif active_tab() == "CWS View" and name != "all":
+            areas = cws_service_areas()
+            selection = areas.loc[areas['cws_id'] == name].geometry.values
+            stations = selected_cws().geometry.values
+        start, end = selected_months()
+        if start is not None and end is not None:
+            period = f"Farms registered {month_label(start)} to {month_label(end)}"
+        else:
+            period = "All registration months"
+        title = "Coffee farms" + ("" if name == "all" else f": {name.replace('_', ' ').title()}")
+        snapshot = report_snapshot(title, period, report_cards(), farms, farmers, report_layers(),
+                                   selection=selection, stations=stations)
+        fmt = input.report_format()
+        report_job.set(report_jobs.submit(snapshot, fmt, f"{file_stem('report', name)}.{fmt}"))
+
+    @output
+    @render.ui
+    @instrument()
+    def report_status():
+        job_id = report_job.get()
+        if job_id is None:
+            return None
+        job = report_jobs.status(job_id)
+        if job["state"] in ("queued", "running"):
+            reactive.invalidate_later(reports.POLL_SECS)
+            return ui.div(
+                ui.div(ui.div(class_="progress-bar", style=f"width: {job['progress']:.0%}"), class_="progress"),
+                ui.span(job["message"], class_="metric-label")
+            )
+        if job["state"] == "failed":
+            return ui.div(f"The report could not be made: {job['message']}", class_="metric-trend negative")
+        return ui.download_button("download_report", f"Download {REPORT_FORMATS[job['format']][0]}")
+
+    @render.download(filename=lambda: report_jobs.status(report_job.get())["filename"],
+                     media_type=lambda: REPORT_FORMATS[report_jobs.status(report_job.get())["format"]][1])
+    @instrument()
+    def download_report():
+        return report_jobs.status(report_job.get())["path"]
 
-app = App(app_ui, server)
+app = with_metrics_routes(with_api_routes(App(app_ui, server), store))
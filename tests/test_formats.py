@@ -0,0 +1,270 @@
+"""Round trips of the binary and encoded formats the maps are drawn from:
+the on-disk packed R-tree (`coffee_core.rtree`) and the freshness checks of
+the ingest cache it goes with, the packed layers (`coffee_core.packed`) and
+the shared-arc TopoJSON (`coffee_core.topology`).
+
+    python -m pytest tests
+"""
+import base64
+import json
+import os
+import shutil
+import subprocess
+import zlib
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, Point, Polygon, box
+
+from coffee_core import ingest, packed
+from coffee_core.rtree import NODE_SIZE, FarmIndex, PackedRTree, write_rtree
+from coffee_core.topology import encode_topology
+
+
+# Packed R-tree
+#---------------
+def _farm_boxes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    points = np.column_stack([rng.uniform(29, 31, n), rng.uniform(-3, -1, n)])
+    half = rng.uniform(0, 0.01, (n, 2))
+    return points, np.hstack([points - half, points + half])
+
+
+def _brute_force(points, min_x, min_y, max_x, max_y):
+    return np.flatnonzero((points[:, 0] >= min_x) & (points[:, 0] <= max_x)
+                          & (points[:, 1] >= min_y) & (points[:, 1] <= max_y))
+
+
+# sizes around the node boundaries: one full node, one over, two full levels, one over
+@pytest.mark.parametrize("n", [1, NODE_SIZE, NODE_SIZE + 1, NODE_SIZE ** 2, NODE_SIZE ** 2 + 1, 1000])
+def test_rtree_search_matches_brute_force(tmp_path, n):
+    points, bounds = _farm_boxes(n)
+    write_rtree(tmp_path / "farms.rtree", points, bounds)
+    tree = PackedRTree(tmp_path / "farms.rtree")
+    assert len(tree) == n
+
+    rng = np.random.default_rng(n)
+    queries = [(28, -4, 32, 0), (29.5, -2.5, 30.5, -1.5), (31.5, -1, 32, 0)]
+    for _ in range(50):
+        x, y = rng.uniform(29, 31, 2), rng.uniform(-3, -1, 2)
+        queries.append((x.min(), y.min(), x.max(), y.max()))
+    # a box holding exactly one farm's point
+    queries.append(tuple(points[n // 2]) * 2)
+    for query in queries:
+        np.testing.assert_array_equal(np.sort(tree.search(*query)), _brute_force(points, *query))
+
+
+def test_farm_index_covers_the_appended_farms(tmp_path):
+    points, bounds = _farm_boxes(NODE_SIZE ** 2 + 1)
+    farms = gpd.GeoDataFrame(geometry=gpd.points_from_xy(points[:, 0], points[:, 1]), crs="EPSG:4326")
+    # the tree covers the first farms only, the others were appended since
+    write_rtree(tmp_path / "farms.rtree", points[:200], bounds[:200])
+    index = FarmIndex(farms, PackedRTree(tmp_path / "farms.rtree"))
+    in_memory = FarmIndex(farms)
+    for south, west, north, east in [(-3, 29, -1, 31), (-2.5, 29.5, -1.5, 30.5), (-2, 30, -1.9, 30.1)]:
+        expected = _brute_force(points, west, south, east, north)
+        np.testing.assert_array_equal(index.query(south, west, north, east), expected)
+        np.testing.assert_array_equal(in_memory.query(south, west, north, east), expected)
+
+
+def test_rtree_rejects_other_files(tmp_path):
+    (tmp_path / "farms.rtree").write_bytes(b"not a tree")
+    with pytest.raises(ValueError):
+        PackedRTree(tmp_path / "farms.rtree")
+
+
+# Ingest cache and its index
+#----------------------------
+@pytest.fixture
+def ingested(tmp_path):
+    points, _ = _farm_boxes(NODE_SIZE + 1)
+    csv_path = tmp_path / "Coffee_farms.csv"
+    pd.DataFrame({
+        "national_id": np.arange(len(points)),
+        "nbr_coffee_trees": 100,
+        "age_range_coffee_trees": "16_to_30",
+        "geom": [box(x, y, x + 0.001, y + 0.001).wkt for x, y in points],
+    }).to_csv(csv_path, index=False)
+    ingest.ingest_farms(csv_path, progress=None)
+    return csv_path
+
+
+def test_farms_index_goes_with_its_cache(ingested):
+    tree = ingest.read_farms_index(ingested)
+    farms = ingest.read_farms_cache(ingested)
+    assert tree is not None and farms is not None
+    assert len(tree) == len(farms)
+    west, south, east, north = farms.total_bounds
+    np.testing.assert_array_equal(np.sort(tree.search(west, south, east, north)), np.arange(len(farms)))
+
+
+def test_farms_index_of_a_rewritten_cache_is_stale(ingested):
+    cached = ingest.cache_path(ingested)
+    # the cache rewritten (by another ingest, say) after the index
+    cached.write_bytes(cached.read_bytes())
+    stat = cached.stat()
+    os.utime(cached, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert ingest.read_farms_cache(ingested) is not None
+    assert ingest.read_farms_index(ingested) is None
+
+
+def test_farms_cache_older_than_the_export_is_stale(ingested):
+    cached = ingest.cache_path(ingested)
+    stat = cached.stat()
+    os.utime(ingested, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert ingest.read_farms_cache(ingested) is None
+    assert ingest.read_farms_index(ingested) is None
+
+
+# Packed layers
+#---------------
+# the Python mirror of `unpackLayer` in packed.UNPACK_JS
+def _unpack_layer(value):
+    raw = zlib.decompress(base64.b64decode(value))
+    length = int(np.frombuffer(raw[:4], dtype="<u4")[0])
+    header = json.loads(raw[4:4 + length])
+    position = 4 + length
+    offsets = []
+    for n in header["offsets"]:
+        offsets.append(np.frombuffer(raw, dtype="<i4", count=n, offset=position))
+        position += 4 * n
+    deltas = np.frombuffer(raw, dtype="<i4", count=2 * header["coordinates"], offset=position).reshape(-1, 2)
+    coords = np.cumsum(deltas.astype(np.int64), axis=0) / 10 ** header["precision"]
+    geometry_type = shapely.GeometryType[header["type"].upper()]
+    geometries = shapely.from_ragged_array(geometry_type, coords, tuple(offsets) or None)
+    geometries[header["missing"]] = None
+    return header, geometries
+
+
+def _layers():
+    return {
+        "points": gpd.GeoDataFrame({"name": ["a", "b", "c"], "value": [1.5, None, 3.0]},
+                                   geometry=[Point(29.123456, -1.654321), None, Point(30.5, -2.25)],
+                                   crs="EPSG:4326"),
+        "polygons": gpd.GeoDataFrame({"district": ["x", "y"]}, geometry=[
+            Polygon([(29, -2), (29.5, -2), (29.5, -1.5), (29, -1.5)],
+                    [[(29.1, -1.9), (29.2, -1.9), (29.2, -1.8), (29.1, -1.8)]]),
+            MultiPolygon([box(30, -2, 30.25, -1.75), box(30.5, -2, 30.75, -1.75)]),
+        ], crs="EPSG:4326"),
+    }
+
+
+@pytest.mark.parametrize("name", ["points", "polygons"])
+def test_pack_round_trips(name):
+    layer = _layers()[name]
+    header, geometries = _unpack_layer(packed.pack(layer))
+    assert header["properties"] == json.loads(layer.drop(columns="geometry").to_json(orient="records"))
+    for original, unpacked in zip(layer.geometry, geometries):
+        if original is None:
+            assert unpacked is None
+        else:
+            assert shapely.hausdorff_distance(original, unpacked) <= 10 ** -packed.PRECISION
+
+
+def test_pack_keeps_feature_ids():
+    collection = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "id": 7, "geometry": {"type": "Point", "coordinates": [29.5, -2.0]}, "properties": {}},
+        {"type": "Feature", "id": 3, "geometry": {"type": "Point", "coordinates": [30.5, -1.5]}, "properties": {}},
+    ]}
+    header, _ = _unpack_layer(packed.pack(collection))
+    assert header["ids"] == [7, 3] and header["properties"] is None
+
+
+def test_pack_falls_back_to_geojson_for_mixed_layers():
+    layer = gpd.GeoDataFrame(geometry=[Point(29, -2), box(29, -2, 30, -1)], crs="EPSG:4326")
+    assert packed.pack(layer) == layer.__geo_interface__
+
+
+def test_pack_mask_bits():
+    mask = zlib.decompress(base64.b64decode(packed.pack_mask([0, 9, 20], 21)))
+    bits = np.unpackbits(np.frombuffer(mask, dtype=np.uint8), bitorder="little")[:21]
+    np.testing.assert_array_equal(np.flatnonzero(bits), [0, 9, 20])
+
+
+# the decoder the pages run, where node can run it
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+def test_unpack_js_reads_pack(tmp_path):
+    layer = _layers()["polygons"]
+    script = tmp_path / "unpack.js"
+    script.write_text(packed.UNPACK_JS + f"""
+unpackLayer({json.dumps(packed.pack(layer))}).then(function(layer) {{
+    return unpackMask({json.dumps(packed.pack_mask([1], 2))}).then(function(selected) {{
+        layer.selected = [selected(0), selected(1)];
+        console.log(JSON.stringify(layer));
+    }});
+}});
+""")
+    decoded = json.loads(subprocess.run(["node", str(script)], capture_output=True, text=True, check=True).stdout)
+    assert [f["id"] for f in decoded["features"]] == [0, 1]
+    assert decoded["selected"] == [False, True]
+    for original, feature in zip(layer.geometry, decoded["features"]):
+        assert feature["properties"] == {"district": layer["district"][feature["id"]]}
+        unpacked = shapely.geometry.shape(feature["geometry"])
+        assert shapely.hausdorff_distance(original, unpacked) <= 10 ** -packed.PRECISION
+
+
+# Shared-arc TopoJSON
+#---------------------
+# GeoJSON-like geometries of the topology's `name` object, like topojson-client's `feature`
+def _decode_topology(topology, name):
+    (kx, ky), (x0, y0) = topology["transform"]["scale"], topology["transform"]["translate"]
+    arcs = [np.cumsum(np.array(arc), axis=0) * (kx, ky) + (x0, y0) for arc in topology["arcs"]]
+
+    def ring(ids):
+        points = [arcs[i] if i >= 0 else arcs[~i][::-1] for i in ids]
+        return np.vstack([points[0]] + [p[1:] for p in points[1:]])
+
+    geometries = []
+    for geometry in topology["objects"][name]["geometries"]:
+        if geometry["type"] is None:
+            geometries.append(None)
+            continue
+        polygons = [geometry["arcs"]] if geometry["type"] == "Polygon" else geometry["arcs"]
+        geometries.append(MultiPolygon([Polygon(ring(rings[0]), [ring(r) for r in rings[1:]]) for rings in polygons]))
+    return geometries
+
+
+def _boundary_layers():
+    # four districts tiling a square, a lake on the border of two of them, a
+    # park inside one, and a district without a geometry
+    districts = [box(x, y, x + 0.5, y + 0.5) for x in (29.0, 29.5) for y in (-2.0, -1.5)] + [None]
+    lake = box(29.4, -1.9, 29.6, -1.7)
+    return {
+        "country": gpd.GeoDataFrame({"name": ["Rwanda"]}, geometry=[box(29, -2, 30, -1)], crs="EPSG:4326"),
+        "districts": gpd.GeoDataFrame({"district": list("abcde")}, geometry=districts, crs="EPSG:4326"),
+        "lakes": gpd.GeoDataFrame({"name": ["lake"]}, geometry=[lake], crs="EPSG:4326"),
+        "parks": gpd.GeoDataFrame({"name": ["park"]}, geometry=[
+            Polygon(box(29.05, -1.45, 29.45, -1.05).exterior.coords, [box(29.1, -1.4, 29.2, -1.3).exterior.coords]),
+        ], crs="EPSG:4326"),
+    }
+
+
+def test_topology_round_trips():
+    layers = _boundary_layers()
+    topology = encode_topology(layers)
+    (kx, ky) = topology["transform"]["scale"]
+    for name, layer in layers.items():
+        objects = topology["objects"][name]["geometries"]
+        assert [g["id"] for g in objects] == list(range(len(layer)))
+        assert [g["properties"] for g in objects] == json.loads(layer.drop(columns="geometry").to_json(orient="records"))
+        for original, decoded in zip(layer.geometry, _decode_topology(topology, name)):
+            if original is None:
+                assert decoded is None
+            else:
+                assert shapely.hausdorff_distance(original, decoded) <= np.hypot(kx, ky)
+                assert abs(decoded.area - original.area) <= original.length * np.hypot(kx, ky)
+
+
+def test_topology_stores_shared_edges_once():
+    # two squares sharing an edge: the shared edge and the two others
+    layers = {"districts": gpd.GeoDataFrame({"district": ["a", "b"]},
+                                            geometry=[box(29, -2, 29.5, -1.5), box(29.5, -2, 30, -1.5)],
+                                            crs="EPSG:4326")}
+    topology = encode_topology(layers)
+    assert len(topology["arcs"]) == 3
+    a, b = (g["arcs"][0] for g in topology["objects"]["districts"]["geometries"])
+    shared = set(a) & {~i for i in b}
+    assert len(shared) == 1